@@ -0,0 +1,89 @@
+"""
+Compares checking the content warnings of the sample tweets with a
+regex/split per topic (how _check_cw used to work) against the prebuilt
+keyword automaton, with a few hundred keywords.
+
+Usage:
+    python benchmarks/bench_keywords.py [--number N] [--keywords K]
+"""
+import os
+import re
+import json
+import random
+import string
+import timeit
+import argparse
+
+from pleroma_bot._keywords import ContentWarnings
+
+SAMPLE_DATA = os.path.join(
+    os.path.dirname(__file__), os.pardir,
+    "pleroma_bot", "tests", "test_files", "sample_data", "tweets_v2.json"
+)
+
+
+def check_cw_per_topic(data, cw_list):
+    # Previous implementation of _check_cw
+    cw_found = []
+    for cw_topic in cw_list:
+        alnum = [k for k in cw_list[cw_topic] if k.isalnum()]
+        not_alnum = [k for k in cw_list[cw_topic] if not k.isalnum()]
+        topic_found = False
+        if not_alnum:
+            matches = re.findall("|".join(not_alnum), data, re.IGNORECASE)
+            if matches:
+                topic_found = True
+        if any(k.lower() in data.lower().split() for k in alnum):
+            topic_found = True
+        if topic_found:
+            cw_found.append(cw_topic.lower())
+    cw_text = ", ".join(cw_found).capitalize()
+    return cw_text
+
+
+def make_cw_list(keywords):
+    rnd = random.Random(0)
+    cw_list = {"spoilers": ["#sponsored", "data"], "hypothetical": ["based"]}
+    for topic_idx in range(keywords // 10):
+        cw_list[f"topic {topic_idx}"] = [
+            "".join(rnd.choice(string.ascii_lowercase) for _ in range(8))
+            + ("" if idx % 2 else "-x")
+            for idx in range(10)
+        ]
+    return cw_list
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--number", type=int, default=200)
+    parser.add_argument("--keywords", type=int, default=300)
+    args = parser.parse_args()
+
+    with open(SAMPLE_DATA) as f:
+        texts = [tweet["text"] for tweet in json.load(f)["data"]]
+    cw_list = make_cw_list(args.keywords)
+    cw = ContentWarnings(cw_list)
+
+    for text in texts:
+        expected = check_cw_per_topic(text, cw_list)
+        output = cw.check(text)
+        if output != expected:
+            print(f"Mismatch for {text!r}: {expected!r} != {output!r}")
+
+    results = {}
+    funcs = {
+        "per_topic": lambda text: check_cw_per_topic(text, cw_list),
+        "automaton": cw.check,
+    }
+    for name, func in funcs.items():
+        timer = timeit.Timer(lambda: [func(text) for text in texts])
+        best = min(timer.repeat(repeat=5, number=args.number))
+        per_tweet = best / (args.number * len(texts)) * 1e6
+        results[name] = per_tweet
+        print(f"{name:>10}: {per_tweet:.2f} us/tweet")
+    speedup = results["per_topic"] / results["automaton"]
+    print(f"{'speedup':>10}: {speedup:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
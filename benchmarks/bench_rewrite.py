@@ -0,0 +1,134 @@
+"""
+Compares rewriting the text of the sample tweets with the chain of
+functions process_tweets used to apply one after another against the
+single pass TextRewriter.
+
+Usage:
+    python benchmarks/bench_rewrite.py [--number N]
+"""
+import os
+import re
+import json
+import html
+import argparse
+import tempfile
+import timeit
+from types import SimpleNamespace
+
+from pleroma_bot._cache import JsonCache
+from pleroma_bot._rewrite import URL_PATTERN
+from pleroma_bot._processing import (
+    _expand_urls,
+    _remove_media_links,
+    _remove_status_links,
+    _replace_mentions,
+    _replace_url,
+    _rewrite_text,
+)
+
+SAMPLE_DATA = os.path.join(
+    os.path.dirname(__file__), os.pardir,
+    "pleroma_bot", "tests", "test_files", "sample_data", "tweets_v2.json"
+)
+
+
+def make_user(cache_path):
+    user = SimpleNamespace(
+        keep_media_links=False,
+        rich_text=True,
+        nitter=True,
+        nitter_base_url="https://nitter.net",
+        invidious=True,
+        invidious_base_url="https://yewtu.be",
+        custom_replacements={"@imdevKc": "@fedihandle", "data": "spot"},
+        url_cache=JsonCache(cache_path),
+        text_rewriter=None,
+    )
+    return user
+
+
+def custom_replacements(data, replacements):
+    # Previous implementation of the custom replacements, keys as regexes
+    replacements = {k.lower(): v for k, v in replacements.items()}
+    keys_regex = "|".join(replacements.keys())
+    matches = re.findall(keys_regex, data, re.IGNORECASE)
+    for match in matches:
+        data = re.sub(match, lambda m: replacements[m.group().lower()], data)
+    return data
+
+
+def chained(user, tweet):
+    # Sequence of passes process_tweets applied before TextRewriter
+    tweet["text"] = _expand_urls(user, tweet)
+    tweet["text"] = html.unescape(tweet["text"])
+    if not user.keep_media_links:
+        tweet["text"] = _remove_media_links(user, tweet)
+        tweet["text"] = _remove_status_links(user, tweet)
+    if user.rich_text:
+        tweet["text"] = _replace_mentions(user, tweet)
+    if user.nitter:
+        tweet["text"] = _replace_url(
+            user, tweet["text"], "https://twitter.com", user.nitter_base_url
+        )
+    if user.invidious:
+        tweet["text"] = _replace_url(
+            user, tweet["text"], "https://youtube.com",
+            user.invidious_base_url
+        )
+    if user.custom_replacements:
+        tweet["text"] = custom_replacements(
+            tweet["text"], user.custom_replacements
+        )
+    return tweet["text"]
+
+
+def single_pass(user, tweet):
+    return _rewrite_text(user, tweet)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--number", type=int, default=2000)
+    args = parser.parse_args()
+
+    with open(SAMPLE_DATA) as f:
+        tweets = json.load(f)["data"]
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        user = make_user(os.path.join(tmp_dir, "url_cache.json"))
+        # Pretend every URL was already expanded, so nothing goes to the
+        # network and only the text processing is measured
+        for tweet in tweets:
+            for match in URL_PATTERN.finditer(tweet["text"]):
+                url = match.group()
+                if url.startswith(("http://", "https://")):
+                    user.url_cache.set(url, url)
+
+        for tweet in tweets:
+            expected = chained(user, dict(tweet))
+            output = single_pass(user, dict(tweet))
+            if output != expected:
+                print(f"Mismatch for {tweet['id']}:")
+                print(f"{'chained':>12}: {expected!r}")
+                print(f"{'single_pass':>12}: {output!r}")
+
+        funcs = (chained, single_pass)
+        timings = {func.__name__: [] for func in funcs}
+        # Alternate between both, so a noisy moment doesn't favour either
+        for _repeat in range(5):
+            for func in funcs:
+                timer = timeit.Timer(
+                    lambda: [func(user, dict(tweet)) for tweet in tweets]
+                )
+                timings[func.__name__].append(timer.timeit(args.number))
+        results = {}
+        for name, times in timings.items():
+            per_tweet = min(times) / (args.number * len(tweets)) * 1e6
+            results[name] = per_tweet
+            print(f"{name:>12}: {per_tweet:.2f} us/tweet")
+        speedup = results["chained"] / results["single_pass"]
+        print(f"{'speedup':>12}: {speedup:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,50 @@
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+
+class AsyncEngine:
+    """
+    Runs the fetch -> process -> post cycle of several users concurrently
+    from an event loop.
+
+    The HTTP stack is blocking, so the loop only schedules the users: the
+    cycle of each one runs in a thread of the engine's pool, the same one
+    the 'sync' engine runs (see _run_user). The pool should have a thread
+    for every user running at once: a user waiting for a rate limit only
+    holds its own thread. The number of in-flight requests per host is
+    bounded by the session registry of each user, regardless of how many
+    users are waiting on it.
+    """
+
+    def __init__(self, max_workers=None):
+        self.max_workers = max_workers
+        self.loop = None
+        self.executor = None
+
+    def run(self, coroutines) -> list:
+        """Runs the given coroutines concurrently until all of them are done
+
+        :param coroutines: coroutines to run
+        :type coroutines: list
+        :returns: result (or raised exception) of every coroutine, in the
+            same order they were given
+        :rtype: list
+        """
+        async def gather():
+            return await asyncio.gather(*coroutines, return_exceptions=True)
+
+        self.loop = asyncio.new_event_loop()
+        self.executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        try:
+            return self.loop.run_until_complete(gather())
+        finally:
+            self.executor.shutdown(wait=True)
+            self.loop.close()
+            self.loop = None
+            self.executor = None
+
+    async def run_blocking(self, func, *args, **kwargs):
+        """Awaits a blocking call executed in the engine's thread pool"""
+        call = functools.partial(func, *args, **kwargs)
+        return await self.loop.run_in_executor(self.executor, call)
@@ -0,0 +1,153 @@
+import os
+import json
+import time
+import threading
+
+from . import logger
+from .i18n import _
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+class JsonCache:
+    """
+    Small key-value cache persisted as a JSON file. Entries expire after
+    'ttl' seconds (never if None). If 'max_entries' is set, the least
+    recently used entries are evicted once the cache grows past it.
+    """
+
+    def __init__(self, path, ttl=None, max_entries=None):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = None
+        self._lock = threading.RLock()
+
+    def get(self, key, default=None):
+        """Returns the value stored for 'key' if present and not expired
+
+        :param key: key to look up
+        :type key: str
+        :param default: value to return on a cache miss
+        :returns: cached value or default
+        """
+        with self._lock:
+            entry = self._load().get(key)
+            if entry is None:
+                return default
+            expires = entry.get("expires")
+            if expires is not None and expires <= time.time():
+                del self._entries[key]
+                return default
+            if self.max_entries:
+                # Move it to the end, entries are kept in order of use
+                self._entries[key] = self._entries.pop(key)
+            return entry["value"]
+
+    def __contains__(self, key):
+        sentinel = object()
+        return self.get(key, sentinel) is not sentinel
+
+    def set(self, key, value, ttl=None):
+        """Stores 'value' for 'key'. 'ttl' overrides the TTL of the cache for
+        this entry"""
+        ttl = self.ttl if ttl is None else ttl
+        expires = time.time() + ttl if ttl is not None else None
+        with self._lock:
+            entries = self._load()
+            entries.pop(key, None)
+            entries[key] = {"value": value, "expires": expires}
+            if self.max_entries and len(entries) > self.max_entries:
+                self._evict()
+
+    def items(self) -> list:
+        """Returns the (key, value) pairs that haven't expired, least
+        recently set first
+
+        :rtype: list
+        """
+        now = time.time()
+        with self._lock:
+            return [
+                (key, entry["value"])
+                for key, entry in self._load().items()
+                if entry.get("expires") is None or entry["expires"] > now
+            ]
+
+    def delete(self, key):
+        with self._lock:
+            self._load().pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries = {}
+
+    def save(self):
+        """Writes the cache to disk, replacing the previous file atomically"""
+        with self._lock:
+            if self._entries is None:
+                return
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(self._entries, f)
+            os.replace(tmp_path, self.path)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._load())
+
+    def __getstate__(self):
+        with self._lock:
+            state = self.__dict__.copy()
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.RLock()
+
+    def _evict(self):
+        now = time.time()
+        expired = [
+            key for key, entry in self._entries.items()
+            if entry.get("expires") is not None and entry["expires"] <= now
+        ]
+        for key in expired:
+            del self._entries[key]
+        excess = len(self._entries) - self.max_entries
+        for key in list(self._entries)[:max(excess, 0)]:
+            del self._entries[key]
+
+    def _load(self):
+        if self._entries is None:
+            self._entries = {}
+            if os.path.isfile(self.path):
+                try:
+                    with open(self.path, "r") as f:
+                        self._entries = json.load(f)
+                except (OSError, ValueError):
+                    logger.warning(
+                        _("Unable to read cache file, ignoring it: {}").format(
+                            self.path
+                        )
+                    )
+        return self._entries
+
+
+def get_cache(path, ttl=None, max_entries=None) -> JsonCache:
+    """Returns the cache stored at 'path', shared by every user in this
+    process
+
+    :param path: path of the cache file
+    :type path: str
+    :returns: cache
+    :rtype: JsonCache
+    """
+    path = os.path.abspath(path)
+    with _caches_lock:
+        cache = _caches.get(path)
+        if cache is None:
+            cache = JsonCache(path, ttl=ttl, max_entries=max_entries)
+            _caches[path] = cache
+    return cache
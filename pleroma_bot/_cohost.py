@@ -1,5 +1,4 @@
 import base64
-import requests
 from hashlib import pbkdf2_hmac
 from datetime import datetime, timedelta
 
@@ -13,8 +12,8 @@ def _login_cohost(self):  # pragma: todo
     cohost_salt_url = f"{self.pleroma_base_url}/api/v1/login/salt"
     data = {"email": email}
 
-    response = requests.get(
-        cohost_salt_url, data
+    response = self.http.get(
+        cohost_salt_url, params=data
     )
     salt = response.json()['salt']
     chars = ['-', '_']
@@ -29,7 +28,7 @@ def _login_cohost(self):  # pragma: todo
     data.update({"clientHash": client_hash})
 
     cohost_login_url = f"{self.pleroma_base_url}/api/v1/login"
-    response = requests.post(cohost_login_url, data)
+    response = self.http.post(cohost_login_url, data)
     cookie = response.headers['set-cookie'].split(";")[0].split("=")[1]
     self.cohost_cookies = {'connect.sid': cookie}
 
@@ -39,7 +38,7 @@ def _login_cohost(self):  # pragma: todo
 def _get_cohost_profile_info(self):  # pragma: todo
     self._login_cohost()
     cohost_info_url = f"{self.pleroma_base_url}/api/v1/trpc/login.loggedIn"
-    response = requests.get(cohost_info_url, cookies=self.cohost_cookies)
+    response = self.http.get(cohost_info_url, cookies=self.cohost_cookies)
     user_info = response.json()['result']['data']
     self.cohost_user_id = user_info["userId"]
     self.cohost_project_id = user_info["projectId"]
@@ -52,7 +51,7 @@ def get_date_last_cohost_post(self):  # pragma: todo
     cohost_posts_url = (
         f"{self.pleroma_base_url}/api/v1/project/{handle}/posts?page={page}"
     )
-    response = requests.get(cohost_posts_url, cookies=self.cohost_cookies)
+    response = self.http.get(cohost_posts_url, cookies=self.cohost_cookies)
     posts_json = response.json()['items']
     if len(posts_json) > 0:
         last_date = posts_json[0]["publishedAt"]
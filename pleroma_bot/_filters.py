@@ -0,0 +1,111 @@
+import re
+
+# Skips HTML character references (&#39;)
+HASHTAG = re.compile(r"(?<![&\w])#(\w+)")
+
+
+class TweetFilter:
+    """
+    Decides which gathered tweets are mirrored, according to the
+    'include_rts', 'include_quotes', 'include_replies' and 'hashtags'
+    settings of a user.
+
+    Every rule is evaluated in a single pass over the tweets.
+    """
+
+    def __init__(self, include_rts=True, include_quotes=True,
+                 include_replies=True, hashtags=None):
+        rules = (
+            ("retweeted", include_rts),
+            ("quoted", include_quotes),
+            ("replied_to", include_replies),
+        )
+        self.excluded_references = frozenset(
+            ref_type for ref_type, included in rules if not included
+        )
+        self.hashtags = frozenset(hashtags or ())
+
+    @classmethod
+    def from_user(cls, user):
+        return cls(
+            include_rts=user.include_rts,
+            include_quotes=user.include_quotes,
+            include_replies=user.include_replies,
+            hashtags=user.hashtags,
+        )
+
+    def accepts(self, tweet) -> bool:
+        """Returns whether 'tweet' passes every rule
+
+        :param tweet: tweet object, only its 'referenced_tweets' and
+            'entities' are looked at
+        :type tweet: dict
+        :rtype: bool
+        """
+        if self.excluded_references:
+            for reference in tweet.get("referenced_tweets") or ():
+                if reference.get("type") in self.excluded_references:
+                    return False
+        if self.hashtags:
+            try:
+                tweet_hashtags = tweet["entities"]["hashtags"]
+            except (KeyError, TypeError):
+                return False
+            # v2 uses 'tag', v1.1 (and archives) 'text'
+            return any(
+                hashtag.get("tag", hashtag.get("text")) in self.hashtags
+                for hashtag in tweet_hashtags
+            )
+        return True
+
+    def apply(self, tweets) -> list:
+        """Returns the tweets that pass every rule, keeping their order
+
+        :param tweets: list of tweet objects
+        :type tweets: list
+        :rtype: list
+        """
+        if not (self.excluded_references or self.hashtags):
+            return list(tweets)
+        return [tweet for tweet in tweets if self.accepts(tweet)]
+
+
+def archive_filter_fields(tweet) -> dict:
+    """Returns the fields TweetFilter looks at for a tweet from an archive
+
+    :param tweet: tweet object from the archive
+    :type tweet: dict
+    :rtype: dict
+    """
+    references = []
+    if tweet.get("in_reply_to_status_id_str"):
+        references.append({"type": "replied_to"})
+    if tweet.get("full_text", "").startswith("RT @"):
+        references.append({"type": "retweeted"})
+    return {
+        "referenced_tweets": references,
+        "entities": tweet.get("entities", {}),
+    }
+
+
+def rss_filter_fields(body, title) -> dict:
+    """Returns the fields TweetFilter looks at for an RSS entry
+
+    :param body: text of the entry
+    :type body: str
+    :param title: title of the entry, which includes the RT or reply
+        header
+    :type title: str
+    :rtype: dict
+    """
+    references = []
+    for text in (body, title):
+        if text.startswith("RT "):
+            references.append({"type": "retweeted"})
+        if text.startswith(("@", "Re @", "R to @")):
+            references.append({"type": "replied_to"})
+    hashtags = [{"tag": tag} for tag in HASHTAG.findall(body)]
+    return {
+        "referenced_tweets": references,
+        "entities": {"hashtags": hashtags},
+    }
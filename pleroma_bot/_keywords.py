@@ -0,0 +1,147 @@
+from collections import deque
+
+
+class KeywordMatcher:
+    """
+    Aho-Corasick automaton over a fixed set of keywords.
+
+    It is built once and then finds every occurrence of every keyword in a
+    text with a single scan, however many keywords there are. Matching is
+    case-insensitive.
+    """
+
+    def __init__(self, keywords):
+        self._goto = [{}]
+        self._fail = [0]
+        self._output = [()]
+        for keyword in keywords:
+            if keyword:
+                self._add(keyword)
+        self._build()
+
+    def __bool__(self):
+        return len(self._goto) > 1
+
+    def finditer(self, text):
+        """Yields (start, end, keyword) for every occurrence of a keyword in
+        'text', overlapping ones included, ordered by their end position
+
+        :param text: text to scan
+        :type text: str
+        """
+        goto = self._goto
+        fail = self._fail
+        output = self._output
+        state = 0
+        for idx, char in enumerate(_lower(text)):
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            for keyword in output[state]:
+                yield idx + 1 - len(keyword), idx + 1, keyword
+
+    def sub(self, repl, text) -> str:
+        """Replaces the leftmost-longest, non-overlapping occurrences of the
+        keywords in 'text'
+
+        :param repl: callable that receives the matched keyword (as it was
+            given) and returns its replacement
+        :type repl: callable
+        :param text: text to scan
+        :type text: str
+        :returns: text with the keywords replaced
+        :rtype: str
+        """
+        matches = sorted(
+            self.finditer(text), key=lambda match: (match[0], -match[1])
+        )
+        pieces = []
+        pos = 0
+        for start, end, keyword in matches:
+            if start < pos:
+                continue
+            pieces.append(text[pos:start])
+            pieces.append(repl(keyword))
+            pos = end
+        if not pieces:
+            return text
+        pieces.append(text[pos:])
+        return "".join(pieces)
+
+    def _add(self, keyword):
+        state = 0
+        for char in _lower(keyword):
+            next_state = self._goto[state].get(char)
+            if next_state is None:
+                next_state = len(self._goto)
+                self._goto.append({})
+                self._fail.append(0)
+                self._output.append(())
+                self._goto[state][char] = next_state
+            state = next_state
+        self._output[state] += (keyword,)
+
+    def _build(self):
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self._goto[state].items():
+                queue.append(next_state)
+                fallback = self._fail[state]
+                while fallback and char not in self._goto[fallback]:
+                    fallback = self._fail[fallback]
+                fallback = self._goto[fallback].get(char, 0)
+                self._fail[next_state] = fallback
+                self._output[next_state] += self._output[fallback]
+
+
+class ContentWarnings:
+    """
+    Finds the content warning topics whose keywords appear in a text.
+
+    Keywords made only of letters and digits must match a whole word (as
+    separated by whitespace), the rest match anywhere in the text.
+    """
+
+    def __init__(self, cw_list):
+        self.topics = list(cw_list)
+        self._keywords = {}
+        for topic in self.topics:
+            for keyword in cw_list[topic] or []:
+                whole_word = keyword.isalnum()
+                self._keywords.setdefault(keyword, []).append(
+                    (topic, whole_word)
+                )
+        self._matcher = KeywordMatcher(self._keywords)
+
+    def check(self, text) -> str:
+        """Returns the content warning for 'text'
+
+        :param text: text to check
+        :type text: str
+        :returns: topics found, separated by commas (empty if none)
+        :rtype: str
+        """
+        found = set()
+        for start, end, keyword in self._matcher.finditer(text):
+            for topic, whole_word in self._keywords[keyword]:
+                if topic in found:
+                    continue
+                if whole_word and not (
+                        (start == 0 or text[start - 1].isspace())
+                        and (end == len(text) or text[end].isspace())
+                ):
+                    continue
+                found.add(topic)
+        cw_found = [topic.lower() for topic in self.topics if topic in found]
+        return ", ".join(cw_found).capitalize()
+
+
+def _lower(text):
+    lowered = text.lower()
+    if len(lowered) == len(text):
+        return lowered
+    # Keep positions aligned with the original text
+    return "".join(
+        char.lower() if len(char.lower()) == 1 else char for char in text
+    )
@@ -0,0 +1,447 @@
+import os
+import time
+import shutil
+import hashlib
+import threading
+import mimetypes
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from . import logger
+from ._cache import JsonCache
+
+# Responses worth trying again after a while
+RETRY_STATUS = frozenset((429, 500, 502, 503, 504))
+# Seconds to wait before the first retry, doubled on every following one
+DEFAULT_BACKOFF = 1.0
+CHUNK_SIZE = 2 ** 16
+
+_media_caches = {}
+_media_caches_lock = threading.Lock()
+
+
+class MediaRejected(Exception):
+    """
+    Raised when the headers of a media response show that it won't be
+    accepted (e.g. it's too large), before its content is downloaded
+    """
+
+
+class RelayFailed(Exception):
+    """
+    Raised when streaming media to an upload failed in a way worth trying
+    again. The content was already consumed, so it has to be downloaded
+    before retrying
+    """
+
+
+class MediaDownloader:
+    """
+    Downloads media attachments, several at a time.
+
+    Requests go through the shared HTTP sessions, so they reuse their
+    connection pools, timeouts and limit of concurrent requests per host.
+    Connection errors, timeouts and transient HTTP errors (429 and 5xx) are
+    retried with an exponential backoff. The number of files and bytes
+    downloaded is kept for reporting.
+
+    If a MediaCache is given, media already in it is linked instead of
+    downloaded again, and new downloads are added to it. Copies sent to
+    other processes don't use it.
+    """
+
+    def __init__(self, http, workers=4, retries=2, backoff=DEFAULT_BACKOFF,
+                 cache=None):
+        self.http = http
+        self.workers = max(int(workers), 1)
+        self.retries = max(int(retries), 0)
+        self.backoff = backoff
+        self.cache = cache
+        self.files = 0
+        self.bytes = 0
+        self._lock = threading.Lock()
+
+    def map(self, func, jobs) -> list:
+        """Applies 'func' to every job at the same time (up to 'workers')
+
+        :param func: callable that receives a job and downloads it, usually
+            through download
+        :type func: callable
+        :param jobs: jobs to run
+        :type jobs: list
+        :returns: results of 'func', in the order of the jobs
+        :rtype: list
+        """
+        jobs = list(jobs)
+        if len(jobs) <= 1 or self.workers == 1:
+            return [func(job) for job in jobs]
+        workers = min(self.workers, len(jobs))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(func, jobs))
+
+    def download(self, url, directory, name, check=None) -> str:
+        """Downloads 'url' into 'directory'
+
+        :param url: URL of the media
+        :type url: str
+        :param directory: folder to save the file to
+        :type directory: str
+        :param name: name of the file, without extension (which is guessed
+            from the Content-Type of the response)
+        :type name: str
+        :param check: callable that receives the Content-Type and
+            Content-Length (None if unknown) of the response and returns
+            why the media must be skipped, or None to download it. It's
+            called before reading the content
+        :type check: callable
+        :returns: path of the downloaded file
+        :rtype: str
+        :raises requests.exceptions.HTTPError: if the media couldn't be
+            downloaded, once every retry is used
+        :raises MediaRejected: if 'check' rejected the media
+        """
+        if self.cache is not None:
+            file_path = self.cache.fetch(url, directory, name)
+            if file_path is not None:
+                logger.debug(f"Media cache hit: {url}")
+                return file_path
+        response = self._open(url, check)
+        try:
+            return self._save(response, url, directory, name)
+        finally:
+            response.close()
+
+    def relay(self, url, upload, check=None):
+        """Streams 'url' straight into 'upload', without writing it to disk
+
+        The media cache isn't used, as nothing is stored.
+
+        :param url: URL of the media
+        :type url: str
+        :param upload: callable that receives the Content-Type of the media
+            and an iterator over its content, uploads it and returns the
+            response (or None if it decided not to upload it)
+        :type upload: callable
+        :param check: same as in download
+        :type check: callable
+        :returns: what 'upload' returned
+        :rtype: requests.Response
+        :raises RelayFailed: if the upload failed with a connection error,
+            a timeout or a transient HTTP error
+        :raises requests.exceptions.HTTPError: if the media couldn't be
+            downloaded, once every retry is used
+        :raises MediaRejected: if 'check' rejected the media
+        """
+        response = self._open(url, check)
+        try:
+            try:
+                result = upload(
+                    response.headers.get("Content-Type"),
+                    self._stream(response),
+                )
+            except (
+                    requests.exceptions.ConnectionError,
+                    requests.exceptions.Timeout,
+            ) as e:
+                raise RelayFailed(str(e))
+            if result is not None and result.status_code in RETRY_STATUS:
+                raise RelayFailed(f"HTTP {result.status_code}")
+            return result
+        finally:
+            response.close()
+
+    def summary(self) -> tuple:
+        """Returns the number of files and bytes downloaded so far
+
+        :rtype: tuple
+        """
+        with self._lock:
+            return self.files, self.bytes
+
+    def _open(self, url, check):
+        attempt = 0
+        while True:
+            last_attempt = attempt >= self.retries
+            try:
+                response = self.http.get(url, stream=True)
+            except (
+                    requests.exceptions.ConnectionError,
+                    requests.exceptions.Timeout,
+            ):
+                if last_attempt:
+                    raise
+                attempt = self._wait(attempt, url)
+                continue
+            try:
+                if response.status_code in RETRY_STATUS and not last_attempt:
+                    response.close()
+                    attempt = self._wait(attempt, url)
+                    continue
+                if not response.ok:
+                    response.raise_for_status()
+                if check is not None:
+                    reason = check(
+                        response.headers.get("Content-Type"),
+                        _content_length(response),
+                    )
+                    if reason:
+                        raise MediaRejected(reason)
+            except BaseException:
+                response.close()
+                raise
+            return response
+
+    def _stream(self, response):
+        response.raw.decode_content = True
+        size = 0
+        for chunk in iter(lambda: response.raw.read(CHUNK_SIZE), b""):
+            size += len(chunk)
+            yield chunk
+        with self._lock:
+            self.files += 1
+            self.bytes += size
+
+    def _wait(self, attempt, url):
+        delay = self.backoff * 2 ** attempt
+        logger.debug(f"Retrying media download in {delay}s: {url}")
+        time.sleep(delay)
+        return attempt + 1
+
+    def _save(self, response, url, directory, name):
+        start = time.monotonic()
+        response.raw.decode_content = True
+        extension = mimetypes.guess_extension(
+            response.headers["Content-Type"]
+        ) or ""
+        file_path = os.path.join(directory, f"{name}{extension}")
+        digest = hashlib.sha256()
+        with open(file_path, "wb") as outfile:
+            for chunk in iter(lambda: response.raw.read(CHUNK_SIZE), b""):
+                digest.update(chunk)
+                outfile.write(chunk)
+        size = os.stat(file_path).st_size
+        if self.cache is not None:
+            self.cache.store(url, file_path, digest.hexdigest())
+        with self._lock:
+            self.files += 1
+            self.bytes += size
+        elapsed = time.monotonic() - start
+        logger.debug(
+            f"Downloaded {url} ({size} bytes in {elapsed:.2f}s) "
+            f"to {file_path}"
+        )
+        return file_path
+
+    def __getstate__(self):
+        # Counters and locks are not shared with other processes. Neither is
+        # the cache: the index of a copy is never saved, so the files other
+        # processes stored would be left out of it (and never evicted)
+        return {
+            "http": self.http,
+            "workers": self.workers,
+            "retries": self.retries,
+            "backoff": self.backoff,
+            "cache": None,
+        }
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.files = 0
+        self.bytes = 0
+        self._lock = threading.Lock()
+
+
+class MediaCache:
+    """
+    Content-addressed store of downloaded media, shared by every user (and
+    run) using the same folder.
+
+    Every file is stored once, named after the SHA-256 of its content, and
+    an index maps the URLs it was downloaded from to it. Files are handed
+    out as hard links (copies where links aren't supported), so removing
+    the temp folder of a tweet or evicting a file doesn't affect the other.
+    Once the stored files exceed 'max_size' bytes the least recently used
+    ones are evicted.
+    """
+
+    def __init__(self, path, max_size):
+        self.path = path
+        self.max_size = max_size
+        self._index = JsonCache(os.path.join(path, "index.json"))
+        self._lock = threading.RLock()
+        os.makedirs(path, exist_ok=True)
+
+    def __contains__(self, url):
+        with self._lock:
+            entry = self._index.get(url)
+            return entry is not None and os.path.isfile(
+                os.path.join(self.path, entry["file"])
+            )
+
+    def fetch(self, url, directory, name):
+        """Links the file cached for 'url' into 'directory'
+
+        :param url: URL of the media
+        :type url: str
+        :param directory: folder to link the file to
+        :type directory: str
+        :param name: name of the link, without extension
+        :type name: str
+        :returns: path of the link, None if 'url' isn't cached
+        :rtype: str
+        """
+        with self._lock:
+            entry = self._index.get(url)
+            if entry is None:
+                return None
+            blob_path = os.path.join(self.path, entry["file"])
+            if not os.path.isfile(blob_path):
+                self._index.delete(url)
+                return None
+            # Set it again to mark it as the most recently used
+            self._index.set(url, entry)
+            extension = os.path.splitext(entry["file"])[1]
+            file_path = os.path.join(directory, f"{name}{extension}")
+            _link(blob_path, file_path)
+            return file_path
+
+    def store(self, url, file_path, digest):
+        """Adds a downloaded file to the cache
+
+        :param url: URL the file was downloaded from
+        :type url: str
+        :param file_path: path of the file
+        :type file_path: str
+        :param digest: SHA-256 of the content of the file (hex)
+        :type digest: str
+        """
+        extension = os.path.splitext(file_path)[1]
+        blob = f"{digest}{extension}"
+        blob_path = os.path.join(self.path, blob)
+        with self._lock:
+            new_blob = not os.path.isfile(blob_path)
+            if new_blob:
+                _link(file_path, blob_path)
+            self._index.set(
+                url, {"file": blob, "size": os.stat(blob_path).st_size}
+            )
+            if new_blob:
+                self._evict()
+
+    def size(self) -> int:
+        """Returns the total size of the cached files, in bytes
+
+        :rtype: int
+        """
+        with self._lock:
+            blobs = {}
+            for url, entry in self._index.items():
+                blobs[entry["file"]] = entry["size"]
+            return sum(blobs.values())
+
+    def save(self):
+        self._index.save()
+
+    def _evict(self):
+        entries = self._index.items()
+        last_use = {}
+        sizes = {}
+        for position, (url, entry) in enumerate(entries):
+            last_use[entry["file"]] = position
+            sizes[entry["file"]] = entry["size"]
+        total = sum(sizes.values())
+        if total <= self.max_size:
+            return
+        evicted = set()
+        for blob in sorted(last_use, key=last_use.get):
+            if total <= self.max_size:
+                break
+            evicted.add(blob)
+            total -= sizes[blob]
+            try:
+                os.remove(os.path.join(self.path, blob))
+            except FileNotFoundError:
+                pass
+        for url, entry in entries:
+            if entry["file"] in evicted:
+                self._index.delete(url)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.RLock()
+
+
+def get_media_cache(path, max_size) -> MediaCache:
+    """Returns the media cache stored at 'path', shared by every user in
+    this process
+
+    :param path: folder of the cache
+    :type path: str
+    :param max_size: max total size of the cached files, in bytes
+    :type max_size: int
+    :returns: media cache
+    :rtype: MediaCache
+    """
+    path = os.path.abspath(path)
+    with _media_caches_lock:
+        cache = _media_caches.get(path)
+        if cache is None:
+            cache = MediaCache(path, max_size)
+            _media_caches[path] = cache
+    return cache
+
+
+def multipart_stream(boundary, fields, file_name, mime_type, chunks):
+    """Yields a multipart/form-data body with 'fields' and a 'file' part
+    whose content is read from 'chunks' as the body is sent
+
+    :param boundary: boundary between the parts
+    :type boundary: str
+    :param fields: names and values of the other form fields
+    :type fields: dict
+    :param file_name: name of the file
+    :type file_name: str
+    :param mime_type: MIME type of the file
+    :type mime_type: str
+    :param chunks: content of the file
+    :type chunks: iterable
+    """
+    for name, value in fields.items():
+        yield (
+            f"--{boundary}\r\n"
+            f"Content-Disposition: form-data; name=\"{name}\"\r\n\r\n"
+            f"{value}\r\n"
+        ).encode("utf-8")
+    yield (
+        f"--{boundary}\r\n"
+        f"Content-Disposition: form-data; name=\"file\"; "
+        f"filename=\"{file_name}\"\r\n"
+        f"Content-Type: {mime_type}\r\n\r\n"
+    ).encode("utf-8")
+    for chunk in chunks:
+        if chunk:
+            yield chunk
+    yield f"\r\n--{boundary}--\r\n".encode("utf-8")
+
+
+def _content_length(response):
+    try:
+        return int(response.headers["Content-Length"])
+    except (KeyError, ValueError):
+        return None
+
+
+def _link(source, destination):
+    if os.path.lexists(destination):
+        os.remove(destination)
+    try:
+        os.link(source, destination)
+    except OSError:
+        # Different filesystem or no support for hard links
+        shutil.copyfile(source, destination)
@@ -15,7 +15,7 @@ except ImportError:
 
 from . import logger
 from .i18n import _
-from ._utils import random_string, guess_type
+from ._utils import random_string, guess_type, file_digest
 
 
 def post_misskey(
@@ -82,7 +82,7 @@ def post_misskey(
             "i": self.pleroma_token,
             "noteId": post_id,
         }
-        response = requests.post(
+        response = self.http.post(
             misskey_posted_url, json.dumps(data_n), headers=self.header_pleroma
         )
         if response.ok:
@@ -125,7 +125,7 @@ def post_misskey(
         )
 
     self.header_pleroma.update({"Content-Type": "text/plain;charset=UTF-8"})
-    response = requests.post(
+    response = self.http.post(
         misskey_post_url, json.dumps(data), headers=self.header_pleroma
     )
     if not response.ok:
@@ -144,7 +144,7 @@ def get_date_last_misskey_post(self):
     """
     i_url = f"{self.pleroma_base_url}/api/i"
     data = {"i": self.pleroma_token}
-    response = requests.post(
+    response = self.http.post(
         i_url, json.dumps(data), headers=self.header_pleroma
     )
     i_id = response.json()["id"]
@@ -158,7 +158,7 @@ def get_date_last_misskey_post(self):
             "includeMyRenotes": True,
         }
         notes_url = f"{self.pleroma_base_url}/api/users/notes"
-        response = requests.post(
+        response = self.http.post(
             notes_url, json.dumps(data), headers=self.header_pleroma
         )
 
@@ -178,10 +178,37 @@ def get_date_last_misskey_post(self):
     return date_misskey
 
 
+def _find_misskey_file(self, file_path):
+    """Looks for a file with the same content in the drive of the user
+
+    :param file_path: path of the file
+    :type file_path: str
+    :returns: ID of the file in the drive or None
+    :rtype: str
+    """
+    find_url = f"{self.pleroma_base_url}/api/drive/files/find-by-hash"
+    data = {"i": self.pleroma_token, "md5": file_digest(file_path, "md5")}
+    response = self.http.post(
+        find_url,
+        data=json.dumps(data),
+        headers={"Content-Type": "application/json"}
+    )
+    # Not every instance supports it, just upload the file
+    if not response.ok:
+        return None
+    try:
+        drive_files = response.json()
+    except ValueError:  # pragma: todo
+        return None
+    if drive_files:
+        logger.debug(f"Reusing drive file: {drive_files[0]['id']}")
+        return drive_files[0]["id"]
+    return None
+
+
 def _upload_media_misskey(self, file_path, sensitive=False, media=None):
     misskey_media_url = f"{self.pleroma_base_url}/api/drive/files/create"
     media_id = None
-    media_file = open(file_path, "rb")
     file_size = os.stat(file_path).st_size
     size_mb = round(file_size / 1048576, 2)
     file = os.path.splitext(os.path.split(file_path)[1])[0]
@@ -199,29 +226,32 @@ def _upload_media_misskey(self, file_path, sensitive=False, media=None):
         f"{random_string(10)}"
         f"{mimetypes.guess_extension(mime_type)}"
     )
-    file_description = (file_name, media_file, mime_type)
-    files = {"file": file_description}
-
-    data = {"i": self.pleroma_token}
 
-    enc_mixin = requests.models.RequestEncodingMixin
-    body, content_type = enc_mixin._encode_files(
-        files, data
-    )
-    data = body
-    headers = {
-        "Cookie": f"igi={self.pleroma_token}",
-        "Content-Type": content_type
-    }
-    response = requests.post(
-        misskey_media_url,
-        data=data,
-        headers=headers
-    )
     try:
-        if not response.ok:
-            response.raise_for_status()
-        media_id = json.loads(response.text)["id"]
+        # Identical files already in the drive are attached by ID
+        media_id = _find_misskey_file(self, file_path)
+        if media_id is None:
+            data = {"i": self.pleroma_token}
+            enc_mixin = requests.models.RequestEncodingMixin
+            with open(file_path, "rb") as media_file:
+                file_description = (file_name, media_file, mime_type)
+                files = {"file": file_description}
+                body, content_type = enc_mixin._encode_files(
+                    files, data
+                )
+            data = body
+            headers = {
+                "Cookie": f"igi={self.pleroma_token}",
+                "Content-Type": content_type
+            }
+            response = self.http.post(
+                misskey_media_url,
+                data=data,
+                headers=headers
+            )
+            if not response.ok:
+                response.raise_for_status()
+            media_id = json.loads(response.text)["id"]
         if sensitive:
             update_url = f"{self.pleroma_base_url}/api/drive/files/update"
             data = {
@@ -229,7 +259,7 @@ def _upload_media_misskey(self, file_path, sensitive=False, media=None):
                 "i": self.pleroma_token,
                 "isSensitive": sensitive
             }
-            response = requests.post(update_url, data=json.dumps(data))
+            response = self.http.post(update_url, data=json.dumps(data))
             if not response.ok:
                 response.raise_for_status()
         if alt_text:  # pragma
@@ -239,7 +269,7 @@ def _upload_media_misskey(self, file_path, sensitive=False, media=None):
                 "i": self.pleroma_token,
                 "comment": alt_text
             }
-            response = requests.post(update_url, data=json.dumps(data))
+            response = self.http.post(update_url, data=json.dumps(data))
             if not response.ok:
                 response.raise_for_status()
     except requests.exceptions.HTTPError:
@@ -295,7 +325,7 @@ def update_misskey(self):
                 r"normal", "400x400",
                 self.profile_image_url[t_user]
             )
-            response = requests.get(profile_img_big, stream=True)
+            response = self.http.get(profile_img_big, stream=True)
             if not response.ok:
                 response.raise_for_status()
             response.raw.decode_content = True
@@ -303,7 +333,7 @@ def update_misskey(self):
                 shutil.copyfileobj(response.raw, outfile)
 
         if t_user in self.profile_banner_url:
-            response = requests.get(
+            response = self.http.get(
                 self.profile_banner_url[t_user], stream=True
             )
             if not response.ok:
@@ -349,7 +379,7 @@ def update_misskey(self):
         data.update({"avatarId": id_avatar})
     if id_banner:
         data.update({"bannerId": id_banner})
-    response = requests.post(
+    response = self.http.post(
         misskey_update_url, json.dumps(data)
     )
     try:
@@ -375,7 +405,7 @@ def update_misskey(self):
 def _misskey_update_bot_status(self, bot):
     i_update_url = f"{self.pleroma_base_url}/api/i/update"
     data = {"i": self.pleroma_token, "isBot": bot}
-    response = requests.post(
+    response = self.http.post(
         i_update_url, json.dumps(data), headers=self.header_pleroma
     )
     if not response.ok:  # pragma
@@ -385,7 +415,7 @@ def _misskey_update_bot_status(self, bot):
 def _get_misskey_profile_info(self):
     i_url = f"{self.pleroma_base_url}/api/i"
     data = {"i": self.pleroma_token}
-    response = requests.post(
+    response = self.http.post(
         i_url, json.dumps(data), headers=self.header_pleroma
     )
     i_json = response.json()
@@ -28,7 +28,7 @@ def pin_misskey(self, id_post):
         "i": self.pleroma_token,
         "noteId": id_post
     }
-    response = requests.post(
+    response = self.http.post(
         pin_url, json.dumps(data), headers=self.header_pleroma
     )
     logger.info(_("Pinning post:\t{}").format(response))
@@ -64,7 +64,7 @@ def unpin_misskey(self, pinned_file):
             "i": self.pleroma_token
         }
         headers = {"Content-Type": "text/plain;charset=UTF-8"}
-        response = requests.post(
+        response = self.http.post(
             unpin_url, json.dumps(data), headers=headers
         )
         if not response.ok:
@@ -110,7 +110,7 @@ def unpin_misskey(self, pinned_file):
 def _find_pinned_misskey(self, pinned_file):
     i_url = f"{self.pleroma_base_url}/api/i"
     data = {"i": self.pleroma_token}
-    response = requests.post(
+    response = self.http.post(
         i_url, json.dumps(data), headers=self.header_pleroma
     )
     i_id = response.json()["id"]
@@ -122,7 +122,7 @@ def _find_pinned_misskey(self, pinned_file):
         "includeMyRenotes": True,
     }
     users_url = f"{self.pleroma_base_url}/api/users/show"
-    response = requests.post(
+    response = self.http.post(
         users_url, json.dumps(data), headers=self.header_pleroma
     )
     users_show = response.json()
@@ -149,7 +149,7 @@ def pin_pleroma(self, id_post):
     self.unpin_pleroma(pinned_file)
 
     pin_url = f"{self.pleroma_base_url}/api/v1/statuses/{id_post}/pin"
-    response = requests.post(pin_url, headers=self.header_pleroma)
+    response = self.http.post(pin_url, headers=self.header_pleroma)
     logger.info(_("Pinning post:\t{}").format(response))
     try:
         pin_id = json.loads(response.text)["id"]
@@ -181,7 +181,7 @@ def unpin_pleroma(self, pinned_file):
             f"{self.pleroma_base_url}/api/v1/statuses/"
             f"{previous_pinned_post_id}/unpin"
         )
-        response = requests.post(unpin_url, headers=self.header_pleroma)
+        response = self.http.post(unpin_url, headers=self.header_pleroma)
         if not response.ok:
             if response.status_code == 404:  # pragma
                 logger.warning(
@@ -246,7 +246,7 @@ def _find_pinned(self, pinned_file):
                     statuses_url = headers_page_url
                 else:
                     statuses_url = pleroma_posts_url
-                response = requests.get(
+                response = self.http.get(
                     statuses_url, headers=self.header_pleroma
                 )
                 if not response.ok:
@@ -5,6 +5,7 @@ import re
 import json
 import time
 import shutil
+import hashlib
 import requests
 import mimetypes
 from datetime import datetime, timedelta, timezone
@@ -18,15 +19,64 @@ except ImportError:
 
 from . import logger
 from .i18n import _
-from ._utils import random_string, guess_type
+from ._utils import random_string, guess_type, file_digest
+from ._media import RelayFailed, multipart_stream
+from ._processing import _fetch_media
 
 
-def pleroma_api_request(method, url,
+def _media_id_key(self, digest, alt_text=None) -> str:
+    """Returns the key of a file in the cache of uploaded media IDs: the
+    account it was uploaded with, the hash of its content and its
+    description
+
+    :param digest: SHA-256 of the content of the file (hex)
+    :type digest: str
+    :param alt_text: description of the media
+    :type alt_text: str
+    :rtype: str
+    """
+    return " ".join(
+        (
+            self.pleroma_base_url,
+            str(self.pleroma_username),
+            digest,
+            alt_text or "",
+        )
+    )
+
+
+def _cached_media_id(self, media_key):
+    """Returns the ID of an earlier upload of the same file if the instance
+    still allows attaching it
+
+    Mastodon only lets media that isn't attached to a post yet be used, so
+    every cached ID is looked up before using it again.
+
+    :param media_key: key of the file (see _media_id_key)
+    :type media_key: str
+    :returns: ID of the uploaded media or None
+    :rtype: str
+    """
+    media_id = self.media_id_cache.get(media_key)
+    if media_id is None:
+        return None
+    media_url = f"{self.pleroma_base_url}/api/v1/media/{media_id}"
+    response = pleroma_api_request(
+        self, 'GET', media_url, headers=self.header_pleroma
+    )
+    if response.ok:
+        logger.debug(f"Reusing uploaded media: {media_id}")
+        return media_id
+    self.media_id_cache.delete(media_key)
+    return None
+
+
+def pleroma_api_request(self, method, url,
                         params=None, data=None, headers=None, cookies=None,
                         files=None, auth=None, timeout=None, proxies=None,
                         hooks=None, allow_redirects=True, stream=None,
                         verify=None, cert=None, json=None):
-    response = requests.request(
+    response = self.http.request(
         method=method.upper(),
         url=url,
         headers=headers,
@@ -37,6 +87,7 @@ def pleroma_api_request(method, url,
         auth=auth,
         cookies=cookies,
         hooks=hooks,
+        timeout=timeout,
     )
     if response.status_code == 429:  # pragma
         remaining_header = response.headers.get("X-RateLimit-Remaining")
@@ -60,7 +111,7 @@ def pleroma_api_request(method, url,
             logger.info(_("Sleeping for {}s...").format(round(delay)))
             time.sleep(delay)
 
-            response = pleroma_api_request(method, url,
+            response = pleroma_api_request(self, method, url,
                                            params=params, data=data,
                                            headers=headers, cookies=cookies,
                                            files=files, auth=auth, hooks=hooks,
@@ -82,6 +133,7 @@ def get_date_last_pleroma_post(self):
         f"{self.pleroma_username}/statuses"
     )
     response = pleroma_api_request(
+        self,
         'GET',
         pleroma_posts_url,
         headers=self.header_pleroma,
@@ -122,6 +174,144 @@ def get_date_last_pleroma_post(self):
     return date_pleroma
 
 
+def _upload_file_name(mime_type) -> str:
+    timestamp = int(float(datetime.now().timestamp()))
+    return (
+        f"pleromapyupload_"
+        f"{timestamp}"
+        f"_"
+        f"{random_string(10)}"
+        f"{mimetypes.guess_extension(mime_type)}"
+    )
+
+
+def _uploaded_media_id(self, response, file, size):
+    """Returns the ID of an uploaded media, logging why the upload failed
+    if it did
+
+    :param response: response of the upload
+    :type response: requests.Response
+    :param file: path (or URL) of the uploaded file
+    :type file: str
+    :param size: size of the file in bytes, None if unknown
+    :type size: int
+    :returns: ID of the uploaded media or None
+    :rtype: str
+    """
+    try:
+        if not response.ok:
+            response.raise_for_status()
+    except requests.exceptions.HTTPError:
+        if response.status_code == 413:
+            size_mb = "?" if size is None else round(size / 1048576, 2)
+            size_msg = _(
+                "Exception occurred"
+                "\nMedia size too large:"
+                "\nFilename: {file}"
+                "\nSize: {size}MB"
+                "\nConsider increasing the attachment"
+                "\n size limit of your instance"
+            ).format(file=file, size=size_mb)
+            logger.error(size_msg)
+            pass
+        elif response.status_code == 422:
+            error = ""
+            response_msg = json.loads(response.text)
+            if "error" in response_msg:
+                error = response_msg["error"]
+            validation_msg = _(
+                "Exception occurred"
+                "\nUnprocessable Entity"
+                "\n{error}"
+                "\nFile: {file}"
+            ).format(error=error, file=file)
+            logger.error(validation_msg)
+            pass
+        else:
+            response.raise_for_status()
+    try:
+        return json.loads(response.text)["id"]
+    except (KeyError, JSONDecodeError):
+        logger.warning(
+            _("Error uploading media:\t{}").format(
+                response.status_code
+            )
+        )
+        return None
+
+
+def _relay_media(self, tweet_id, media_url, alt_text, allowed):
+    """Uploads an attachment while it's downloaded, streaming the content
+    from its URL to the instance without writing it to disk
+
+    :param tweet_id: ID of the tweet the attachment belongs to
+    :type tweet_id: str
+    :param media_url: URL of the attachment
+    :type media_url: str
+    :param alt_text: description of the media
+    :type alt_text: str
+    :param allowed: callable that receives the MIME type of the attachment
+        and returns whether it can be attached to the post
+    :type allowed: callable
+    :returns: ID and MIME type of the uploaded media, None if it wasn't
+        uploaded
+    :rtype: tuple
+    :raises RelayFailed: if the upload should be tried again (after
+        downloading the attachment)
+    """
+    pleroma_media_url = f"{self.pleroma_base_url}/api/v1/media"
+    uploaded = {}
+
+    def hashed(chunks):
+        digest = hashlib.sha256()
+        for chunk in chunks:
+            digest.update(chunk)
+            yield chunk
+        uploaded["digest"] = digest.hexdigest()
+
+    def upload(content_type, chunks):
+        mime_type = (content_type or "").split(";")[0].strip()
+        mime_type = mime_type or "application/octet-stream"
+        if not allowed(mime_type):  # pragma: todo
+            return None
+        uploaded["mime_type"] = mime_type
+        boundary = random_string(32)
+        fields = {"description": alt_text} if alt_text else {}
+        headers = dict(self.header_pleroma)
+        headers["Content-Type"] = f"multipart/form-data; boundary={boundary}"
+        # Not through pleroma_api_request, the body can't be sent again
+        return self.http.post(
+            pleroma_media_url,
+            data=multipart_stream(
+                boundary,
+                fields,
+                _upload_file_name(mime_type),
+                mime_type,
+                hashed(chunks),
+            ),
+            headers=headers,
+        )
+
+    response = _fetch_media(
+        self,
+        tweet_id,
+        media_url,
+        lambda check: self.media_downloader.relay(
+            media_url, upload, check=check
+        ),
+    )
+    if response is None:
+        return None
+    media_id = _uploaded_media_id(self, response, media_url, None)
+    if media_id is None:
+        return None
+    if "digest" in uploaded:
+        self.media_id_cache.set(
+            _media_id_key(self, uploaded["digest"], alt_text), media_id
+        )
+    return media_id, uploaded["mime_type"]
+
+
 def post_pleroma(
         self,
         tweet: tuple,
@@ -153,6 +343,9 @@ def post_pleroma(
 
     tweet_id, tweet_text, tweet_date, tweet_reply_id, retweet_id = tweet
     tweet_folder = os.path.join(self.tweets_temp_path, tweet_id)
+    # Attachments streamed from their URL instead (see 'media_relay'), taken
+    # before any early return so they aren't kept for the rest of the run
+    relayed = self.relayed_media.pop(tweet_id, {})
 
     posts = self.posts_ids[self.pleroma_base_url]
     if (
@@ -165,6 +358,7 @@ def post_pleroma(
             f"{self.pleroma_base_url}/api/v1/statuses/{post_id}"
         )
         response = pleroma_api_request(
+            self,
             'GET',
             pleroma_posted_url,
             headers=self.header_pleroma,
@@ -188,6 +382,7 @@ def post_pleroma(
             f"{self.pleroma_base_url}/api/v1/statuses/{post_id}/reblog"
         )
         response = pleroma_api_request(
+            self,
             'POST',
             pleroma_reblog_url,
             headers=self.header_pleroma,
@@ -200,51 +395,90 @@ def post_pleroma(
     media_ids = []
     video_ids = []
     if self.media_upload:
-        tweet_video_count = 0
+        media_files = []
         if os.path.isdir(tweet_folder):
-            media_files = sorted(os.listdir(tweet_folder))
-            if len(media_files) > self.max_attachments:  # pragma: todo
-                logger.warning(_(
-                    "Attachments: {}. Media attachment limit for target "
-                    "instance is {}. Ignoring the rest..."
-                ).format(len(media_files), self.max_attachments))
-            media_files = media_files[:self.max_attachments]
-            for file in media_files:
-                # for file in media_files:
-                file_path = os.path.join(tweet_folder, file)
-                media_file = open(file_path, "rb")
-                file_size = os.stat(os.path.join(tweet_folder, file)).st_size
-                size_mb = round(file_size / 1048576, 2)
-                alt_text = None
-                if media:
-                    key = file.split("-")[1].split(".")[0]
-                    item = media[key][0]
-                    alt_text = item["alt_text"] if "alt_text" in item else None
-                mime_type = guess_type(os.path.join(tweet_folder, file))
-                if (
-                        mime_type.startswith("video")
-                        and self.max_video_attachments
-                ):  # pragma: todo
-                    tweet_video_count += 1
-                    if tweet_video_count > self.max_video_attachments:
-                        logger.warning(
-                            _(
-                                "Mastodon only supports {} video/s per post. "
-                                "Already reached max media,"
-                                " skipping the rest... "
-                            ).format(self.max_video_attachments)
-                        )
+            media_files = os.listdir(tweet_folder)
+        media_files = sorted(media_files + list(relayed))
+        if len(media_files) > self.max_attachments:  # pragma: todo
+            logger.warning(_(
+                "Attachments: {}. Media attachment limit for target "
+                "instance is {}. Ignoring the rest..."
+            ).format(len(media_files), self.max_attachments))
+        media_files = media_files[:self.max_attachments]
+        tweet_videos = set()
+
+        def video_allowed(file, mime_type):
+            if not (
+                    mime_type.startswith("video")
+                    and self.max_video_attachments
+            ):
+                return True
+            tweet_videos.add(file.split(".")[0])
+            if len(tweet_videos) <= self.max_video_attachments:
+                return True
+            logger.warning(
+                _(
+                    "Mastodon only supports {} video/s per post. "
+                    "Already reached max media,"
+                    " skipping the rest... "
+                ).format(self.max_video_attachments)
+            )
+            return False
+
+        for file in media_files:
+            alt_text = None
+            if media:
+                key = file.split("-")[1].split(".")[0]
+                item = media[key][0]
+                alt_text = item["alt_text"] if "alt_text" in item else None
+            if file in relayed:
+                media_url = relayed[file]
+                try:
+                    uploaded = _relay_media(
+                        self,
+                        tweet_id,
+                        media_url,
+                        alt_text,
+                        lambda mime_type: video_allowed(file, mime_type),
+                    )
+                except RelayFailed as e:
+                    logger.warning(
+                        _(
+                            "Relaying media failed ({}), downloading it to "
+                            "retry the upload: {}"
+                        ).format(e, media_url)
+                    )
+                    os.makedirs(tweet_folder, exist_ok=True)
+                    file_path = _fetch_media(
+                        self,
+                        tweet_id,
+                        media_url,
+                        lambda check: self.media_downloader.download(
+                            media_url, tweet_folder, file, check=check
+                        ),
+                    )
+                    if file_path is None:
                         continue
-                timestamp = int(float(datetime.now().timestamp()))
-                file_name = (
-                    f"pleromapyupload_"
-                    f"{timestamp}"
-                    f"_"
-                    f"{random_string(10)}"
-                    f"{mimetypes.guess_extension(mime_type)}"
-                )
-                file_description = (file_name, media_file, mime_type)
-                files = {"file": file_description}
+                    file = os.path.basename(file_path)
+                else:
+                    if uploaded is not None:
+                        media_id, mime_type = uploaded
+                        media_ids.append(media_id)
+                        if (
+                                self.instance == "mastodon"
+                                and mime_type.startswith("video")
+                        ):  # pragma: todo
+                            video_ids.append(media_id)
+                    continue
+            file_path = os.path.join(tweet_folder, file)
+            file_size = os.stat(file_path).st_size
+            mime_type = guess_type(file_path)
+            if not video_allowed(file, mime_type):  # pragma: todo
+                continue
+            # Same file (and description) uploaded before?
+            media_key = _media_id_key(self, file_digest(file_path), alt_text)
+            media_id = _cached_media_id(self, media_key)
+            if media_id is None:
                 data = {}
                 if alt_text:  # pragma
                     data.update(
@@ -252,58 +486,31 @@ def post_pleroma(
                             "description": alt_text
                         }
                     )
-                response = pleroma_api_request(
-                    'POST',
-                    pleroma_media_url,
-                    data=data,
-                    headers=self.header_pleroma,
-                    files=files
-                )
-                try:
-                    if not response.ok:
-                        response.raise_for_status()
-                except requests.exceptions.HTTPError:
-                    if response.status_code == 413:
-                        size_msg = _(
-                            "Exception occurred"
-                            "\nMedia size too large:"
-                            "\nFilename: {file}"
-                            "\nSize: {size}MB"
-                            "\nConsider increasing the attachment"
-                            "\n size limit of your instance"
-                        ).format(file=file_path, size=size_mb)
-                        logger.error(size_msg)
-                        pass
-                    elif response.status_code == 422:
-                        error = ""
-                        response_msg = json.loads(response.text)
-                        if "error" in response_msg:
-                            error = response_msg["error"]
-                        validation_msg = _(
-                            "Exception occurred"
-                            "\nUnprocessable Entity"
-                            "\n{error}"
-                            "\nFile: {file}"
-                        ).format(error=error, file=file_path)
-                        logger.error(validation_msg)
-                        pass
-                    else:
-                        response.raise_for_status()
-                try:
-                    media_id = json.loads(response.text)["id"]
-                    media_ids.append(media_id)
-                    if (
-                            self.instance == "mastodon"
-                            and mime_type.startswith("video")
-                    ):  # pragma: todo
-                        video_ids.append(media_id)
-                except (KeyError, JSONDecodeError):
-                    logger.warning(
-                        _("Error uploading media:\t{}").format(
-                            response.status_code
-                        )
+                with open(file_path, "rb") as media_file:
+                    file_description = (
+                        _upload_file_name(mime_type), media_file, mime_type
+                    )
+                    files = {"file": file_description}
+                    response = pleroma_api_request(
+                        self,
+                        'POST',
+                        pleroma_media_url,
+                        data=data,
+                        headers=self.header_pleroma,
+                        files=files
                     )
-                    pass
+                media_id = _uploaded_media_id(
+                    self, response, file_path, file_size
+                )
+                if media_id is None:
+                    continue
+                self.media_id_cache.set(media_key, media_id)
+            media_ids.append(media_id)
+            if (
+                    self.instance == "mastodon"
+                    and mime_type.startswith("video")
+            ):  # pragma: todo
+                video_ids.append(media_id)
     # remove video or rest of media if mixed with other media for mastodon
     if self.instance == "mastodon":  # pragma: todo
         for video_id in video_ids:
@@ -361,6 +568,7 @@ def post_pleroma(
     empty = (tweet_text == '' and len(media_ids) == 0 and poll is None)
     if not empty:
         response = pleroma_api_request(
+            self,
             'POST',
             pleroma_post_url,
             data=data,
@@ -397,7 +605,7 @@ def update_pleroma(self):
                 r"normal", "400x400",
                 self.profile_image_url[t_user]
             )
-            response = requests.get(profile_img_big, stream=True)
+            response = self.http.get(profile_img_big, stream=True)
             if not response.ok:
                 response.raise_for_status()
             response.raw.decode_content = True
@@ -405,7 +613,7 @@ def update_pleroma(self):
                 shutil.copyfileobj(response.raw, outfile)
 
         if t_user in self.profile_banner_url:
-            response = requests.get(
+            response = self.http.get(
                 self.profile_banner_url[t_user], stream=True
             )
             if not response.ok:
@@ -466,6 +674,7 @@ def update_pleroma(self):
         files.update({"header": (header_file_name, header, header_mime_type)})
 
     response = pleroma_api_request(
+        self,
         'PATCH',
         cred_url,
         data=data,
@@ -498,6 +707,7 @@ def _pleroma_update_bot_status(self, bot):
     )
     data = {"bot": str(bot).lower()}
     response = pleroma_api_request(
+        self,
         'PATCH',
         update_cred_url,
         data=data,
@@ -513,6 +723,7 @@ def _get_pleroma_profile_info(self):
         f"{self.pleroma_username}"
     )
     response = pleroma_api_request(
+        self,
         'GET',
         profile_url,
         headers=self.header_pleroma,
@@ -1,11 +1,9 @@
 import os
 import re
 import json
-import html
-import shutil
 import requests
-import mimetypes
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 
 from tqdm import tqdm
 
@@ -18,258 +16,396 @@ except ImportError:
 
 from . import logger
 from .i18n import _
+from ._rewrite import URL_PATTERN, TextRewriter
+from ._keywords import ContentWarnings
+from ._filters import TweetFilter
+from ._utils import index_media, ordered_map, guess_type
+from ._media import MediaRejected
 
+_NOT_CACHED = object()
 
-def process_tweets(self, tweets_to_post):
+
+def process_tweets(self, tweets_to_post, workers=1):
     """Transforms tweets for posting them to Pleroma
     Expands shortened URLs
     Downloads tweet related media and prepares them for upload
 
     :param tweets_to_post: Dict of tweet objects to be processed
     :type tweets_to_post: dict
+    :param workers: number of threads processing tweets at the same time
+    :type workers: int
     :returns: Tweets ready to be published
     :rtype: list
     """
-    # TODO: Break into smaller functions
+    processed = iter_processed_tweets(self, tweets_to_post, workers)
+    show_progress = workers > 1 or int(self.threads) == 1
+    desc = _("Processing tweets... ")
+    with tqdm(
+            total=len(tweets_to_post["data"]),
+            desc=desc,
+            disable=not show_progress
+    ) as pbar:
+        for tweet in processed:
+            pbar.update(1)
+    return tweets_to_post
 
-    # Remove RTs if include_rts is false
-    if not self.include_rts:
-        for tweet in tweets_to_post["data"][:]:
-            try:
-                for reference in tweet["referenced_tweets"]:
-                    if reference["type"] == "retweeted":
-                        tweets_to_post["data"].remove(tweet)
-                        break
-            except KeyError:
-                pass
-    # Remove quote tweets if include_quotes is false
-    if not self.include_quotes:  # pragma: todo
-        for tweet in tweets_to_post["data"][:]:
-            try:
-                for reference in tweet["referenced_tweets"]:
-                    if reference["type"] == "quoted":
-                        tweets_to_post["data"].remove(tweet)
-                        break
-            except KeyError:
-                pass
-    # Remove replies if include_replies is false
-    if not self.include_replies:
-        for tweet in tweets_to_post["data"][:]:
-            try:
-                for reference in tweet["referenced_tweets"]:
-                    if reference["type"] == "replied_to":
-                        tweets_to_post["data"].remove(tweet)
-                        break
-            except KeyError:
-                pass
-
-    if self.hashtags:
-        for tweet in tweets_to_post["data"][:]:
-            try:
-                tweet_hashtags = tweet["entities"]["hashtags"]
-                i = 0
-                while i < len(tweet_hashtags):
-                    if tweet_hashtags[i]["tag"] in self.hashtags:
-                        break
-                    i += 1
-                else:
-                    tweets_to_post["data"].remove(tweet)
-            except KeyError:
-                tweets_to_post["data"].remove(tweet)
-                pass
-    all_media = []
-    if int(self.threads) == 1:
-        desc = _("Processing tweets... ")
-        pbar = tqdm(total=len(tweets_to_post["data"]), desc=desc)
-
-    for idx, tweet in enumerate(tweets_to_post["data"]):
-        # logger.info(_("Processing: {}/{}").format(idx+1, total_tweets))
-        posts = self.posts_ids[self.pleroma_base_url]
-        if tweet["id"] not in posts:
-            self.posts_ids[self.pleroma_base_url].update({tweet["id"]: ''})
-        tweet["reply_id"] = None
-        tweet["retweet_id"] = None
-        # get reply ids
-        if "referenced_tweets" in tweet.keys():
-            for reference in tweet["referenced_tweets"]:
-                if reference["type"] == "replied_to":
-                    tweet["reply_id"] = reference["id"]
-                if reference["type"] == "retweeted":
-                    tweet["retweet_id"] = reference["id"]
-        media = []
-        logger.debug(tweet["id"])
-        # Get full text from RT or quoted tweet
-        if "referenced_tweets" in tweet.keys():  # pragma: no cover
-            tweet["text"] = _get_rt_text(self, tweet)
-        tweet["text"] = _expand_urls(self, tweet)
-        tweet["text"] = html.unescape(tweet["text"])
-
-        # Download media only if we plan to upload it later
-        if self.media_upload and not self.archive:
-            if self.guest:  # pragma: todo
-                if "extended_entities" in tweet:
-                    if "media" in tweet['extended_entities']:
-                        for item in tweet['extended_entities']['media']:
-                            media.append(item)
-            try:
-                media_keys = False
-                attachments = "attachments" in tweet.keys()
-                if attachments:
-                    tweet_attachments = tweet["attachments"]
-                    media_keys = "media_keys" in tweet_attachments.keys()
-                if media_keys and attachments:
-                    includes_media = tweets_to_post["includes"]["media"]
-                    for item in tweet["attachments"]["media_keys"]:
-                        for media_include in includes_media:
-                            media_url = _get_media_url(
-                                self, item, media_include, tweet
-                            )
-                            if media_url:
-                                media.extend(media_url)
-                # Get RT tweet media
-                if "referenced_tweets" in tweet.keys():  # pragma: no cover
-                    _get_rt_media_url(self, tweet, media)
-            except KeyError:
-                pass
-            if len(media) > 0:
-                # Create folder to store attachments related to the tweet ID
-                tweet_path = os.path.join(self.tweets_temp_path, tweet["id"])
-                os.makedirs(tweet_path, exist_ok=True)
-                _download_media(self, media, tweet)
-                all_media.extend(media)
-
-        if not self.keep_media_links:
-            tweet["text"] = _remove_media_links(self, tweet)
-            tweet["text"] = _remove_status_links(self, tweet)
-        if hasattr(self, "rich_text"):
-            if self.rich_text:
-                tweet["text"] = _replace_mentions(self, tweet)
-        if self.nitter:
-            tweet["text"] = _replace_url(
-                self,
-                tweet["text"],
-                "https://twitter.com",
-                self.nitter_base_url
-            )
-        if self.invidious:
-            tweet["text"] = _replace_url(
-                self,
-                tweet["text"],
-                "https://youtube.com",
-                self.invidious_base_url
-            )
-        if hasattr(self, "custom_replacements"):
-            if self.custom_replacements:
-                tweet["text"] = _custom_replacements(
-                    self,
-                    tweet["text"],
-                    self.custom_replacements
-                )
-        signature = ''
-        if self.signature:
-            if self.archive:  # pragma: todo
-                t_user = self.twitter_ids[list(self.twitter_ids.keys())[0]]
-            else:
-                t_user = "i/web"
-                if tweet["author_id"] in self.twitter_ids:
-                    t_user = self.twitter_ids[tweet["author_id"]]
-            twitter_url_user = f"{self.twitter_url_home}/{t_user}"
-            signature = f"\n\n 🐦🔗: {twitter_url_user}/status/{tweet['id']}"
-            if self.instance == "mastodon":
-                len_text = self._mastodon_len(tweet["text"])
-                len_signature = self._mastodon_len(signature)
-            else:
-                len_text = len(tweet["text"])
-                len_signature = len(signature)
-            total_length = len_text + len_signature
-            if total_length > self.max_post_length:  # pragma
-                body_max_length = self.max_post_length - len_signature - 1
-                tweet["text"] = f"{tweet['text'][:body_max_length]}…"
-            tweet["text"] = f"{tweet['text']}{signature}"
-        if self.original_date:
-            tweet_date = tweet["created_at"]
-            date = datetime.strftime(
-                datetime.strptime(tweet_date, "%Y-%m-%dT%H:%M:%S.000Z"),
-                self.original_date_format,
-            )
-            orig_date = f"\n\n[{date}]"
+
+def iter_processed_tweets(self, tweets_to_post, workers=1, window=None):
+    """Prepares a batch of tweets for processing and returns an iterator
+    over them that yields every tweet, in order, once it is processed (see
+    process_tweets)
+
+    The unwanted tweets are removed from tweets_to_post["data"] right away.
+    The media of every tweet is added to tweets_to_post["media_processed"]
+    before the tweet is yielded.
+
+    :param tweets_to_post: Dict of tweet objects to be processed
+    :type tweets_to_post: dict
+    :param workers: number of threads processing tweets at the same time
+    :type workers: int
+    :param window: max number of tweets processed ahead of the one being
+        consumed (see ordered_map)
+    :type window: int
+    :returns: processed tweets
+    :rtype: iterator
+    """
+    # Remove RTs, quotes, replies and tweets without the wanted hashtags
+    if getattr(self, "tweet_filter", None) is None:
+        self.tweet_filter = TweetFilter.from_user(self)
+    tweets_to_post["data"] = self.tweet_filter.apply(tweets_to_post["data"])
+    # Media of the batch by media key
+    media_index = _media_by_key(tweets_to_post.get("includes", {}))
+    tweet_index = _prefetch_referenced_tweets(self, tweets_to_post)
+    _prefetch_extended_media(self, tweets_to_post, tweet_index)
+    poll_index = _prefetch_polls(self, tweets_to_post)
+    _prefetch_urls(self, tweets_to_post, tweet_index)
+    if self.content_warnings:
+        if getattr(self, "cw_checker", None) is None:
+            self.cw_checker = ContentWarnings(self.content_warnings)
+    if getattr(self, "text_rewriter", None) is None:
+        self.text_rewriter = TextRewriter(self)
+
+    def process(tweet):
+        media = _process_tweet(
+            self, tweet, media_index, tweet_index, poll_index
+        )
+        return tweet, media
+
+    tweets = tweets_to_post["data"]
+    if workers > 1:
+        # Every tweet is a task of its own, idle threads pick up the next one
+        results = ordered_map(process, tweets, workers, window)
+    else:
+        results = map(process, tweets)
+    tweets_to_post["media_processed"] = {}
+    return _index_processed(results, tweets_to_post["media_processed"])
+
+
+def _index_processed(results, all_media):
+    for tweet, media in results:
+        index_media(media, index=all_media)
+        yield tweet
+
+
+def _process_tweet(self, tweet, media_index, tweet_index, poll_index):
+    """Transforms a single tweet for posting it, see process_tweets
+
+    :param tweet: tweet object, updated in place
+    :type tweet: dict
+    :param media_index: media of the batch by media key
+    :type media_index: dict
+    :param tweet_index: referenced tweets of the batch by ID
+    :type tweet_index: dict
+    :param poll_index: polls of the batch by ID
+    :type poll_index: dict
+    :returns: media downloaded for the tweet
+    :rtype: list
+    """
+    posts = self.posts_ids[self.pleroma_base_url]
+    if tweet["id"] not in posts:
+        self.posts_ids[self.pleroma_base_url].update({tweet["id"]: ''})
+    tweet["reply_id"] = None
+    tweet["retweet_id"] = None
+    # get reply ids
+    if "referenced_tweets" in tweet.keys():
+        for reference in tweet["referenced_tweets"]:
+            if reference["type"] == "replied_to":
+                tweet["reply_id"] = reference["id"]
+            if reference["type"] == "retweeted":
+                tweet["retweet_id"] = reference["id"]
+    media = []
+    logger.debug(tweet["id"])
+    # Get full text from RT or quoted tweet
+    if "referenced_tweets" in tweet.keys():  # pragma: no cover
+        tweet["text"] = _get_rt_text(self, tweet, tweet_index)
+    tweet["text"] = _rewrite_text(self, tweet)
+
+    # Download media only if we plan to upload it later
+    if self.media_upload and not self.archive:
+        if self.guest:  # pragma: todo
+            if "extended_entities" in tweet:
+                if "media" in tweet['extended_entities']:
+                    for item in tweet['extended_entities']['media']:
+                        media.append(item)
+        try:
+            media_keys = False
+            attachments = "attachments" in tweet.keys()
+            if attachments:
+                tweet_attachments = tweet["attachments"]
+                media_keys = "media_keys" in tweet_attachments.keys()
+            if media_keys and attachments:
+                for item in tweet["attachments"]["media_keys"]:
+                    if item not in media_index:
+                        continue
+                    media_url = _get_media_url(
+                        self, item, media_index[item], tweet
+                    )
+                    if media_url:
+                        media.extend(media_url)
+            # Get RT tweet media
+            if "referenced_tweets" in tweet.keys():  # pragma: no cover
+                _get_rt_media_url(self, tweet, media, tweet_index)
+        except KeyError:
+            pass
+        if len(media) > 0:
+            # Create folder to store attachments related to the tweet ID
+            tweet_path = os.path.join(self.tweets_temp_path, tweet["id"])
+            os.makedirs(tweet_path, exist_ok=True)
+            _download_media(self, media, tweet)
+
+    signature = ''
+    if self.signature:
+        if self.archive:  # pragma: todo
+            t_user = self.twitter_ids[list(self.twitter_ids.keys())[0]]
+        else:
+            t_user = "i/web"
+            if tweet["author_id"] in self.twitter_ids:
+                t_user = self.twitter_ids[tweet["author_id"]]
+        twitter_url_user = f"{self.twitter_url_home}/{t_user}"
+        signature = f"\n\n 🐦🔗: {twitter_url_user}/status/{tweet['id']}"
+        if self.instance == "mastodon":
+            len_text = self._mastodon_len(tweet["text"])
+            len_signature = self._mastodon_len(signature)
+        else:
+            len_text = len(tweet["text"])
+            len_signature = len(signature)
+        total_length = len_text + len_signature
+        if total_length > self.max_post_length:  # pragma
+            body_max_length = self.max_post_length - len_signature - 1
+            tweet["text"] = f"{tweet['text'][:body_max_length]}…"
+        tweet["text"] = f"{tweet['text']}{signature}"
+    if self.original_date:
+        tweet_date = tweet["created_at"]
+        date = datetime.strftime(
+            datetime.strptime(tweet_date, "%Y-%m-%dT%H:%M:%S.000Z"),
+            self.original_date_format,
+        )
+        orig_date = f"\n\n[{date}]"
+        if self.instance == "mastodon":
+            len_text = self._mastodon_len(tweet["text"])
+        else:
+            len_text = len(tweet["text"])
+        total_length = len_text + len(orig_date)
+        if total_length > self.max_post_length:  # pragma
+            if self.signature:
+                tweet["text"] = tweet["text"].replace(signature, '')
+            l_date = len(orig_date)
             if self.instance == "mastodon":
-                len_text = self._mastodon_len(tweet["text"])
+                l_sig = self._mastodon_len(signature)
             else:
-                len_text = len(tweet["text"])
-            total_length = len_text + len(orig_date)
-            if total_length > self.max_post_length:  # pragma
-                if self.signature:
-                    tweet["text"] = tweet["text"].replace(signature, '')
-                l_date = len(orig_date)
-                if self.instance == "mastodon":
-                    l_sig = self._mastodon_len(signature)
+                l_sig = len(signature)
+            body_max_length = self.max_post_length - l_date - l_sig - 1
+            tweet["text"] = f"{tweet['text'][:body_max_length]}…"
+        else:
+            signature = ''
+        tweet["text"] = f"{tweet['text']}{signature}{orig_date}"
+    # Process poll if exists and no media is used
+    tweet["polls"] = None
+    if not self.guest:
+        tweet["polls"] = _process_polls(self, tweet, media, poll_index)
+
+    # Truncate text if needed
+    if self.instance == "mastodon":
+        total_tweet_length = self._mastodon_len(tweet["text"])
+    else:
+        total_tweet_length = len(tweet["text"])
+    if total_tweet_length > self.max_post_length:  # pragma
+        logger.info(
+            _(
+                "Post text longer than allowed ({}), truncating..."
+            ).format(self.max_post_length)
+        )
+        tweet["text"] = f"{tweet['text'][:self.max_post_length]}"
+    tweet["cw"] = None
+    if self.content_warnings:
+        tweet["cw"] = self.cw_checker.check(tweet["text"])
+    return media
+
+
+def _prefetch_referenced_tweets(self, tweets_to_post) -> dict:
+    """Builds an index with the retweeted and quoted tweets of the batch (and
+    the ones they reference, up to the same depth _get_rt_media_url follows)
+
+    Tweets already present in the includes of the timeline are taken from
+    there, the rest are requested in batches.
+
+    :param tweets_to_post: Dict of tweet objects to be processed
+    :type tweets_to_post: dict
+    :returns: tweet ID -> tweet, as returned by _get_tweets
+    :rtype: dict
+    """
+    tweet_index = {}
+    if self.guest or self.archive or self.rss:
+        return tweet_index
+    includes = dict(tweets_to_post.get("includes", {}))
+    for include in ("users", "tweets", "media", "polls"):
+        includes.setdefault(include, [])
+    users = set(user["id"] for user in includes["users"])
+    media_keys = set(
+        media["media_key"] for media in includes["media"]
+        if "media_key" in media
+    )
+    included = {}
+    for tweet in includes["tweets"]:
+        if "id" not in tweet or tweet.get("author_id") not in users:
+            continue
+        attachments = tweet.get("attachments", {})
+        # Media of referenced tweets is only included with some expansions
+        if not set(attachments.get("media_keys", [])) <= media_keys:
+            continue
+        included[tweet["id"]] = {"data": tweet, "includes": includes}
+
+    tweets = tweets_to_post["data"]
+    for _depth in range(4):
+        wanted = []
+        found = []
+        for tweet in tweets:
+            for reference in tweet.get("referenced_tweets", []):
+                if reference["type"] not in ("retweeted", "quoted"):
+                    continue
+                ref_id = reference["id"]
+                if ref_id in tweet_index or ref_id in wanted:
+                    continue
+                if ref_id in included:
+                    tweet_index[ref_id] = included[ref_id]
+                    found.append(ref_id)
                 else:
-                    l_sig = len(signature)
-                body_max_length = self.max_post_length - l_date - l_sig - 1
-                tweet["text"] = f"{tweet['text'][:body_max_length]}…"
-            else:
-                signature = ''
-            tweet["text"] = f"{tweet['text']}{signature}{orig_date}"
-        # Process poll if exists and no media is used
-        tweet["polls"] = None
-        if not self.guest:
-            tweet["polls"] = _process_polls(self, tweet, media)
+                    wanted.append(ref_id)
+        if wanted:
+            try:
+                tweet_index.update(self._get_tweets_by_ids(wanted))
+            except requests.exceptions.RequestException as e:
+                # Leave them out, they'll be requested one by one if needed
+                logger.debug(
+                    _("Unable to prefetch referenced tweets: {}").format(e)
+                )
+                break
+        # The references of included tweets are followed too
+        tweets = [
+            tweet_index[ref_id]["data"]
+            for ref_id in found + wanted if tweet_index.get(ref_id)
+        ]
+        if not tweets:
+            break
+    # The includes of a lookup are shared by every tweet of its batch, index
+    # their media once for _get_rt_media_url
+    media_indexes = {}
+    for tweet_rt in tweet_index.values():
+        if not tweet_rt:
+            continue
+        rt_includes = tweet_rt["includes"]
+        if id(rt_includes) not in media_indexes:
+            media_indexes[id(rt_includes)] = _media_by_key(rt_includes)
+        tweet_rt["media_index"] = media_indexes[id(rt_includes)]
+    return tweet_index
+
+
+def _media_by_key(includes) -> dict:
+    """Returns the media of the includes of a response by media key
+
+    :param includes: includes of a v2 API response
+    :type includes: dict
+    :rtype: dict
+    """
+    return {
+        media_include["media_key"]: media_include
+        for media_include in includes.get("media", [])
+        if "media_key" in media_include
+    }
 
-        # Truncate text if needed
-        if self.instance == "mastodon":
-            total_tweet_length = self._mastodon_len(tweet["text"])
-        else:
-            total_tweet_length = len(tweet["text"])
-        if total_tweet_length > self.max_post_length:  # pragma
-            logger.info(
-                _(
-                    "Post text longer than allowed ({}), truncating..."
-                ).format(self.max_post_length)
-            )
-            tweet["text"] = f"{tweet['text'][:self.max_post_length]}"
-        tweet["cw"] = None
-        if self.content_warnings:
-            tweet["cw"] = _check_cw(tweet["text"], self.content_warnings)
-        if int(self.threads) == 1:
-            pbar.update(1)
-    tweets_to_post["media_processed"] = all_media
-    return tweets_to_post
 
+def _get_referenced_tweet(self, tweet_id, tweet_index=None):
+    """Returns a referenced tweet from the index, requesting it if it's not
+    there"""
+    if tweet_index is not None and tweet_id in tweet_index:
+        return tweet_index[tweet_id]
+    tweet = self._get_tweets("v2", tweet_id)
+    if tweet_index is not None:
+        tweet_index[tweet_id] = tweet
+    return tweet
 
-def _check_cw(data, cw_list):
-    cw_found = []
-    for cw_topic in cw_list:
-        alnum = [k for k in cw_list[cw_topic] if k.isalnum()]
-        not_alnum = [k for k in cw_list[cw_topic] if not k.isalnum()]
-        topic_found = False
-        if not_alnum:
-            matches = re.findall("|".join(not_alnum), data, re.IGNORECASE)
-            if matches:
-                topic_found = True
-        if any(k.lower() in data.lower().split() for k in alnum):
-            topic_found = True
-        if topic_found:
-            cw_found.append(cw_topic.lower())
-    cw_text = ", ".join(cw_found).capitalize()
-    return cw_text
-
-
-def _custom_replacements(self, data, custom_replacements):
-    pairs = custom_replacements.items()
-    # normalize dict keys to lower-case for case-insensitive matching
-    custom_replacements = {k.lower(): v for k, v in pairs}
-    # alternation regex on all keys in custom_replacements
-    keys_regex = "|".join(custom_replacements.keys())
-    matches = re.findall(keys_regex, data, re.IGNORECASE)
-    for match in matches:
-        data = re.sub(
-            match, lambda m: custom_replacements[m.group().lower()], data
-        )
-    return data
 
+def _prefetch_extended_media(self, tweets_to_post, tweet_index):
+    """Requests in batches the v1.1 media (with the video variants) of every
+    tweet of the batch, or referenced by it, that has videos or GIFs
 
-def _get_rt_text(self, tweet):  # pragma: no cover
+    The media is cached per tweet ID in 'extended_media' for the rest of the
+    run.
+
+    :param tweets_to_post: Dict of tweet objects to be processed
+    :type tweets_to_post: dict
+    :param tweet_index: referenced tweets, as returned by
+        _prefetch_referenced_tweets
+    :type tweet_index: dict
+    """
+    if self.guest or self.archive or self.rss or not self.media_upload:
+        return
+    includes_media = tweets_to_post.get("includes", {}).get("media", [])
+    candidates = [(tweet, includes_media) for tweet in tweets_to_post["data"]]
+    for tweet_ref in tweet_index.values():
+        if tweet_ref:
+            ref_media = tweet_ref.get("includes", {}).get("media", [])
+            candidates.append((tweet_ref["data"], ref_media))
+    wanted = set()
+    for tweet, media in candidates:
+        if tweet["id"] in self.extended_media:
+            continue
+        media_keys = set(
+            tweet.get("attachments", {}).get("media_keys", [])
+        )
+        for media_include in media:
+            if (
+                    media_include.get("media_key") in media_keys
+                    and media_include["type"] in ("video", "animated_gif")
+            ):
+                wanted.add(tweet["id"])
+                break
+    if not wanted:
+        return
+    try:
+        tweets = self._get_tweets_v1_by_ids(sorted(wanted))
+    except requests.exceptions.RequestException as e:
+        # They'll be requested one by one when processing
+        logger.debug(_("Unable to prefetch tweets media: {}").format(e))
+        return
+    for tweet_id, tweet in tweets.items():
+        if "extended_entities" in tweet:
+            self.extended_media[tweet_id] = tweet["extended_entities"]["media"]
+
+
+def _get_extended_media(self, tweet_id) -> list:
+    """Returns the v1.1 media of a tweet, requesting it if it wasn't
+    prefetched"""
+    if tweet_id not in self.extended_media:
+        tweet_video = self._get_tweets("v1.1", tweet_id)
+        if not tweet_video:  # pragma: todo
+            return []
+        xmd = tweet_video["extended_entities"]["media"]
+        self.extended_media[tweet_id] = xmd
+    return self.extended_media[tweet_id]
+
+
+def _get_rt_text(self, tweet, tweet_index=None):  # pragma: no cover
     text = tweet["text"]
 
     for reference in tweet["referenced_tweets"]:
@@ -277,7 +413,7 @@ def _get_rt_text(self, tweet):  # pragma: no cover
         quoted = reference["type"] == "quoted"
         if retweeted or quoted:
             tweet_ref_id = reference["id"]
-            tweet_ref = self._get_tweets("v2", tweet_ref_id)
+            tweet_ref = _get_referenced_tweet(self, tweet_ref_id, tweet_index)
             if not tweet_ref:  # pragma: todo
                 continue
             match = re.search(r"RT.*?\:", tweet["text"])
@@ -295,41 +431,46 @@ def _get_rt_text(self, tweet):  # pragma: no cover
     return text
 
 
-def _get_rt_media_url(self, tweet, media):  # pragma: no cover
+def _get_rt_media_url(
+        self, tweet, media, tweet_index=None
+):  # pragma: no cover
     tweet_rt = {"data": tweet}
     tw_data = tweet_rt["data"]
     i = 0
     max_at = self.max_attachments
+    seen_urls = {item.get("url") for item in media}
     while "referenced_tweets" in tw_data.keys() and len(media) < max_at:
         for reference in tw_data["referenced_tweets"]:
             retweeted = reference["type"] == "retweeted"
             quoted = reference["type"] == "quoted"
             if retweeted or quoted:
                 tweet_id = reference["id"]
-                tweet_rt = self._get_tweets("v2", tweet_id)
+                tweet_rt = _get_referenced_tweet(self, tweet_id, tweet_index)
                 if not tweet_rt:
                     continue
                 tw_data = tweet_rt["data"]
                 att = "attachments" in tw_data.keys()
                 if att:
                     attachments = tw_data["attachments"]
-                    in_md = tweet_rt["includes"]["media"]
+                    in_md = tweet_rt.get("media_index")
+                    if in_md is None:
+                        # Requested on its own, not prefetched
+                        in_md = _media_by_key(tweet_rt["includes"])
+                        tweet_rt["media_index"] = in_md
                     md_keys = attachments["media_keys"]
                     for item in md_keys:
-                        for media_include in in_md:
-                            media_url = _get_media_url(
-                                self,
-                                item,
-                                media_include,
-                                tw_data
-                            )
-                            if media_url:
-                                new = [
-                                    i for i in media_url if i["url"] not in [
-                                        j["url"] for j in media
-                                    ]
-                                ]
-                                media.extend(new)
+                        if item not in in_md:
+                            continue
+                        media_url = _get_media_url(
+                            self,
+                            item,
+                            in_md[item],
+                            tw_data
+                        )
+                        for new in media_url or []:
+                            if new["url"] not in seen_urls:
+                                seen_urls.add(new["url"])
+                                media.append(new)
                 if self.guest:  # pragma: todo
                     if "extended_entities" in tw_data:
                         if "media" in tw_data['extended_entities']:
@@ -346,31 +487,73 @@ def _get_rt_media_url(self, tweet, media):  # pragma: no cover
             break
 
 
-def _process_polls(self, tweet, media):
+def _prefetch_polls(self, tweets_to_post) -> dict:
+    """Builds a poll ID -> poll index from the includes of the batch. Only
+    the polls missing from them are requested, in batches.
+
+    :param tweets_to_post: Dict of tweet objects to be processed
+    :type tweets_to_post: dict
+    :returns: poll ID -> poll
+    :rtype: dict
+    """
+    if self.guest or self.archive or self.rss:
+        return {}
+    polls = tweets_to_post.get("includes", {}).get("polls", [])
+    poll_index = {poll["id"]: poll for poll in polls if "id" in poll}
+    missing = []
+    for tweet in tweets_to_post["data"]:
+        poll_ids = tweet.get("attachments", {}).get("poll_ids", [])
+        if any(poll_id not in poll_index for poll_id in poll_ids):
+            missing.append(tweet["id"])
+    poll_url = f"{self.twitter_base_url_v2}/tweets"
+    for idx in range(0, len(missing), 100):
+        params = {
+            "ids": ",".join(missing[idx:idx + 100]),
+            "expansions": "attachments.poll_ids",
+            "poll.fields": "duration_minutes," "options",
+        }
+        response = self.twitter_api_request(
+            'GET',
+            poll_url,
+            headers=self.header_twitter,
+            params=params,
+            auth=self.auth
+        )
+        if not response.ok:
+            response.raise_for_status()
+        response_content = json.loads(response.content)
+        for poll in response_content.get("includes", {}).get("polls", []):
+            poll_index[poll["id"]] = poll
+    return poll_index
+
+
+def _process_polls(self, tweet, media, poll_index=None):
     tweet["polls"] = None
     try:
         if tweet["attachments"]["poll_ids"] and not media:
+            poll_id = tweet["attachments"]["poll_ids"][0]
+            if poll_index is not None and poll_id in poll_index:
+                tweet_poll = poll_index[poll_id]
+            else:
+                poll_url = f"{self.twitter_base_url_v2}/tweets"
 
-            # tweet_poll = tweet['includes']['polls']
-            poll_url = f"{self.twitter_base_url_v2}/tweets"
-
-            params = {
-                "ids": tweet["id"],
-                "expansions": "attachments.poll_ids",
-                "poll.fields": "duration_minutes," "options",
-            }
+                params = {
+                    "ids": tweet["id"],
+                    "expansions": "attachments.poll_ids",
+                    "poll.fields": "duration_minutes," "options",
+                }
 
-            response = self.twitter_api_request(
-                'GET',
-                poll_url,
-                headers=self.header_twitter,
-                params=params,
-                auth=self.auth
-            )
-            if not response.ok:
-                response.raise_for_status()
-            response_content = json.loads(response.content)
-            tweet_poll = response_content["includes"]["polls"][0]
+                response = self.twitter_api_request(
+                    'GET',
+                    poll_url,
+                    headers=self.header_twitter,
+                    params=params,
+                    auth=self.auth
+                )
+                if not response.ok:
+                    response.raise_for_status()
+                response_content = json.loads(response.content)
+                tweet_poll = response_content["includes"]["polls"][0]
 
             pleroma_poll = {
                 "options": [
@@ -392,6 +575,16 @@ def _process_polls(self, tweet, media):
 
 
 def _download_media(self, media, tweet):
+    """Downloads the media of a tweet to its folder in the temp path, all
+    the attachments at the same time (see MediaDownloader)
+
+    :param media: media items of the tweet
+    :type media: list
+    :param tweet: tweet object
+    :type tweet: dict
+    """
+    tweet_path = os.path.join(self.tweets_temp_path, tweet["id"])
+    jobs = []
     for idx, item in enumerate(media):
         if item["type"] != "video" and item["type"] != "animated_gif":
             if "media_url" in item:  # pragma: todo
@@ -406,56 +599,139 @@ def _download_media(self, media, tweet):
         if media_url:
             if "media_key" not in item:  # pragma: todo
                 item["media_key"] = str(item["id"])
-            key = item["media_key"]
-            response = requests.get(media_url, stream=True)
-            try:
-                if not response.ok:
-                    response.raise_for_status()
-            except requests.exceptions.HTTPError:
-                if response.status_code == 404:
-                    att_not_found = _(
-                        "Exception occurred"
-                        "\nMedia not found (404)"
-                        "\n{tweet} - {media_url}"
-                        "\nIgnoring attachment and continuing..."
-                    ).format(tweet=tweet["id"], media_url=media_url)
-                    logger.warning(att_not_found)
-                    continue
-                elif response.status_code == 403:
-                    geoblocked = _(
-                        "Media possibly geoblocked? (403) Skipping... "
-                        "{tweet} - {media_url} "
-                    ).format(tweet=tweet["id"], media_url=media_url)
-                    logger.warning(geoblocked)
-                    continue
-                else:
-                    response.raise_for_status()
-            response.raw.decode_content = True
-            filename = str(idx) + "-" + str(key) + mimetypes.guess_extension(
-                response.headers["Content-Type"]
-            )
-            file_path = os.path.join(
-                self.tweets_temp_path, tweet["id"], filename
-            )
-            with open(file_path, "wb") as outfile:
-                shutil.copyfileobj(response.raw, outfile)
-            # Remove attachment if exceeds the limit
-            if hasattr(self, "file_max_size"):
-                file_size_bytes = os.stat(file_path).st_size
-                max_file_size_bytes = parse_size(self.file_max_size)
-                if file_size_bytes > max_file_size_bytes:
-                    logger.error(
-                        _(
-                            "Attachment exceeded config file size limit ({})"
-                        ).format(self.file_max_size)
-                    )
-                    logger.error(
-                        _("File size: {}MB").format(
-                            round(file_size_bytes / 2 ** 20, 2)
-                        )
-                    )
-                    logger.error(_("Ignoring attachment and continuing..."))
-                    os.remove(file_path)
+            jobs.append((f"{idx}-{item['media_key']}", media_url))
+
+    relay = _relays_media(self)
+    cache = self.media_downloader.cache
+
+    def download(job):
+        name, media_url = job
+        if relay and (cache is None or media_url not in cache):
+            # Streamed to the instance when posting the tweet
+            self.relayed_media.setdefault(tweet["id"], {})[name] = media_url
+            return
+        file_path = _fetch_media(
+            self,
+            tweet["id"],
+            media_url,
+            lambda check: self.media_downloader.download(
+                media_url, tweet_path, name, check=check
+            ),
+        )
+        if file_path is None:
+            return
+        # The size wasn't known in advance (or the file was cached)
+        issue = _attachment_issue(
+            self, guess_type(file_path), os.stat(file_path).st_size
+        )
+        if issue:
+            logger.error(issue)
+            os.remove(file_path)
+
+    self.media_downloader.map(download, jobs)
+
+
+def _relays_media(self) -> bool:
+    # Relayed media is kept in memory until the tweet is posted, so it has
+    # to be processed in this process and posted through post_pleroma
+    return bool(self.media_relay) and not (
+        self.archive
+        or self.instance == "misskey"
+        or (self.process_mode == "process" and self.threads > 1)
+    )
+
+
+def _fetch_media(self, tweet_id, media_url, fetch):
+    """Calls 'fetch' to download (or relay) an attachment, logging why it
+    was skipped if it was
+
+    :param tweet_id: ID of the tweet the attachment belongs to
+    :type tweet_id: str
+    :param media_url: URL of the attachment
+    :type media_url: str
+    :param fetch: callable that receives the check for the attachment
+        (see MediaDownloader.download) and fetches it
+    :type fetch: callable
+    :returns: what 'fetch' returned, None if the attachment was skipped
+    """
+    def check(mime_type, size):
+        return _attachment_issue(self, mime_type, size)
+
+    try:
+        return fetch(check)
+    except MediaRejected as e:
+        # Skipped before downloading it
+        logger.error(str(e))
+        return None
+    except requests.exceptions.HTTPError as e:
+        if e.response is None:  # pragma: todo
+            raise
+        if e.response.status_code == 404:
+            att_not_found = _(
+                "Exception occurred"
+                "\nMedia not found (404)"
+                "\n{tweet} - {media_url}"
+                "\nIgnoring attachment and continuing..."
+            ).format(tweet=tweet_id, media_url=media_url)
+            logger.warning(att_not_found)
+            return None
+        elif e.response.status_code == 403:
+            geoblocked = _(
+                "Media possibly geoblocked? (403) Skipping... "
+                "{tweet} - {media_url} "
+            ).format(tweet=tweet_id, media_url=media_url)
+            logger.warning(geoblocked)
+            return None
+        raise
+
+
+def _attachment_issue(self, mime_type, size):
+    """Returns why an attachment can't be posted, if it can't
+
+    Attachments are checked against 'file_max_size' and the size limits and
+    MIME types published by the instance.
+
+    :param mime_type: MIME type of the attachment
+    :type mime_type: str
+    :param size: size of the attachment in bytes, None if unknown
+    :type size: int
+    :returns: message explaining the issue or None
+    :rtype: str
+    """
+    ignoring = _("Ignoring attachment and continuing...")
+    mime_type = (mime_type or "").split(";")[0].strip().lower()
+    supported = self.supported_mime_types
+    if supported and mime_type and mime_type not in supported:
+        return "\n".join((
+            _("Attachment type not supported by the instance ({})").format(
+                mime_type
+            ),
+            ignoring,
+        ))
+    if size is None:
+        return None
+    size_msg = _("File size: {}MB").format(round(size / 2 ** 20, 2))
+    file_max_size = getattr(self, "file_max_size", None)
+    if file_max_size and size > parse_size(file_max_size):
+        return "\n".join((
+            _(
+                "Attachment exceeded config file size limit ({})"
+            ).format(file_max_size),
+            size_msg,
+            ignoring,
+        ))
+    media_type = mime_type.split("/")[0]
+    instance_limit = self.upload_limits.get(
+        media_type, self.upload_limits.get("default")
+    )
+    if instance_limit and size > instance_limit:
+        return "\n".join((
+            _("Attachment exceeded the size limit of the instance ({}MB)")
+            .format(round(instance_limit / 2 ** 20, 2)),
+            size_msg,
+            ignoring,
+        ))
+    return None
 
 
 def parse_size(size):
@@ -504,18 +780,8 @@ def _replace_mentions(self, tweet):
 def _expand_urls(self, tweet):
     # TODO: transform twitter links to nitter links, if self.nitter
     #  'true' in resolved shortened urls
-
-    # URI regex
-    matching_pattern = (
-        r"(?i)\b((?:https?://|www\d{0,3}[.]|[a-z0-9.\-]+[.][a-z]"
-        r"{2,4}/)(?:[^\s()<>]+|\(([^\s()<>]+|(\([^\s()<>]+\)))*"
-        r"\))+(?:\(([^\s()<>]+|(\([^\s()<>]+\)))*\)|[^\s`!()\[\]{}"
-        r';:\'".,<>?«»“”‘’]))'
-    )
-    matches = re.finditer(matching_pattern, tweet["text"])
+    matches = re.finditer(URL_PATTERN, tweet["text"])
     urls = {}
-    # Prepare a session to recycle connections across requests
-    session = requests.Session()
     # Replace shortened links
     for matchNum, match in enumerate(matches, start=1):
         group = match.group()
@@ -530,51 +796,141 @@ def _expand_urls(self, tweet):
             else:
                 raise KeyError
         except (KeyError, TypeError):
-            # don't be brave trying to unwound an URL when it gets cut off
-            if (
-                    not group.__contains__("…") and not
-                    group.startswith(self.nitter_base_url)
-            ):
-                if not group.startswith(("http://", "https://")):
-                    group = f"http://{group}"
-                try:
-                    response = session.head(
-                        group,
-                        allow_redirects=True,
-                        timeout=(7, 10)
+            group = _expandable_url(self, group)
+            if group:
+                expanded_url = _expand_url(self, group)
+                if expanded_url:
+                    tweet["text"] = re.sub(
+                        group, expanded_url, tweet["text"]
                     )
-                    if not response.ok:
-                        logger.debug(
-                            _(
-                                "Couldn't expand the url {}: {}"
-                            ).format(group, response.status_code)
-                        )
-                    if response:
-                        expanded_url = response.url
-                        tweet["text"] = re.sub(
-                            group, expanded_url, tweet["text"]
-                        )
-                except Exception as ex:  # pragma
-                    logger.debug(
-                        _(
-                            "Couldn't expand the url: {}"
-                        ).format(group)
-                    )
-                    if isinstance(ex, requests.exceptions.RequestException):
-                        expanded_url = ex.request.url
-                        tweet["text"] = re.sub(
-                            group, expanded_url, tweet["text"]
-                        )
-                        pass
-                    elif isinstance(ex, UnicodeError):
-                        expanded_url = ex.object.decode('latin1')
-                        tweet["text"] = re.sub(
-                            group, expanded_url, tweet["text"]
-                        )
-                        pass
     return tweet["text"]
 
 
+def _rewrite_text(self, tweet):
+    """Expands the URLs of the tweet and applies the rest of replacements
+    configured for the user (see TextRewriter) to its text
+
+    :param tweet: tweet object
+    :type tweet: dict
+    :returns: rewritten text
+    :rtype: str
+    """
+    if getattr(self, "text_rewriter", None) is None:
+        self.text_rewriter = TextRewriter(self)
+    try:
+        urls = {
+            u["url"]: u["expanded_url"] for u in tweet["entities"]["urls"]
+        }
+    except (KeyError, TypeError):
+        urls = {}
+
+    def expand(url):
+        if url in urls:
+            return urls[url]
+        # Links without a scheme are left as they are
+        if url.startswith(("http://", "https://")):
+            url = _expandable_url(self, url)
+            if url:
+                return _expand_url(self, url)
+        return None
+
+    return self.text_rewriter.rewrite(tweet["text"], expand)
+
+
+def _expandable_url(self, url):
+    """Returns 'url' with a scheme if it's worth trying to expand it, None
+    otherwise"""
+    # don't be brave trying to unwound an URL when it gets cut off
+    if "…" in url or url.startswith(self.nitter_base_url):
+        return None
+    if not url.startswith(("http://", "https://")):
+        url = f"http://{url}"
+    return url
+
+
+def _prefetch_urls(self, tweets_to_post, tweet_index=None):
+    """Expands the shortened URLs of every tweet in the batch concurrently,
+    so _expand_urls finds all of them in the URL cache
+
+    :param tweets_to_post: Dict of tweet objects to be processed
+    :type tweets_to_post: dict
+    :param tweet_index: referenced tweets of the batch
+    :type tweet_index: dict
+    """
+    pending = set()
+    for tweet in tweets_to_post["data"]:
+        text = tweet["text"]
+        if "referenced_tweets" in tweet:
+            text = _get_rt_text(self, tweet, tweet_index)
+        try:
+            entities_urls = {u["url"] for u in tweet["entities"]["urls"]}
+        except (KeyError, TypeError):
+            entities_urls = set()
+        for match in re.finditer(URL_PATTERN, text):
+            # Only links with a scheme are expanded (see _rewrite_text)
+            if match.group() in entities_urls or not match.group().startswith(
+                    ("http://", "https://")
+            ):
+                continue
+            url = _expandable_url(self, match.group())
+            if url and url not in self.url_cache:
+                pending.add(url)
+    if not pending:
+        return
+    workers = min(int(self.url_workers), len(pending))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        # _expand_url stores every result in the URL cache
+        list(executor.map(lambda url: _expand_url(self, url), pending))
+
+
+def _expand_url(self, url):
+    """Follows the redirects of a shortened URL
+
+    Results are kept in the URL cache, failures included (for
+    'url_cache_negative_ttl' seconds) so dead links don't time out on
+    every run.
+
+    :param url: URL to expand
+    :type url: str
+    :returns: expanded URL or None if it couldn't be expanded
+    :rtype: str
+    """
+    cached = self.url_cache.get(url, _NOT_CACHED)
+    if cached is not _NOT_CACHED:
+        return cached
+    ttl = None
+    expanded_url = None
+    try:
+        response = self.http.head(
+            url,
+            allow_redirects=True,
+            timeout=(7, 10)
+        )
+        if not response.ok:
+            logger.debug(
+                _(
+                    "Couldn't expand the url {}: {}"
+                ).format(url, response.status_code)
+            )
+            ttl = self.url_cache_negative_ttl
+        if response:
+            expanded_url = response.url
+    except Exception as ex:  # pragma
+        logger.debug(
+            _(
+                "Couldn't expand the url: {}"
+            ).format(url)
+        )
+        ttl = self.url_cache_negative_ttl
+        if isinstance(ex, requests.exceptions.RequestException):
+            # Keep as much of the redirect chain as we managed to follow
+            expanded_url = getattr(ex.request, "url", None)
+        elif isinstance(ex, UnicodeError):
+            expanded_url = ex.object.decode('latin1')
+    self.url_cache.set(url, expanded_url, ttl=ttl)
+    return expanded_url
+
+
 def _get_media_url(self, item, media_include, tweet):
     # TODO: Verify if video download is available on v2 and migrate to it
     media_urls = []
@@ -585,9 +941,9 @@ def _get_media_url(self, item, media_include, tweet):
             media_include["type"] == "video"
             or media_include["type"] == "animated_gif"
         ):
-            tweet_video = self._get_tweets("v1.1", tweet["id"])
-            xmd = tweet_video["extended_entities"]["media"]
+            xmd = _get_extended_media(self, tweet["id"])
             for extended_media in xmd:
+                extended_media = dict(extended_media)
                 extended_media["media_key"] = item
                 media_urls.append(extended_media)
             return media_urls
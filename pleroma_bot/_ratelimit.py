@@ -0,0 +1,155 @@
+import re
+import time
+import threading
+from urllib.parse import urlsplit
+
+# Seconds added to the reset time reported by the API, to account for clock
+# drift between us and the server
+RESET_MARGIN = 2
+# Fraction of the budget of a window below which requests start being paced
+DEFAULT_RESERVE = 0.1
+
+_ID_SEGMENT = re.compile(r"^\d+(\.json)?$")
+
+_tracker = None
+_tracker_lock = threading.Lock()
+
+
+class RateLimitTracker:
+    """
+    Keeps the rate limit budget reported by the Twitter API for every
+    endpoint family (e.g. 'api.twitter.com/2/users/:id/tweets') and
+    credential, updated from the headers of every response.
+
+    Instead of waiting for a 429 and sleeping until the window resets,
+    callers ask for a slot before sending a request. While there is plenty
+    of budget left the slot is immediate, when it runs low the remaining
+    requests are spread over what is left of the window, and when it is
+    exhausted the slot is given at the reset time. Limits are tracked per
+    family, so running out of budget on one endpoint doesn't hold back
+    requests to the others.
+    """
+
+    def __init__(self, reserve=DEFAULT_RESERVE, margin=RESET_MARGIN):
+        self.reserve = reserve
+        self.margin = margin
+        self._limits = {}
+        self._lock = threading.Lock()
+
+    def key(self, url, credential=None) -> tuple:
+        """Returns the key used for tracking the budget of 'url'
+
+        :param url: URL of the request
+        :type url: str
+        :param credential: token the request is authenticated with, limits
+            are enforced per token
+        :type credential: str
+        :returns: key of the endpoint family
+        :rtype: tuple
+        """
+        return credential, endpoint_family(url)
+
+    def update(self, key, headers) -> bool:
+        """Records the budget reported in the headers of a response
+
+        :param key: key returned by 'key'
+        :param headers: headers of the response
+        :returns: True if the response included rate limit headers
+        :rtype: bool
+        """
+        limit = headers.get("x-rate-limit-limit")
+        remaining = headers.get("x-rate-limit-remaining")
+        reset = headers.get("x-rate-limit-reset")
+        if not (limit and remaining and reset):
+            return False
+        try:
+            limit, remaining, reset = int(limit), int(remaining), int(reset)
+        except ValueError:
+            return False
+        with self._lock:
+            state = self._limits.get(key)
+            if state is None or state["reset"] != reset:
+                state = {"next": 0}
+                self._limits[key] = state
+            # Responses can arrive out of order, keep the lowest count seen
+            # within the same window
+            if "remaining" in state:
+                remaining = min(remaining, state["remaining"])
+            state.update(limit=limit, remaining=remaining, reset=reset)
+        return True
+
+    def reserve_slot(self, key) -> float:
+        """Books a request against the budget of 'key'
+
+        :param key: key returned by 'key'
+        :returns: seconds to wait before sending the request
+        :rtype: float
+        """
+        now = time.time()
+        with self._lock:
+            state = self._limits.get(key)
+            if state is None:
+                return 0
+            reset = state["reset"] + self.margin
+            if reset <= now:
+                # The window is over, the next response tells us the new one
+                del self._limits[key]
+                return 0
+            if state["remaining"] <= 0:
+                return reset - now
+            start = now
+            if state["remaining"] <= state["limit"] * self.reserve:
+                interval = (reset - now) / state["remaining"]
+                start = max(now, state["next"])
+                state["next"] = start + interval
+            state["remaining"] -= 1
+            return start - now
+
+    def status(self, key):
+        """Returns (remaining, limit, reset) for 'key' or None if unknown"""
+        with self._lock:
+            state = self._limits.get(key)
+            if state is None:
+                return None
+            return state["remaining"], state["limit"], state["reset"]
+
+    def __getstate__(self):
+        return {"reserve": self.reserve, "margin": self.margin}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._limits = {}
+        self._lock = threading.Lock()
+
+
+def endpoint_family(url) -> str:
+    """Returns the path of 'url' with the IDs and usernames replaced by a
+    placeholder, so requests to the same endpoint share their budget
+
+    :param url: URL of the request
+    :type url: str
+    :returns: endpoint family
+    :rtype: str
+    """
+    parts = urlsplit(url)
+    # The first segment is the API version
+    version, *path = parts.path.strip("/").split("/")
+    segments = [version]
+    for segment in path:
+        if _ID_SEGMENT.match(segment) or segments[-1] == "username":
+            segment = ":id"
+        segments.append(segment)
+    return f"{parts.netloc.lower()}/{'/'.join(segments)}"
+
+
+def get_rate_limiter() -> RateLimitTracker:
+    """Returns the tracker shared by every user in this process
+
+    :returns: rate limit tracker
+    :rtype: RateLimitTracker
+    """
+    global _tracker
+    with _tracker_lock:
+        if _tracker is None:
+            _tracker = RateLimitTracker()
+    return _tracker
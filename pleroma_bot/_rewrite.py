@@ -0,0 +1,115 @@
+import re
+import html
+
+# URI regex
+URL_PATTERN = re.compile(
+    r"(?i)\b((?:https?://|www\d{0,3}[.]|[a-z0-9.\-]+[.][a-z]"
+    r"{2,4}/)(?:[^\s()<>]+|\(([^\s()<>]+|(\([^\s()<>]+\)))*"
+    r"\))+(?:\(([^\s()<>]+|(\([^\s()<>]+\)))*\)|[^\s`!()\[\]{}"
+    r';:\'".,<>?«»“”‘’]))'
+)
+# Same patterns as _remove_status_links and _remove_media_links
+STATUS_LINK = re.compile(
+    r"\bhttps?:\/\/twitter.com\/+[^\/:]+\/.*?status\/\d*\b"
+)
+MEDIA_LINK = re.compile(
+    r"\bhttps?:\/\/twitter.com\/+[^\/:]+\/.*?(photo|video)\/\d*\b"
+)
+MENTION = r"\B\@\w+"
+
+
+class TextRewriter:
+    """
+    Rewrites the text of tweets with patterns compiled once per user.
+
+    Built once per user from its config: URLs and mentions are combined into
+    one compiled pattern, and every token found goes through the steps that
+    apply to it (expansion, removal of Twitter media and status links,
+    nitter and invidious URLs and mention links) in the same order
+    process_tweets used to apply them to the whole text. HTML entities are
+    unescaped after URLs are expanded. Custom replacements are then applied
+    to the whole result with a single pattern of their (escaped) keys.
+    """
+
+    def __init__(self, user):
+        self.keep_media_links = user.keep_media_links
+        self.rich_text = getattr(user, "rich_text", False)
+        self.url_replacements = []
+        if user.nitter:
+            self.url_replacements.append(
+                ("https://twitter.com", user.nitter_base_url)
+            )
+        if user.invidious:
+            self.url_replacements.append(
+                ("https://youtube.com", user.invidious_base_url)
+            )
+        custom = getattr(user, "custom_replacements", None) or {}
+        # Keys are matched case-insensitively
+        self.custom_replacements = {
+            k.lower(): v for k, v in custom.items() if k
+        }
+
+        # URL_PATTERN sets its flags inline, they apply to the whole pattern
+        alternatives = [
+            f"(?P<url>{URL_PATTERN.pattern.replace('(?i)', '', 1)})"
+        ]
+        if self.rich_text:
+            alternatives.append(f"(?P<mention>{MENTION})")
+        self.pattern = re.compile("|".join(alternatives), re.IGNORECASE)
+        self.custom_pattern = None
+        if self.custom_replacements:
+            # Longest keys first, so the longest one starting at a position
+            # is the one replaced
+            keys = sorted(self.custom_replacements, key=len, reverse=True)
+            self.custom_pattern = re.compile(
+                "|".join(re.escape(key) for key in keys), re.IGNORECASE
+            )
+
+    def rewrite(self, text, expand=None) -> str:
+        """Returns the rewritten text
+
+        :param text: text of the tweet
+        :type text: str
+        :param expand: callable that receives a URL found in the text and
+            returns its expanded form, or None to leave it as it is
+        :type expand: callable
+        :returns: rewritten text
+        :rtype: str
+        """
+        pieces = []
+        pos = 0
+        for match in self.pattern.finditer(text):
+            pieces.append(html.unescape(text[pos:match.start()]))
+            if match.lastgroup == "url":
+                pieces.append(self._rewrite_url(match.group(), expand))
+            else:
+                pieces.append(self._rewrite_mention(match.group()))
+            pos = match.end()
+        pieces.append(html.unescape(text[pos:]))
+        text = "".join(pieces)
+        if self.custom_pattern is not None:
+            text = self.custom_pattern.sub(self._replace_custom, text)
+        return text
+
+    def _rewrite_url(self, url, expand):
+        if expand is not None:
+            url = expand(url) or url
+        url = html.unescape(url)
+        if not self.keep_media_links:
+            url = MEDIA_LINK.sub("", url)
+            url = STATUS_LINK.sub("", url)
+        return self._replace_urls(url)
+
+    def _rewrite_mention(self, mention):
+        # TODO: Use nitter if asked (self.nitter)
+        link = f"[{mention}](https://twitter.com/{mention[1:]})"
+        return self._replace_urls(link)
+
+    def _replace_urls(self, token):
+        for url, new_url in self.url_replacements:
+            token = token.replace(url, new_url)
+        return token
+
+    def _replace_custom(self, match):
+        key = match.group()
+        return self.custom_replacements.get(key.lower(), key)
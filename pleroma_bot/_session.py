@@ -0,0 +1,186 @@
+import threading
+from http.cookiejar import DefaultCookiePolicy
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# (connect, read) timeouts in seconds used when a call doesn't provide one
+DEFAULT_TIMEOUT = (10, 120)
+DEFAULT_POOL_CONNECTIONS = 10
+DEFAULT_POOL_MAXSIZE = 10
+
+_registries = {}
+_registries_lock = threading.Lock()
+
+
+class TimeoutSession(requests.Session):
+    """
+    Session that applies a default timeout to every request and doesn't
+    persist cookies between requests, so it can be safely shared by
+    multiple users.
+    """
+
+    __attrs__ = requests.Session.__attrs__ + ["timeout"]
+
+    def __init__(self, timeout=DEFAULT_TIMEOUT):
+        super(TimeoutSession, self).__init__()
+        self.timeout = timeout
+        self.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+
+    def request(self, method, url, **kwargs):
+        if kwargs.get("timeout") is None:
+            kwargs["timeout"] = self.timeout
+        return super(TimeoutSession, self).request(method, url, **kwargs)
+
+
+class SessionRegistry:
+    """
+    Keeps one keep-alive session (and its connection pool) per host so
+    consecutive requests to the same host reuse warm connections
+    """
+
+    def __init__(
+            self,
+            pool_connections=DEFAULT_POOL_CONNECTIONS,
+            pool_maxsize=DEFAULT_POOL_MAXSIZE,
+            timeout=DEFAULT_TIMEOUT,
+            host_concurrency=None
+    ):
+        self.pool_connections = int(pool_connections)
+        self.pool_maxsize = int(pool_maxsize)
+        self.timeout = _parse_timeout(timeout)
+        # Max number of in-flight requests per host, shared by every thread
+        # using the registry (by default as many as the pool can keep alive)
+        self.host_concurrency = int(host_concurrency or self.pool_maxsize)
+        self._sessions = {}
+        self._host_limits = {}
+        self._lock = threading.Lock()
+
+    def session(self, url) -> requests.Session:
+        """Returns the session associated with the host of 'url'
+
+        :param url: URL that is going to be requested
+        :type url: str
+        :returns: session for the host
+        :rtype: requests.Session
+        """
+        key = _host_key(url)
+        session = self._sessions.get(key)
+        if session is None:
+            with self._lock:
+                session = self._sessions.get(key)
+                if session is None:
+                    session = self._new_session()
+                    self._sessions[key] = session
+                    self._host_limits[key] = threading.BoundedSemaphore(
+                        self.host_concurrency
+                    )
+        return session
+
+    def host_limit(self, url) -> threading.BoundedSemaphore:
+        """Returns the semaphore bounding concurrent requests to the host of
+        'url'
+
+        :param url: URL that is going to be requested
+        :type url: str
+        :returns: semaphore for the host
+        :rtype: threading.BoundedSemaphore
+        """
+        self.session(url)
+        return self._host_limits[_host_key(url)]
+
+    def request(self, method, url, **kwargs) -> requests.Response:
+        session = self.session(url)
+        with self.host_limit(url):
+            return session.request(method.upper(), url, **kwargs)
+
+    def get(self, url, **kwargs) -> requests.Response:
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, data=None, **kwargs) -> requests.Response:
+        return self.request("POST", url, data=data, **kwargs)
+
+    def head(self, url, **kwargs) -> requests.Response:
+        kwargs.setdefault("allow_redirects", False)
+        return self.request("HEAD", url, **kwargs)
+
+    def close(self):
+        with self._lock:
+            for session in self._sessions.values():
+                session.close()
+            self._sessions = {}
+            self._host_limits = {}
+
+    def _new_session(self):
+        session = TimeoutSession(timeout=self.timeout)
+        adapter = HTTPAdapter(
+            pool_connections=self.pool_connections,
+            pool_maxsize=self.pool_maxsize,
+        )
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        return session
+
+    def __getstate__(self):
+        # Sessions and locks are not shared with other processes
+        return {
+            "pool_connections": self.pool_connections,
+            "pool_maxsize": self.pool_maxsize,
+            "timeout": self.timeout,
+            "host_concurrency": self.host_concurrency,
+        }
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._sessions = {}
+        self._host_limits = {}
+        self._lock = threading.Lock()
+
+
+def get_registry(
+        pool_connections=DEFAULT_POOL_CONNECTIONS,
+        pool_maxsize=DEFAULT_POOL_MAXSIZE,
+        timeout=DEFAULT_TIMEOUT,
+        host_concurrency=None
+) -> SessionRegistry:
+    """Returns the registry shared by every user with the same pool settings
+
+    :returns: session registry
+    :rtype: SessionRegistry
+    """
+    key = (
+        int(pool_connections),
+        int(pool_maxsize),
+        _parse_timeout(timeout),
+        int(host_concurrency or pool_maxsize),
+    )
+    with _registries_lock:
+        registry = _registries.get(key)
+        if registry is None:
+            registry = SessionRegistry(*key)
+            _registries[key] = registry
+    return registry
+
+
+def close_registries():
+    """Closes the sessions of every registry, they are opened again on the
+    next request
+    """
+    with _registries_lock:
+        for registry in _registries.values():
+            registry.close()
+
+
+def _host_key(url):
+    parts = urlsplit(url)
+    return parts.scheme.lower(), parts.netloc.lower()
+
+
+def _parse_timeout(timeout):
+    if timeout is None:
+        return None
+    if isinstance(timeout, (list, tuple)):
+        connect, read = timeout
+        return float(connect), float(read)
+    return float(timeout)
@@ -1,105 +1,139 @@
+import os
 import time
 import json
-import requests
 
 from tqdm import tqdm
 from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
 
 from . import logger
+from ._cache import JsonCache
 from pleroma_bot.i18n import _
 
 # from pleroma_bot._utils import spinner
 
+# Fields and expansions requested for every tweet retrieved from the v2 API
+TWEET_V2_PARAMS = {
+    "poll.fields": "duration_minutes,end_datetime,id,options,"
+                   "voting_status",
+    "media.fields": "duration_ms,height,media_key,"
+                    "preview_image_url,type,url,width,"
+                    "public_metrics,alt_text",
+    "expansions": "attachments.poll_ids,"
+                  "attachments.media_keys,author_id,"
+                  "entities.mentions.username,geo.place_id,"
+                  "in_reply_to_user_id,referenced_tweets.id,"
+                  "referenced_tweets.id.author_id",
+    "tweet.fields": "attachments,author_id,"
+                    "context_annotations,conversation_id,"
+                    "created_at,entities,"
+                    "geo,id,in_reply_to_user_id,lang,"
+                    "public_metrics,"
+                    "possibly_sensitive,referenced_tweets,"
+                    "source,text,"
+                    "withheld",
+}
+
 
 def twitter_api_request(self, method, url,
                         params=None, data=None, headers=None, cookies=None,
                         files=None, auth=None, timeout=None, proxies=None,
                         hooks=None, allow_redirects=True, stream=None,
                         verify=None, cert=None, json=None, retries=0):
-    response = requests.request(
-        method=method.upper(),
-        url=url,
-        headers=headers,
-        files=files,
-        data=data or {},
-        json=json,
-        params=params or {},
-        auth=auth,
-        cookies=cookies,
-        hooks=hooks,
-    )
+    """Sends a request to the Twitter API, pacing it according to the rate
+    limit budget left for its endpoint and retrying on HTTP 429 and 503
+
+    The wait for a slot (see ``RateLimitTracker.reserve_slot``) sleeps in
+    the calling thread, with every engine.
+    """
     max_retries = 5
-    if response.status_code == 429:
-        remaining_header = response.headers.get('x-rate-limit-remaining')
-        reset_header = response.headers.get('x-rate-limit-reset')
-        limit_header = response.headers.get('x-rate-limit-limit')
-        if self.guest:  # pragma: todo
-            logger.warning(
-                _(
-                    "Rate limit exceeded when using a guest token. "
-                    "Refreshing token and retrying..."
+    rate_limit_key = self.rate_limits.key(url, self.twitter_token)
+    # Whether a slot was already waited for after a 429
+    paced = False
+    while True:
+        if not paced:
+            delay = self.rate_limits.reserve_slot(rate_limit_key)
+            if delay > 0:
+                logger.debug(
+                    _("Pacing request to {} for {}s").format(
+                        rate_limit_key[1], round(delay, 2)
+                    )
                 )
-            )
-            guest_token, headers = self._get_guest_token_header()
-            self.twitter_token = guest_token
-            self.header_twitter = headers
-            response = requests.request(
-                method=method.upper(),
-                url=url,
-                headers=headers,
-                files=files,
-                data=data or {},
-                json=json,
-                params=params or {},
-                auth=auth,
-                cookies=cookies,
-                hooks=hooks,
-            )
-            if response.status_code == 429 and self.proxy:
+                time.sleep(delay)
+        paced = False
+        response = self.http.request(
+            method=method.upper(),
+            url=url,
+            headers=headers,
+            files=files,
+            data=data or {},
+            json=json,
+            params=params or {},
+            auth=auth,
+            cookies=cookies,
+            hooks=hooks,
+            timeout=timeout,
+        )
+        has_limits = self.rate_limits.update(
+            rate_limit_key, response.headers
+        )
+        if response.status_code == 429:
+            if self.guest:  # pragma: todo
                 logger.warning(
                     _(
                         "Rate limit exceeded when using a guest token. "
-                        "Retrying with a proxy..."
+                        "Refreshing token and retrying..."
                     )
                 )
-                retries += 1
-                if retries <= max_retries:
-                    response = self._request_proxy(
-                        method, url, params=params,
-                        data=data, headers=headers,
-                        cookies=cookies, files=files,
-                        auth=auth, hooks=hooks,
-                        timeout=timeout,
-                        proxies=proxies,
-                        allow_redirects=allow_redirects,
-                        stream=stream, verify=verify,
-                        cert=cert, json=json, retries=retries
+                guest_token, headers = self._get_guest_token_header()
+                self.twitter_token = guest_token
+                self.header_twitter = headers
+                response = self.http.request(
+                    method=method.upper(),
+                    url=url,
+                    headers=headers,
+                    files=files,
+                    data=data or {},
+                    json=json,
+                    params=params or {},
+                    auth=auth,
+                    cookies=cookies,
+                    hooks=hooks,
+                    timeout=timeout,
+                )
+                if response.status_code == 429 and self.proxy:
+                    logger.warning(
+                        _(
+                            "Rate limit exceeded when using a guest token. "
+                            "Retrying with a proxy..."
+                        )
                     )
-        elif remaining_header and reset_header and limit_header:
-            limit = int(limit_header)
-            remaining = int(remaining_header)
-            reset = int(reset_header)
-            reset_time = datetime.utcfromtimestamp(reset)
-            logger.info(_(
-                "Rate limit exceeded. {} out of {} requests remaining until {}"
-                " UTC"
-            ).format(remaining, limit, reset_time))
-
-            delay = (reset_time - datetime.utcnow()).total_seconds() + 2
-            logger.info(_("Sleeping for {}s...").format(round(delay)))
-            time.sleep(delay)
-
-            response = self.twitter_api_request(
-                method, url, params=params,
-                data=data, headers=headers,
-                cookies=cookies, files=files,
-                auth=auth, hooks=hooks,
-                timeout=timeout,
-                proxies=proxies,
-                allow_redirects=allow_redirects,
-                stream=stream, verify=verify,
-                cert=cert, json=json
-            )
+                    retries += 1
+                    if retries <= max_retries:
+                        response = self._request_proxy(
+                            method, url, params=params,
+                            data=data, headers=headers,
+                            cookies=cookies, files=files,
+                            auth=auth, hooks=hooks,
+                            timeout=timeout,
+                            proxies=proxies,
+                            allow_redirects=allow_redirects,
+                            stream=stream, verify=verify,
+                            cert=cert, json=json, retries=retries
+                        )
+            elif has_limits:
+                remaining, limit, reset = self.rate_limits.status(
+                    rate_limit_key
+                )
+                logger.info(_(
+                    "Rate limit exceeded. {} out of {} requests remaining "
+                    "until {} UTC"
+                ).format(remaining, limit, datetime.utcfromtimestamp(reset)))
+                delay = self.rate_limits.reserve_slot(rate_limit_key)
+                logger.info(_("Sleeping for {}s...").format(round(delay)))
+                time.sleep(delay)
+                paced = True
+                continue
         elif response.status_code == 503 and retries <= max_retries:  # pragma
             retries += 1
             logger.warning(
@@ -109,19 +143,8 @@ def twitter_api_request(self, method, url,
                 ).format(response.text, retries, max_retries)
             )
             time.sleep(0.5 * retries)
-            response = self.twitter_api_request(
-                method, url, params=params,
-                data=data, headers=headers,
-                cookies=cookies, files=files,
-                auth=auth, hooks=hooks,
-                timeout=timeout,
-                proxies=proxies,
-                allow_redirects=allow_redirects,
-                stream=stream, verify=verify,
-                cert=cert, json=json, retries=retries
-            )
-
-    return response
+            continue
+        return response
 
 
 def _get_twitter_info_guest(self):  # pragma: todo
@@ -133,7 +156,7 @@ def _get_twitter_info_guest(self):  # pragma: todo
             f"/users/show.json?screen_name="
             f"{t_user}"
         )
-        response = requests.get(
+        response = self.http.get(
             twitter_user_url, headers=self.header_twitter, auth=self.auth
         )
         if not response.ok:
@@ -223,7 +246,18 @@ def _get_twitter_info(self):
         )
         if not response.ok:
             response.raise_for_status()
-        user = response.json()["data"]
+        response_json = response.json()
+        user = response_json["data"]
+        # Saves a lookup in _get_twitter_user_id
+        id_cache = _twitter_id_cache(self, t_user)
+        if id_cache is not None and id_cache.get(t_user) != user["id"]:
+            id_cache.set(t_user, user["id"])
+            id_cache.save()
+        # The pinned tweet is expanded too, no need to request it again
+        pinned_tweets = response_json.get("includes", {}).get("tweets", [])
+        self.twitter_pinned_ids[t_user] = (
+            pinned_tweets[0]["id"] if pinned_tweets else None
+        )
         bio_text = user["description"]
         # Expand bio urls if possible
         if self.twitter_bio:
@@ -399,13 +433,17 @@ def _get_tweets(
         tweet_id=None,
         start_time=None,
         t_user=None,
-        pbar=None):
+        pbar=None,
+        since_id=None):
     """Gathers last 'max_tweets' tweets from the user and returns them
     as a dict
     :param version: Twitter API version to use to retrieve the tweets
     :type version: string
     :param tweet_id: Tweet ID to retrieve
     :type tweet_id: int
+    :param since_id: only retrieve tweets newer than this tweet ID (takes
+        precedence over start_time)
+    :type since_id: str
 
     :returns: last 'max_tweets' tweets
     :rtype: dict
@@ -488,20 +526,26 @@ def _get_tweets(
                     tweets = response.json()
                 else:  # pragma: todo
                     now_ts = int(datetime.now(tz=timezone.utc).timestamp())
-                    fmt_date = ("%Y-%m-%dT%H:%M:%S.%fZ", "%Y-%m-%dT%H:%M:%SZ")
-                    for fmt in fmt_date:
-                        try:
-                            start_time_ts = int(datetime.strptime(
-                                start_time, fmt
-                            ).replace(tzinfo=timezone.utc).timestamp())
-                        except ValueError:
-                            pass
+                    if since_id:
+                        since = f"since_id:{since_id}"
+                    else:
+                        fmt_date = (
+                            "%Y-%m-%dT%H:%M:%S.%fZ", "%Y-%m-%dT%H:%M:%SZ"
+                        )
+                        for fmt in fmt_date:
+                            try:
+                                start_time_ts = int(datetime.strptime(
+                                    start_time, fmt
+                                ).replace(tzinfo=timezone.utc).timestamp())
+                            except ValueError:
+                                pass
+                        since = f"since_time:{start_time_ts}"
                     rts = ""
                     if self.include_rts:
                         rts = "include:nativeretweets"
                     query = (
                         f"(from:{t_user}) "
-                        f"since_time:{start_time_ts} until_time:{now_ts} {rts}"
+                        f"{since} until_time:{now_ts} {rts}"
                     )
                     param = {
                         "include_profile_interstitial_type": "1",
@@ -546,7 +590,11 @@ def _get_tweets(
             return tweets
     elif version == "v2":
         tweets_v2 = self._get_tweets_v2(
-            tweet_id=tweet_id, start_time=start_time, t_user=t_user, pbar=pbar
+            tweet_id=tweet_id,
+            start_time=start_time,
+            t_user=t_user,
+            pbar=pbar,
+            since_id=since_id
         )
         return tweets_v2
     else:
@@ -613,169 +661,278 @@ def _get_tweets_v2(
         count=0,
         tweets_v2=None,
         t_user=None,
-        pbar=None
+        pbar=None,
+        since_id=None
 ):
     if not (3200 >= self.max_tweets >= 10):
-        global _
         error_msg = _(
             "max_tweets must be between 10 and 3200. max_tweets: {}"
         ).format(self.max_tweets)
         raise ValueError(error_msg)
-    params = {}
-    previous_token = next_token
-    max_tweets = self.max_tweets
-    diff = max_tweets - count
-    if diff == 0 or diff < 0:
-        return tweets_v2
-    # Tweet number must be between 10 and 100 for search
-    if count:
-
-        max_results = diff if diff < 100 else 100
-    else:
-        max_results = max_tweets if 100 > self.max_tweets > 10 else 100
-    # round up max_results to the nearest 10
-    max_results = (max_results + 9) // 10 * 10
     if tweet_id:
         url = f"{self.twitter_base_url_v2}/tweets/{tweet_id}"
-        params.update(
-            {
-                "poll.fields": "duration_minutes,end_datetime,id,options,"
-                               "voting_status",
-                "media.fields": "duration_ms,height,media_key,"
-                                "preview_image_url,type,url,width,"
-                                "public_metrics,alt_text",
-                "expansions": "attachments.poll_ids,"
-                              "attachments.media_keys,author_id,"
-                              "entities.mentions.username,geo.place_id,"
-                              "in_reply_to_user_id,referenced_tweets.id,"
-                              "referenced_tweets.id.author_id",
-                "tweet.fields": "attachments,author_id,"
-                                "context_annotations,conversation_id,"
-                                "created_at,entities,"
-                                "geo,id,in_reply_to_user_id,lang,"
-                                "public_metrics,"
-                                "possibly_sensitive,referenced_tweets,"
-                                "source,text,"
-                                "withheld",
-            }
-        )
         response = self.twitter_api_request(
             'GET',
             url,
             headers=self.header_twitter,
             auth=self.auth,
-            params=params
+            params=dict(TWEET_V2_PARAMS)
         )
 
         if not response.ok:
             response.raise_for_status()
         response = response.json()
         return response
-    else:
-        params.update({"max_results": max_results})
 
-        url = (
-            f"{self.twitter_base_url_v2}/users/by?"
-            f"usernames={t_user}"
+    pages = self._iter_tweets_v2(
+        start_time,
+        t_user,
+        next_token=next_token,
+        count=count,
+        pbar=pbar,
+        since_id=since_id
+    )
+    for page in pages:
+        if tweets_v2 is None:
+            tweets_v2 = page
+        else:
+            _merge_tweets_v2(tweets_v2, page)
+    return tweets_v2
+
+
+def _iter_tweets_v2(self, start_time, t_user, next_token=None, count=0,
+                    pbar=None, since_id=None):
+    """Yields the timeline of a Twitter user page by page (newest first).
+
+    The request for the next page is already in flight while the current
+    one is being consumed.
+
+    :param start_time: oldest date of the tweets to retrieve
+    :type start_time: str
+    :param t_user: Twitter username
+    :type t_user: str
+    :param next_token: pagination token to start from
+    :type next_token: str
+    :param count: number of tweets already retrieved
+    :type count: int
+    :param pbar: progress bar to update with the number of tweets
+    :type pbar: tqdm
+    :param since_id: only retrieve tweets newer than this tweet ID (takes
+        precedence over start_time)
+    :type since_id: str
+
+    :returns: parsed pages, as returned by the API
+    :rtype: generator
+    """
+    if self.max_tweets - count <= 0:
+        return
+    twitter_user_id = self._get_twitter_user_id(t_user)
+    url = f"{self.twitter_base_url_v2}/users/{twitter_user_id}/tweets"
+
+    executor = ThreadPoolExecutor(max_workers=1)
+    try:
+        future = executor.submit(
+            _get_tweets_v2_page,
+            self,
+            url,
+            start_time,
+            count,
+            next_token,
+            since_id
         )
+        while future:
+            page = future.result()
+            future = None
+            previous_token = next_token
+            if pbar:
+                pbar.update(page["meta"]["result_count"])
+            try:
+                next_token = page["meta"]["next_token"]
+                count += page["meta"]["result_count"]
+            except KeyError:
+                next_token = None
+            if (
+                    next_token
+                    and next_token != previous_token
+                    and self.max_tweets - count > 0
+            ):
+                future = executor.submit(
+                    _get_tweets_v2_page,
+                    self,
+                    url,
+                    start_time,
+                    count,
+                    next_token,
+                    since_id
+                )
+            yield page
+    finally:
+        executor.shutdown(wait=True)
+
+
+def _twitter_id_cache(self, t_user):
+    # Stored in the user folder, None if it's not a configured user
+    if t_user not in self.user_path:
+        return None
+    cache_path = os.path.join(self.user_path[t_user], "twitter_id.json")
+    return JsonCache(cache_path, ttl=self.twitter_id_ttl)
+
+
+def _get_twitter_user_id(self, t_user):
+    """Resolves the ID of a Twitter user, using the cache stored in the
+    user folder when it hasn't expired yet
+
+    :param t_user: Twitter username
+    :type t_user: str
+    :returns: ID of the Twitter user
+    :rtype: str
+    """
+    cache = _twitter_id_cache(self, t_user)
+    if cache is not None:
+        twitter_user_id = cache.get(t_user)
+        if twitter_user_id is not None:
+            return twitter_user_id
+    url = (
+        f"{self.twitter_base_url_v2}/users/by?"
+        f"usernames={t_user}"
+    )
+    response = self.twitter_api_request(
+        'GET', url, headers=self.header_twitter, auth=self.auth
+    )
+    if not response.ok:
+        response.raise_for_status()
+    twitter_user_id = response.json()["data"][0]["id"]
+    if cache is not None:
+        cache.set(t_user, twitter_user_id)
+        cache.save()
+    return twitter_user_id
+
+
+def _get_tweets_by_ids(self, tweet_ids) -> dict:
+    """Retrieves multiple tweets from the v2 API, up to 100 per request
+
+    :param tweet_ids: IDs of the tweets to retrieve
+    :type tweet_ids: list
+    :returns: dict with the retrieved tweets indexed by ID, in the same
+        format as returned by _get_tweets for a single tweet. Tweets that
+        don't exist anymore (or are not visible) are indexed as None
+    :rtype: dict
+    """
+    url = f"{self.twitter_base_url_v2}/tweets"
+    tweet_ids = list(tweet_ids)
+    tweets = {}
+    for idx in range(0, len(tweet_ids), 100):
+        params = {"ids": ",".join(tweet_ids[idx:idx + 100])}
+        params.update(TWEET_V2_PARAMS)
         response = self.twitter_api_request(
-            'GET', url, headers=self.header_twitter, auth=self.auth
+            'GET',
+            url,
+            headers=self.header_twitter,
+            auth=self.auth,
+            params=params
         )
         if not response.ok:
             response.raise_for_status()
         response = response.json()
-        twitter_user_id = response["data"][0]["id"]
+        includes = response.get("includes", {})
+        for include in ("users", "tweets", "media", "polls"):
+            includes.setdefault(include, [])
+        for tweet in response.get("data", []):
+            tweets[tweet["id"]] = {"data": tweet, "includes": includes}
+        for error in response.get("errors", []):
+            if "resource_id" in error:
+                tweets.setdefault(error["resource_id"], None)
+    return tweets
 
-        url = f"{self.twitter_base_url_v2}/users/{twitter_user_id}/tweets"
-        if next_token:
-            params.update({"pagination_token": next_token})
 
-        params.update(
-            {
-                "start_time": start_time,
-            }
-        )
+def _get_tweets_v1_by_ids(self, tweet_ids) -> dict:
+    """Retrieves multiple tweets from the v1.1 API, up to 100 per request
 
-    params.update(
-        {
-            "poll.fields": "duration_minutes,end_datetime,id,options,"
-                           "voting_status",
-            "media.fields": "duration_ms,height,media_key,"
-                            "preview_image_url,type,url,width,"
-                            "public_metrics,alt_text",
-            "expansions": "attachments.poll_ids,"
-                          "attachments.media_keys,author_id,"
-                          "entities.mentions.username,geo.place_id,"
-                          "in_reply_to_user_id,referenced_tweets.id,"
-                          "referenced_tweets.id.author_id",
-            "tweet.fields": "attachments,author_id,"
-                            "context_annotations,conversation_id,"
-                            "created_at,entities,"
-                            "geo,id,in_reply_to_user_id,lang,"
-                            "public_metrics,"
-                            "possibly_sensitive,referenced_tweets,"
-                            "source,text,"
-                            "withheld",
+    :param tweet_ids: IDs of the tweets to retrieve
+    :type tweet_ids: list
+    :returns: dict with the retrieved tweets indexed by ID. Tweets that
+        don't exist anymore (or are not visible) are left out
+    :rtype: dict
+    """
+    url = f"{self.twitter_base_url}/statuses/lookup.json"
+    tweet_ids = list(tweet_ids)
+    tweets = {}
+    for idx in range(0, len(tweet_ids), 100):
+        params = {
+            "id": ",".join(tweet_ids[idx:idx + 100]),
+            "include_entities": "true",
+            "include_ext_alt_text": "true",
+            "tweet_mode": "extended",
         }
-    )
+        response = self.twitter_api_request(
+            'GET',
+            url,
+            headers=self.header_twitter,
+            auth=self.auth,
+            params=params
+        )
+        if not response.ok:
+            response.raise_for_status()
+        for tweet in response.json():
+            tweets[tweet["id_str"]] = tweet
+    return tweets
+
+
+def _get_tweets_v2_page(self, url, start_time, count, next_token=None,
+                        since_id=None):
+    # Tweet number must be between 10 and 100 for search
+    diff = self.max_tweets - count
+    if count:
+        max_results = diff if diff < 100 else 100
+    else:
+        max_results = (
+            self.max_tweets if 100 > self.max_tweets > 10 else 100
+        )
+    # round up max_results to the nearest 10
+    max_results = (max_results + 9) // 10 * 10
+    params = {"max_results": max_results}
+    if next_token:
+        params.update({"pagination_token": next_token})
+    if since_id:
+        params.update({"since_id": since_id})
+    else:
+        params.update({"start_time": start_time})
+    params.update(TWEET_V2_PARAMS)
 
     response = self.twitter_api_request(
         'GET', url, headers=self.header_twitter, params=params, auth=self.auth
     )
     if not response.ok:
         response.raise_for_status()
+    return response.json()
 
-    if tweets_v2:
-        # TODO: Tidy up this mess
-        next_tweets = response.json()
 
-        includes = ["users", "tweets", "media", "polls"]
-        for include in includes:
-            try:
-                _ = tweets_v2["includes"][include]
-            except KeyError:
-                tweets_v2["includes"].update({include: []})
-            try:
-                _ = next_tweets["includes"][include]
-            except KeyError:
-                next_tweets["includes"].update({include: []})
-
-        for tweet in next_tweets["data"]:
-            tweets_v2["data"].append(tweet)
-        for user in next_tweets["includes"]["users"]:
-            tweets_v2["includes"]["users"].append(user)
-        for tweet_include in next_tweets["includes"]["tweets"]:
-            tweets_v2["includes"]["tweets"].append(tweet_include)
-        for media in next_tweets["includes"]["media"]:
-            tweets_v2["includes"]["media"].append(media)
-        for poll in next_tweets["includes"]["polls"]:
-            tweets_v2["includes"]["polls"].append(poll)
-        tweets_v2["meta"] = next_tweets["meta"]
-    else:
-        tweets_v2 = response.json()
-    if pbar:
-        pbar.update(response.json()["meta"]["result_count"])
-    try:
-        next_token = response.json()["meta"]["next_token"]
-        count += response.json()["meta"]["result_count"]
-        if next_token and next_token != previous_token:
-            self._get_tweets_v2(
-                start_time=start_time,
-                tweets_v2=tweets_v2,
-                next_token=next_token,
-                previous_token=previous_token,
-                count=count,
-                t_user=t_user,
-                pbar=pbar
-            )
-    except KeyError:
-        pass
-
-    return tweets_v2
+def _merge_tweets_v2(tweets_v2, next_tweets):
+    """Appends the tweets and includes of a page to the ones gathered so far,
+    in place"""
+    tweets_v2.setdefault("data", []).extend(next_tweets.get("data", []))
+    tweets_v2.setdefault("includes", {})
+    next_includes = next_tweets.get("includes", {})
+    for include in ("users", "tweets", "media", "polls"):
+        tweets_v2["includes"].setdefault(include, []).extend(
+            next_includes.get(include, [])
+        )
+    tweets_v2["meta"] = next_tweets["meta"]
 
 
 # @spinner(_("Gathering tweets... "))
-def get_tweets(self, start_time):
+def get_tweets(self, start_time=None):
+    """Gathers the tweets of every Twitter user of the account
+
+    If no start_time is given, only the tweets newer than the last mirrored
+    one (see get_since_id) are retrieved. Users without one fall back to the
+    date of the last post in the Fediverse account.
+
+    :param start_time: oldest date of the tweets to retrieve
+    :type start_time: str
+    :returns: tweets of every user merged
+    :rtype: dict
+    """
     from .i18n import _
     t_utweets = {}
     self.result_count = 0
@@ -783,8 +940,12 @@ def get_tweets(self, start_time):
         "data": [],
         "includes": {},
     }
+    use_cursor = start_time is None
     try:
         for t_user in self.twitter_username:
+            since_id = self.get_since_id(t_user) if use_cursor else None
+            if not since_id and start_time is None:
+                start_time = self.get_date_last_post()
             desc = _("Gathering tweets... ")
             fmt = '{desc}{n_fmt}'
             pbar = tqdm(desc=desc, position=0, total=10000, bar_format=fmt)
@@ -792,9 +953,12 @@ def get_tweets(self, start_time):
                 "v2",
                 start_time=start_time,
                 t_user=t_user,
-                pbar=pbar
+                pbar=pbar,
+                since_id=since_id
             )
             pbar.close()
+            for tweet in t_utweets[t_user].get("data", []):
+                self.tweet_sources[tweet["id"]] = t_user
             self.result_count += t_utweets[t_user]["meta"]["result_count"]
             tweets_merged["meta"] = {}
 
@@ -827,3 +991,51 @@ def get_tweets(self, start_time):
         pass
 
     return tweets_merged
+
+
+def spool_tweets(self, start_time=None):
+    """Gathers the tweets of every Twitter user of the account like
+    get_tweets, but every page retrieved is written to the 'pages' folder of
+    the temp path instead of being kept in memory
+
+    :param start_time: oldest date of the tweets to retrieve
+    :type start_time: str
+    :returns: paths of the pages, in the order they were retrieved (newest
+        tweets first)
+    :rtype: list
+    """
+    from .i18n import _
+    if not (3200 >= self.max_tweets >= 10):
+        error_msg = _(
+            "max_tweets must be between 10 and 3200. max_tweets: {}"
+        ).format(self.max_tweets)
+        raise ValueError(error_msg)
+    self.result_count = 0
+    pages_path = os.path.join(self.tweets_temp_path, "pages")
+    os.makedirs(pages_path, exist_ok=True)
+    page_paths = []
+    use_cursor = start_time is None
+    for t_user in self.twitter_username:
+        since_id = self.get_since_id(t_user) if use_cursor else None
+        if not since_id and start_time is None:
+            start_time = self.get_date_last_post()
+        desc = _("Gathering tweets... ")
+        fmt = '{desc}{n_fmt}'
+        pbar = tqdm(desc=desc, position=0, total=10000, bar_format=fmt)
+        pages = self._iter_tweets_v2(
+            start_time, t_user, pbar=pbar, since_id=since_id
+        )
+        for page in pages:
+            self.result_count += page["meta"]["result_count"]
+            if not page.get("data"):
+                continue
+            for tweet in page["data"]:
+                self.tweet_sources[tweet["id"]] = t_user
+            page_path = os.path.join(
+                pages_path, f"{len(page_paths):05d}.json"
+            )
+            with open(page_path, "w") as f:
+                json.dump(page, f)
+            page_paths.append(page_path)
+        pbar.close()
+    return page_paths
@@ -6,6 +6,7 @@ import json
 import string
 import random
 import shutil
+import hashlib
 import zipfile
 import tempfile
 import requests
@@ -20,7 +21,10 @@ from errno import ENOENT
 from multiprocessing import Queue, Pool
 from json.decoder import JSONDecodeError
 from datetime import datetime, timedelta
+from collections import deque
+from urllib.parse import urlsplit
 from itertools import tee, islice, chain, cycle
+from concurrent.futures import ThreadPoolExecutor
 from requests.structures import CaseInsensitiveDict
 from bs4 import BeautifulSoup, MarkupResemblesLocatorWarning
 
@@ -42,6 +46,7 @@ else:
 from .i18n import _
 from . import logger
 from ._error import TimeoutLocker
+from ._filters import TweetFilter, archive_filter_fields, rss_filter_fields
 
 
 def spinner(
@@ -99,10 +104,55 @@ def spinner(
 
 
 def chunkify(lst, n):
-    return [lst[i::n] for i in range(n)]
+    """Splits 'lst' in 'n' consecutive chunks of (almost) the same size,
+    so joining them in order gives back 'lst'
+    """
+    size, extra = divmod(len(lst), n)
+    chunks = []
+    start = 0
+    for idx in range(n):
+        end = start + size + (1 if idx < extra else 0)
+        chunks.append(lst[start:end])
+        start = end
+    return chunks
+
+
+def ordered_map(func, iterable, workers, window=None):
+    """Applies 'func' to the items of 'iterable' in a pool of threads
+
+    Results are yielded in the same order as the items, each one as soon
+    as it and every result before it are ready.
+
+    :param func: callable that receives an item
+    :type func: callable
+    :param iterable: items to process
+    :type iterable: iterable
+    :param workers: number of threads
+    :type workers: int
+    :param window: max number of items being processed or waiting to be
+        yielded at the same time, twice the number of threads by default
+    :type window: int
+    """
+    window = max(window or workers * 2, 1)
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        try:
+            for item in iterable:
+                pending.append(executor.submit(func, item))
+                if len(pending) >= window:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            # Stopped early (error or consumer gone), drop what's queued
+            for future in pending:
+                future.cancel()
 
 
 def process_parallel(tweets, user, threads):
+    if user.process_mode == "thread":
+        # Threads share the user, so there is nothing to pickle or merge
+        return user.process_tweets(tweets, workers=threads)
     dt = tweets["data"]
     chunks = chunkify(dt, threads)
     # mp = Multiprocessor()
@@ -117,8 +167,9 @@ def process_parallel(tweets, user, threads):
         ret = []
         desc = _("Processing tweets... ")
         with tqdm(total=len(dt), desc=desc) as pbar:
+            # Chunks are consecutive and come back in order
             for idx, res in enumerate(
-                    p.imap_unordered(user.process_tweets, tweets_chunked)
+                    p.imap(user.process_tweets, tweets_chunked)
             ):
                 pbar.update(len(chunks[idx]))
                 ret.append(res)
@@ -127,15 +178,11 @@ def process_parallel(tweets, user, threads):
         "data": [],
         "includes": tweets["includes"],
         "meta": tweets["meta"],
-        "media_processed": []
+        "media_processed": {}
     }
     for idx in range(threads):
         tweets_merged["data"].extend(ret[idx]["data"])
-        tweets_merged["media_processed"].extend(ret[idx]["media_processed"])
-    sort_key = "id" if not user.archive else "created_at"
-    tweets_merged["data"] = sorted(
-        tweets_merged["data"], key=lambda i: i[sort_key]
-    )
+        tweets_merged["media_processed"].update(ret[idx]["media_processed"])
     return tweets_merged
 
 
@@ -397,6 +444,80 @@ def check_pinned(self, posted=None):
         self.unpin(pinned_file)
 
 
+def _since_id_file(self, t_user) -> str:
+    # Kept per Fediverse account, several of them can mirror the same
+    # Twitter user
+    host = urlsplit(self.pleroma_base_url).netloc.replace(":", "_")
+    account = f"{self.pleroma_username}@{host}"
+    return os.path.join(self.user_path[t_user], account, "since_id.txt")
+
+
+def get_since_id(self, t_user):
+    """Returns the ID of the last tweet mirrored from the Twitter user to
+    this Fediverse account, if there is one stored
+
+    :param t_user: Twitter username
+    :type t_user: str
+    :returns: tweet ID or None
+    :rtype: str
+    """
+    since_id_file = _since_id_file(self, t_user)
+    if not os.path.isfile(since_id_file):
+        return None
+    with open(since_id_file, "r") as file:
+        since_id = file.readline().rstrip()
+    return since_id if since_id.isdigit() else None
+
+
+def update_since_id(self, tweet_id, t_user=None):
+    """Moves forward the last mirrored tweet of the Twitter user that posted
+    the tweet (or 't_user'). Older tweet IDs are ignored, and so are tweets
+    that couldn't be posted and the ones after them (see hold_since_id).
+
+    :param tweet_id: ID of the mirrored tweet
+    :type tweet_id: str
+    :param t_user: Twitter username
+    :type t_user: str
+    """
+    t_user = t_user or self.tweet_sources.get(tweet_id)
+    if t_user not in self.user_path or not str(tweet_id).isdigit():
+        return
+    held = self.since_id_holds.get(t_user)
+    if held is not None and int(tweet_id) >= int(held):
+        return
+    since_id = self.get_since_id(t_user)
+    if since_id is None or int(tweet_id) > int(since_id):
+        since_id_file = _since_id_file(self, t_user)
+        os.makedirs(os.path.dirname(since_id_file), exist_ok=True)
+        with open(since_id_file, "w") as file:
+            file.write(f"{tweet_id}\n")
+
+
+def update_since_ids(self):
+    """Moves forward the last mirrored tweet of every Twitter user to the
+    newest tweet gathered, including the ones filtered out when processing,
+    but not past a tweet that couldn't be posted
+    """
+    for tweet_id, t_user in self.tweet_sources.items():
+        self.update_since_id(tweet_id, t_user)
+
+
+def hold_since_id(self, tweet_id):
+    """Keeps the last mirrored tweet of the Twitter user that posted the
+    tweet from reaching it for the rest of the run, so it's gathered (and
+    posted) again on the next one
+
+    :param tweet_id: ID of the tweet that couldn't be posted
+    :type tweet_id: str
+    """
+    t_user = self.tweet_sources.get(tweet_id)
+    if t_user is None or not str(tweet_id).isdigit():
+        return
+    held = self.since_id_holds.get(t_user)
+    if held is None or int(tweet_id) < int(held):
+        self.since_id_holds[t_user] = tweet_id
+
+
 def replace_vars_in_str(self, text: str, var_name: str = None) -> str:
     """
     Returns a string with "{{ var_name }}" replaced with var_name's value
@@ -459,6 +580,23 @@ def guess_type(media_file: str) -> str:
     return mime_type
 
 
+def file_digest(file_path: str, algorithm: str = "sha256") -> str:
+    """Returns the hash of the content of a file
+
+    :param file_path: path of the file
+    :type file_path: str
+    :param algorithm: name of the hash algorithm (see hashlib)
+    :type algorithm: str
+    :returns: hex digest of the file
+    :rtype: str
+    """
+    digest = hashlib.new(algorithm)
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(2 ** 16), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
 def random_string(length: int) -> str:
     """Returns a string of random characters of length 'length'
     :param length: How long the string to return must be
@@ -478,14 +616,14 @@ def _get_instance_info(self):
     try:
         nodeinfo_json = None
         nodeinfo_url = f"{self.pleroma_base_url}/.well-known/nodeinfo"
-        response = requests.get(nodeinfo_url)
+        response = self.http.get(nodeinfo_url)
         if not response.ok:
             response.raise_for_status()
         nodeinfo = response.json()
         for lnk in nodeinfo["links"]:
             if lnk["rel"] == "http://nodeinfo.diaspora.software/ns/schema/2.0":
                 nodeinfo_json_url = lnk["href"]
-                response = requests.get(nodeinfo_json_url, headers={})
+                response = self.http.get(nodeinfo_json_url, headers={})
                 if not response.ok:
                     response.raise_for_status()  # pragma
                 nodeinfo_json = response.json()
@@ -493,6 +631,11 @@ def _get_instance_info(self):
         if hasattr(self, "software"):
             if self.software:
                 self.instance = self.software
+        # Pleroma and Akkoma publish their upload limit
+        if nodeinfo_json and "metadata" in nodeinfo_json:
+            upload_limits = nodeinfo_json["metadata"].get("uploadLimits")
+            if upload_limits and upload_limits.get("general"):
+                self.upload_limits = {"default": upload_limits["general"]}
         if self.instance not in known_software:
             logger.info(_(
                 "Software on target instance ({}) not recognized."
@@ -521,7 +664,7 @@ def _get_instance_info(self):
         self.characters_reserved_per_url = 23
         self.max_video_attachments = 1
         instance_url = f"{self.pleroma_base_url}/api/v1/instance"
-        response = requests.get(instance_url)
+        response = self.http.get(instance_url)
         instance_url_json = None
         if response.ok:
             instance_url_json = response.json()
@@ -540,6 +683,17 @@ def _get_instance_info(self):
                 if "characters_reserved_per_url" in statuses_conf:
                     chars_url = statuses_conf["characters_reserved_per_url"]
                     self.characters_reserved_per_url = chars_url
+            if "media_attachments" in instance_url_json["configuration"]:
+                media_conf = instance_url_json["configuration"][
+                    "media_attachments"
+                ]
+                for media_type in ("image", "video"):
+                    size_limit = media_conf.get(f"{media_type}_size_limit")
+                    if size_limit:
+                        self.upload_limits[media_type] = size_limit
+                if "supported_mime_types" in media_conf:
+                    mime_types = media_conf["supported_mime_types"]
+                    self.supported_mime_types = frozenset(mime_types)
 
 
 def mastodon_enforce_limits(self):
@@ -695,6 +849,7 @@ def process_archive(self, archive_zip_path, start_time=None):
     if not os.path.isdir(tweet_media_path):
         tweet_media_path = os.path.join(extracted_dir, 'data', 'tweets_media')
     tweets_archive = get_tweets_from_archive(tweet_js_path)
+    tweet_filter = TweetFilter.from_user(self)
     tweets = {
         "data": [],
         "includes": {
@@ -714,6 +869,9 @@ def process_archive(self, archive_zip_path, start_time=None):
         if start_time:
             if created_at_f < start_time:
                 continue
+        # Skip filtered tweets before copying their media
+        if not tweet_filter.accepts(archive_filter_fields(tweet["tweet"])):
+            continue
         tweet["tweet"]["text"] = tweet["tweet"]["full_text"]
         tweet["tweet"]["created_at"] = created_at_f
         if "possibly_sensitive" not in tweet["tweet"].keys():
@@ -769,16 +927,30 @@ def _get_account_info_from_archive(account_js_path):
     return json_p["account"]
 
 
+def index_media(media, key="media_key", index=None) -> dict:
+    """Groups media items by their media key
+
+    :param media: media items to add to the index
+    :type media: list
+    :param key: name of the field used as key
+    :type key: str
+    :param index: existing index to add the items to
+    :type index: dict
+    :returns: media key -> list of media items
+    :rtype: dict
+    """
+    index = {} if index is None else index
+    for item in media:
+        index.setdefault(item[key], []).append(item)
+    return index
+
+
 def post(self, tweet: tuple, poll, sensitive, media=None, cw=None) -> str:
     post_id = None
     instance = self.instance
-    if media:
+    if media and not isinstance(media, dict):
         media_id = 'id' if (self.archive or self.rss) else 'media_key'
-        media = {
-            key: [
-                l_item for l_item in media if l_item[media_id] == key
-            ] for key in set([i[media_id] for i in media])
-        }
+        media = index_media(media, media_id)
     if instance == "mastodon" or instance == "pleroma" or instance is None:
         post_id = self.post_pleroma(tweet, poll, sensitive, media, cw=cw)
     elif self.instance == "misskey":
@@ -851,9 +1023,7 @@ def parse_rss_feed(self, rss_link, start_time, threads=1):  # pragma: todo
             desc = _("Processing tweets... ")
             with tqdm(total=len(dt), desc=desc) as pbar:
                 for idx, res in enumerate(
-                        p.imap_unordered(
-                            self._process_tweets_rss, chunks
-                        )
+                        p.imap(self._process_tweets_rss, chunks)
                 ):
                     pbar.update(len(chunks[idx]))
                     ret.append(res)
@@ -861,16 +1031,13 @@ def parse_rss_feed(self, rss_link, start_time, threads=1):  # pragma: todo
         tweets_merged = {
             "data": [],
             "meta": tweets["meta"],
-            "media_processed": []
+            "media_processed": {}
         }
         for idx in range(threads):
             tweets_merged["data"].extend(ret[idx]["data"])
-            tweets_merged["media_processed"].extend(
+            tweets_merged["media_processed"].update(
                 ret[idx]["media_processed"]
             )
-        tweets_merged["data"] = sorted(
-            tweets_merged["data"], key=lambda i: i["id"]
-        )
         tweets = tweets_merged
     else:
         tweets = self._process_tweets_rss(d.entries)
@@ -881,12 +1048,13 @@ def _process_tweets_rss(self, entries):  # pragma: todo
     start_time = self.start_time
     tweets = {
         "data": [],
-        "media_processed": [],
+        "media_processed": {},
         "meta": []
     }
     if self.threads == 1:
         desc = _("Processing tweets... ")
         pbar = tqdm(total=len(entries), desc=desc)
+    tweet_filter = TweetFilter.from_user(self)
     for item in entries[:self.max_tweets]:
         created_at = datetime.strftime(
             datetime.strptime(item.published, "%a, %d %b %Y %H:%M:%S %Z"),
@@ -906,22 +1074,11 @@ def _process_tweets_rss(self, entries):  # pragma: todo
             soup.p.unwrap()
         # title_detail includes RT or reply header
         # but only summary_details includes links to media
-        if not self.include_rts:
-            if (
-                    soup.prettify().startswith('RT ')
-                    or soup_title.prettify().startswith('RT ')
-            ):
-                continue
-        if not self.include_replies:
-            if (
-                    soup.prettify().startswith('@')
-                    or soup.prettify().startswith('Re @')
-                    or soup.prettify().startswith('R to @')
-                    or soup_title.prettify().startswith('@')
-                    or soup_title.prettify().startswith('Re @')
-                    or soup_title.prettify().startswith('R to @')
-            ):
-                continue
+        filter_fields = rss_filter_fields(
+            soup.prettify(), soup_title.prettify()
+        )
+        if not tweet_filter.accepts(filter_fields):
+            continue
 
         tweet_id = item.id.strip('#m').split('/')[-1]
 
@@ -1051,7 +1208,7 @@ def _process_tweets_rss(self, entries):  # pragma: todo
                 tweet_path = os.path.join(self.tweets_temp_path, tweet_id)
                 os.makedirs(tweet_path, exist_ok=True)
                 self._download_media(media, data)
-                tweets["media_processed"].extend(media)
+                index_media(media, "id", tweets["media_processed"])
         if self.threads == 1:
             pbar.update(1)
     return tweets
@@ -1104,7 +1261,7 @@ def _get_guest_token_header(self):  # pragma: todo
     )
     headers['User-Agent'] = user_agent
     headers.update({"user-agent": user_agent})
-    response = requests.post(guest_url, headers=headers, stream=True)
+    response = self.http.post(guest_url, headers=headers, stream=True)
     if not response.ok:
         if self.proxy and response.status_code == 429:
             logger.warning(
@@ -1139,7 +1296,7 @@ def _request_proxy(
         verify=None, cert=None, json=None
 ):  # pragma: todo
     if not self.pool_iter:
-        response = requests.get('https://www.sslproxies.org/')
+        response = self.http.get('https://www.sslproxies.org/')
         matches = re.findall(
             r"<td>\d+.\d+.\d+.\d+</td><td>\d+</td>", response.text
         )
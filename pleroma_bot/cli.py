@@ -34,10 +34,14 @@ import time
 import json
 import yaml
 import shutil
+import asyncio
 import logging
 import argparse
+import threading
 import multiprocessing as mp
 
+from concurrent.futures import ThreadPoolExecutor
+
 from tqdm import tqdm
 from random import shuffle
 from itertools import cycle
@@ -47,14 +51,27 @@ from requests.structures import CaseInsensitiveDict
 from .i18n import _
 from . import logger
 from .__init__ import __version__
+from ._async import AsyncEngine
+from ._session import close_registries, get_registry
+from ._ratelimit import get_rate_limiter
+from ._cache import get_cache
+from ._media import MediaDownloader, get_media_cache
+from ._processing import parse_size
 from ._utils import config_wizard
 from ._utils import process_parallel, Locker
 
+_posts_lock = threading.Lock()
+
 
 class User(object):
     from ._twitter import get_tweets
+    from ._twitter import spool_tweets
     from ._twitter import _get_tweets
     from ._twitter import _get_tweets_v2
+    from ._twitter import _iter_tweets_v2
+    from ._twitter import _get_tweets_by_ids
+    from ._twitter import _get_tweets_v1_by_ids
+    from ._twitter import _get_twitter_user_id
     from ._twitter import _get_twitter_info
     from ._twitter import _get_tweets_guest
     from ._twitter import twitter_api_request
@@ -99,6 +116,10 @@ class User(object):
     from ._utils import process_archive
     from ._utils import check_date_format
     from ._utils import _get_instance_info
+    from ._utils import get_since_id
+    from ._utils import update_since_id
+    from ._utils import update_since_ids
+    from ._utils import hold_since_id
     from ._utils import get_date_last_post
     from ._utils import _update_bot_status
     from ._utils import _process_tweets_rss
@@ -108,14 +129,15 @@ class User(object):
     from ._utils import mastodon_enforce_limits
 
     from ._processing import process_tweets
+    from ._processing import iter_processed_tweets
 
     from ._processing import _expand_urls
     from ._processing import _replace_url
     from ._processing import _get_media_url
     from ._processing import _process_polls
+    from ._processing import _prefetch_polls
     from ._processing import _download_media
     from ._processing import _replace_mentions
-    from ._processing import _custom_replacements
     from ._processing import _get_best_bitrate_video
 
     def __init__(self, user_cfg: dict, cfg: dict, base_path: str, posts_ids):
@@ -128,10 +150,19 @@ class User(object):
         self.profile_banner_url = {}
         self.t_user_tweets = {}
         self.twitter_ids = {}
+        self.twitter_pinned_ids = {}
+        self.extended_media = {}
+        self.tweet_sources = {}
+        # Oldest tweet that couldn't be posted, by Twitter user
+        self.since_id_holds = {}
         self.posts_ids = posts_ids
         self.instance = ""
         self.max_attachments = 16
         self.max_video_attachments = None
+        # Max size (in bytes) of attachments by type (or "default") and
+        # MIME types accepted by the instance, when it publishes them
+        self.upload_limits = {}
+        self.supported_mime_types = None
         self.proxy = True
         self.pool_iter = None
         self.software = None
@@ -183,6 +214,23 @@ class User(object):
             "content_warnings": {},
             "custom_replacements": {},
             "software": None,
+            "pool_connections": 10,
+            "pool_maxsize": 10,
+            "http_timeout": [10, 120],
+            "host_concurrency": None,
+            "twitter_id_ttl": 86400,
+            "url_cache_ttl": 604800,
+            "url_cache_negative_ttl": 3600,
+            "url_cache_size": 10000,
+            "url_workers": 8,
+            "process_mode": "thread",
+            "pipeline_depth": 16,
+            "streaming": False,
+            "media_workers": 4,
+            "media_retries": 2,
+            "media_cache_size": 0,
+            "media_ids_ttl": 86400,
+            "media_relay": False,
         }
         # iterate attrs defined in config
         for attribute in default_cfg_attributes:
@@ -212,6 +260,16 @@ class User(object):
             bio_text = self.replace_vars_in_str(str(self.bio_text))
             self.bio_text = {"_generic_bio_text": bio_text}
 
+        # Keep-alive connection pools shared by users with the same settings
+        self.http = get_registry(
+            self.pool_connections,
+            self.pool_maxsize,
+            self.http_timeout,
+            self.host_concurrency,
+        )
+        # Twitter API budget per endpoint, shared by users in this process
+        self.rate_limits = get_rate_limiter()
+
         # Auth
         self.header_pleroma = {"Authorization": f"Bearer {self.pleroma_token}"}
         self.header_twitter = {"Authorization": f"Bearer {self.twitter_token}"}
@@ -254,6 +312,32 @@ class User(object):
         self.base_path = base_path
         self.users_path = os.path.join(self.base_path, "users")
         self.tweets_temp_path = os.path.join(self.base_path, "tweets")
+        # Expanded short links, shared by every user in the same base path
+        self.url_cache = get_cache(
+            os.path.join(self.base_path, "url_cache.json"),
+            ttl=self.url_cache_ttl,
+            max_entries=self.url_cache_size,
+        )
+        # IDs of the media uploaded to the Fediverse, by account and hash
+        self.media_id_cache = get_cache(
+            os.path.join(self.base_path, "media_ids.json"),
+            ttl=self.media_ids_ttl,
+        )
+        # Downloaded media, shared by every user in the same base path
+        self.media_cache = None
+        if self.media_cache_size:
+            self.media_cache = get_media_cache(
+                os.path.join(self.base_path, "media_cache"),
+                parse_size(str(self.media_cache_size)),
+            )
+        self.media_downloader = MediaDownloader(
+            self.http,
+            self.media_workers,
+            self.media_retries,
+            cache=self.media_cache,
+        )
+        # Media streamed to the instance when posting, by tweet ID
+        self.relayed_media = {}
         if self.pleroma_base_url not in self.posts_ids:
             self.posts_ids[self.pleroma_base_url] = {}
         self.user_path = {}
@@ -284,7 +368,11 @@ class User(object):
             # Get Twitter info on instance creation
             self._get_twitter_info()
             if not self.archive and not self.guest:
-                self.pinned_tweet_id = self._get_pinned_tweet_id()
+                t_user = self.twitter_username[0]
+                if t_user in self.twitter_pinned_ids:
+                    self.pinned_tweet_id = self.twitter_pinned_ids[t_user]
+                else:  # pragma: todo
+                    self.pinned_tweet_id = self._get_pinned_tweet_id()
         if self.instance == "mastodon":  # pragma
             self.mastodon_enforce_limits()
         self.website = self.website if self.website else ""
@@ -454,6 +542,22 @@ def get_args(sysargs):
         ),
     )
 
+    parser.add_argument(
+        "-e",
+        "--engine",
+        required=False,
+        action="store",
+        choices=["sync", "asyncio"],
+        default="sync",
+        help=(
+            _(
+                "execution engine to use. 'sync' (default) processes one "
+                "user after another, 'asyncio' runs every user concurrently "
+                "from an event loop, each one in its own worker thread."
+            )
+        ),
+    )
+
     parser.add_argument("--verbose", "-v", action="count", default=0)
 
     parser.add_argument(
@@ -464,6 +568,466 @@ def get_args(sysargs):
     return args
 
 
+def _setup_user(user_item, config, args, base_path, posts_ids):
+    """Creates the User for a config entry and figures out the date to start
+    retrieving tweets from. Can prompt for input, so it's always run
+    sequentially.
+
+    :returns: user and date
+    :rtype: tuple
+    """
+    first_time = False
+    logger.info("======================================")
+    logger.info(
+        _(
+            "Processing user:\t{}"
+        ).format(user_item["pleroma_username"])
+    )
+    users_path = os.path.join(base_path, "users")
+    t_users = user_item["twitter_username"]
+    t_user_list = isinstance(t_users, list)
+    t_users = t_users if t_user_list else [t_users]
+    for t_user in t_users:
+        user_path = os.path.join(users_path, t_user)
+
+        if not os.path.exists(user_path):
+            first_time_msg = _(
+                "It seems like pleroma-bot is running for the "
+                "first time for this Twitter user: {}"
+            ).format(t_user)
+            logger.info(first_time_msg)
+            first_time = True
+    user = User(user_item, config, base_path, posts_ids)
+    if args.threads:  # pragma: todo
+        threads = int(args.threads)
+    else:
+        cores = mp.cpu_count()
+        threads = round(cores / 2 if cores > 4 else 4)
+    user.threads = threads
+    if first_time and not args.skipChecks and not args.forceDate:
+        user.first_time = True
+    if (
+            (args.forceDate
+             and args.forceDate in user.twitter_username)
+            or args.forceDate == "all"
+            or user.first_time
+    ) and not args.skipChecks:
+        date_fedi = user.force_date()
+    elif args.forceDate and user.check_date_format(args.forceDate):
+        date_fedi = user.transform_date(args.forceDate)
+    else:
+        if args.forceDate:
+            if not user.check_date_format(args.forceDate):
+                raise Exception(
+                    _('Invalid forceDate format, use "YYYY-mm-dd"')
+                )
+        use_cursor = not (user.tweet_ids or user.archive or user.rss) and all(
+            user.get_since_id(t_user) for t_user in user.twitter_username
+        )
+        if use_cursor:
+            # Continue from the last mirrored tweet, no need to check the
+            # date of the last post in the Fediverse account
+            date_fedi = None
+        else:
+            date_fedi = user.get_date_last_post()
+    return user, date_fedi
+
+
+def _fetch_tweets(user, date_fedi) -> dict:
+    if user.tweet_ids:
+        tweets = {
+            "data": [],
+            "includes": {},
+            "meta": {"result_count": len(user.tweet_ids)},
+        }
+        user.result_count = len(user.tweet_ids)
+        includes = ["users", "tweets", "media", "polls"]
+        for include in includes:
+            try:
+                _include = tweets["includes"][include]
+            except KeyError:
+                tweets["includes"].update({include: []})
+        for tweet_id in user.tweet_ids:
+            next_tweet = user._get_tweets("v2", tweet_id=tweet_id)
+            if not next_tweet:  # pragma: todo
+                continue
+            includes = ["users", "tweets", "media", "polls"]
+            for include in includes:
+                try:
+                    _include = next_tweet["includes"][include]
+                    _include = _include
+                except KeyError:
+                    next_tweet["includes"].update({include: []})
+            tweets["data"].append(next_tweet["data"])
+            for user_tweet in next_tweet["includes"]["users"]:
+                tweets["includes"]["users"].append(user_tweet)
+            for tweet_include in next_tweet["includes"]["tweets"]:
+                tweets["includes"]["tweets"].append(tweet_include)
+            for media in next_tweet["includes"]["media"]:
+                tweets["includes"]["media"].append(media)
+            for poll in next_tweet["includes"]["polls"]:
+                tweets["includes"]["polls"].append(poll)
+    elif user.archive:
+        tweets = user.process_archive(
+            user.archive, start_time=date_fedi
+        )
+        user.result_count = len(tweets["data"])
+    elif user.rss:  # pragma: todo
+        rss_msg = _("\nUsing RSS feed. The following features "
+                    "will not be available: \n- Profile "
+                    "update\n- Pinned tweets\n- Polls")
+        logger.debug(rss_msg)
+        tweets = user.parse_rss_feed(
+            user.rss, start_time=date_fedi, threads=user.threads
+        )
+        user.result_count = len(tweets["data"])
+    else:
+        tweets = user.get_tweets(start_time=date_fedi)
+    if not user.rss and tweets.get("data"):
+        # Newest first, as the timeline of a single user is returned, so the
+        # tweets of several users (or tweet_ids) are posted in order
+        if user.archive:
+            tweets["data"].sort(key=lambda i: i["created_at"], reverse=True)
+        else:
+            tweets["data"].sort(key=lambda i: int(i["id"]), reverse=True)
+    # Don't format the whole batch unless it's going to be logged
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(f"tweets: \t {tweets}")
+
+    if "meta" not in tweets:
+        error_msg = _(
+            "Unable to retrieve tweets. Is the account protected?"
+            " If so, you need to provide the following OAuth 1.0a"
+            " fields in the user config:\n - consumer_key \n "
+            "- consumer_secret \n - access_token_key \n "
+            "- access_token_secret"
+        )
+        logger.error(error_msg)
+    return tweets
+
+
+def _process_fetched(user, tweets, threads) -> dict:
+    logger.info(
+        _("tweets gathered: \t {}").format(len(tweets["data"]))
+    )
+    # Put oldest first to iterate them and post them in order
+    tweets["data"].reverse()
+    if user.rss:  # pragma: todo
+        tweets_to_post = tweets
+    else:
+        if threads > 1:
+            tweets_to_post = process_parallel(
+                tweets, user, threads
+            )
+        else:  # pragma: todo
+            tweets_to_post = user.process_tweets(tweets)
+    logger.info(
+        _("tweets to post: \t {}").format(
+            len(tweets_to_post['data'])
+        )
+    )
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(
+            f"tweets_processed: \t {tweets_to_post['data']}"
+        )
+    return tweets_to_post
+
+
+def _pipeline_fetched(user, tweets, threads) -> tuple:
+    """Starts processing the gathered tweets in the background, so they can
+    be posted while the following ones are still being processed.
+
+    At most 'pipeline_depth' tweets are processed ahead of the one being
+    posted. When it's 0 (or tweets are processed in separate processes)
+    every tweet is processed before returning, like _process_fetched.
+
+    :returns: tweets to post and an iterator over them, in posting order,
+        that yields each one once it's processed
+    :rtype: tuple
+    """
+    depth = int(user.pipeline_depth or 0)
+    threaded = threads <= 1 or user.process_mode == "thread"
+    if user.rss or not depth or not threaded:
+        tweets_to_post = _process_fetched(user, tweets, threads)
+        return tweets_to_post, iter(tweets_to_post["data"])
+    logger.info(
+        _("tweets gathered: \t {}").format(len(tweets["data"]))
+    )
+    # Put oldest first to iterate them and post them in order
+    tweets["data"].reverse()
+    processed = user.iter_processed_tweets(
+        tweets, workers=threads, window=depth
+    )
+    logger.info(
+        _("tweets to post: \t {}").format(len(tweets["data"]))
+    )
+    return tweets, processed
+
+
+def _post_args(tweet, media_processed) -> tuple:
+    try:
+        reply_id = tweet["reply_id"]
+    except KeyError:  # pragma: todo
+        reply_id = None
+    try:
+        retweet_id = tweet["retweet_id"]
+    except KeyError:  # pragma: todo
+        retweet_id = None
+    return (
+        (
+            tweet["id"],
+            tweet["text"],
+            tweet["created_at"],
+            reply_id,
+            retweet_id
+        ),
+        tweet["polls"],
+        tweet["possibly_sensitive"],
+        media_processed,
+    )
+
+
+def _save_posts(posts_path, posts_ids):
+    # Users of the same instance share (and keep updating) the same dict,
+    # take a shallow snapshot before serializing it
+    with _posts_lock:
+        snapshot = {
+            key: dict(value) if isinstance(value, dict) else value
+            for key, value in list(posts_ids.items())
+        }
+        with open(posts_path, "r+") as f:
+            f.write(json.dumps(snapshot, indent=4))
+
+
+def _finish_user(user, posted, args):
+    try:
+        # Everything gathered was either posted or filtered out
+        user.update_since_ids()
+        files, size = user.media_downloader.summary()
+        if files:
+            logger.info(
+                _("media downloaded: \t {} files ({}MB)").format(
+                    files, round(size / 2 ** 20, 2)
+                )
+            )
+        if not user.skip_pin:
+            user.check_pinned(posted)
+
+        if not (user.no_profile or args.noProfile):
+            if user.skip_profile:
+                logger.warning(
+                    _("Multiple twitter users, not updating profile")
+                )
+            else:
+                user.update_profile()
+        # Clean-up
+        shutil.rmtree(user.tweets_temp_path)
+    finally:
+        # Saved last, the pinned tweet is posted (and its media uploaded)
+        # when checking it and the bio and website are expanded when
+        # updating the profile
+        user.url_cache.save()
+        user.media_id_cache.save()
+        if user.media_cache is not None:
+            user.media_cache.save()
+
+
+def _has_content(user, tweet) -> bool:
+    # Whether posting the tweet should result in a post, checked before
+    # posting it
+    if tweet["text"] or tweet["polls"] or tweet["id"] in user.relayed_media:
+        return True
+    tweet_folder = os.path.join(user.tweets_temp_path, tweet["id"])
+    return os.path.isdir(tweet_folder) and len(os.listdir(tweet_folder)) > 0
+
+
+def _update_cursor(user, tweet, post_id, has_content):
+    if post_id is None and has_content:
+        # Posting it failed (e.g. its media couldn't be uploaded), keep it
+        # to be gathered again on the next run
+        user.hold_since_id(tweet["id"])
+    user.update_since_id(tweet["id"])
+
+
+def _post_tweets(user, tweets_to_post, processed, posts_path, posted):
+    tweet_counter = 0
+    desc = _("Posting tweets... ")
+    pbar = tqdm(total=len(tweets_to_post["data"]), desc=desc)
+    for tweet in processed:
+        tweet_counter += 1
+        logger.debug(
+            f"({tweet_counter}/{len(tweets_to_post['data'])})"
+        )
+        post_args = _post_args(tweet, tweets_to_post["media_processed"])
+        has_content = _has_content(user, tweet)
+        post_id = user.post(*post_args, cw=tweet["cw"])
+        posted[tweet["id"]] = post_id
+        _save_posts(posts_path, user.posts_ids)
+        _update_cursor(user, tweet, post_id, has_content)
+        # Media of posted tweets is no longer needed
+        shutil.rmtree(
+            os.path.join(user.tweets_temp_path, tweet["id"]),
+            ignore_errors=True
+        )
+        pbar.update(1)
+        time.sleep(user.delay_post)
+    pbar.close()
+
+
+def _streams(user) -> bool:
+    # Only timelines from the v2 API are paginated. The pages of several
+    # Twitter users would be posted one user after the other, instead of in
+    # the order they were tweeted
+    return bool(user.streaming) and not (
+        user.tweet_ids or user.archive or user.rss or user.guest
+        or len(user.twitter_username) > 1
+    )
+
+
+def _load_page(page_path) -> dict:
+    with open(page_path, "r") as f:
+        page = json.load(f)
+    os.remove(page_path)
+    page.setdefault("includes", {})
+    for include in ("users", "tweets", "media", "polls"):
+        page["includes"].setdefault(include, [])
+    return page
+
+
+def _run_user_streaming(user, date_fedi, args, posts_path):
+    """Gathers, processes and posts the tweets of a user one page at a time,
+    so only a page of tweets (and their media) is held at once.
+
+    Pages are written to disk while gathering and then processed from the
+    oldest one, to keep posting the tweets in order.
+    """
+    page_paths = user.spool_tweets(start_time=date_fedi)
+    posted = None
+    if user.result_count > 0:
+        posted = {}
+        for page_path in reversed(page_paths):
+            tweets = _load_page(page_path)
+            tweets_to_post, processed = _pipeline_fetched(
+                user, tweets, user.threads
+            )
+            _post_tweets(user, tweets_to_post, processed, posts_path, posted)
+    _finish_user(user, posted, args)
+
+
+def _run_user(user, date_fedi, args, posts_path):
+    if _streams(user):
+        return _run_user_streaming(user, date_fedi, args, posts_path)
+    tweets = _fetch_tweets(user, date_fedi)
+    posted = None
+    if user.result_count > 0:
+        tweets_to_post, processed = _pipeline_fetched(
+            user, tweets, user.threads
+        )
+        posted = {}
+        _post_tweets(user, tweets_to_post, processed, posts_path, posted)
+    _finish_user(user, posted, args)
+
+
+def _setup_users(user_dict, config, args, base_path, posts_ids):
+    """Sets up every user of the config before running them concurrently.
+
+    :returns: list of (user, date) tuples and the exit code of the setup
+    :rtype: tuple
+    """
+    exit_code = 0
+    users = []
+    for idx, user_item in enumerate(user_dict):
+        try:
+            user, date_fedi = _setup_user(
+                user_item, config, args, base_path, posts_ids
+            )
+            # Every user gets its own temp folder, as they run at the same time
+            user.tweets_temp_path = os.path.join(
+                user.tweets_temp_path, str(idx)
+            )
+            os.makedirs(user.tweets_temp_path, exist_ok=True)
+            users.append((user, date_fedi))
+        except Exception:
+            logger.error(
+                _(
+                    "Exception occurred for user, skipping..."
+                ), exc_info=True
+            )
+            exit_code = 1
+    return users, exit_code
+
+
+def _log_results(users, results) -> int:
+    exit_code = 0
+    for (user, _date_fedi), result in zip(users, results):
+        if isinstance(result, Exception):
+            logger.error(
+                _(
+                    "Exception occurred for user, skipping..."
+                ), exc_info=result
+            )
+            exit_code = 1
+    return exit_code
+
+
+def _run_threaded(users, args, posts_path, user_workers, instance_limit):
+    """Runs the cycle of several users at the same time in a thread pool,
+    with at most 'instance_limit' users of the same Fediverse instance
+    running at once.
+
+    :returns: result (or raised exception) of every user, in order
+    :rtype: list
+    """
+    limits = {
+        user.pleroma_base_url: threading.BoundedSemaphore(instance_limit)
+        for user, _date_fedi in users
+    }
+
+    def run(user, date_fedi):
+        with limits[user.pleroma_base_url]:
+            # Users are already processed concurrently, skip the process pool
+            user.threads = 1
+            return _run_user(user, date_fedi, args, posts_path)
+
+    with ThreadPoolExecutor(max_workers=user_workers) as executor:
+        futures = [
+            executor.submit(run, user, date_fedi)
+            for user, date_fedi in users
+        ]
+    return [future.exception() or future.result() for future in futures]
+
+
+def _run_asyncio(users, args, posts_path, user_workers, instance_limit):
+    """Runs the cycle of every user concurrently in an event loop, with at
+    most 'user_workers' users in total (unbounded if None) and
+    'instance_limit' users of the same Fediverse instance running at once.
+
+    :returns: result (or raised exception) of every user, in order
+    :rtype: list
+    """
+    # A thread for every user that can be running at once, so users waiting
+    # (e.g. for a rate limit) don't hold back the rest
+    engine = AsyncEngine(max_workers=max(user_workers or len(users), 1))
+    limits = {}
+
+    async def run(user, date_fedi):
+        # Semaphores are created inside the loop that is going to use them
+        if "all" not in limits:
+            limits["all"] = asyncio.Semaphore(user_workers or len(users))
+            for base_url in set(u.pleroma_base_url for u, _d in users):
+                limits[base_url] = asyncio.Semaphore(instance_limit)
+        async with limits["all"], limits[user.pleroma_base_url]:
+            # Users are already processed concurrently, skip the process pool
+            user.threads = 1
+            return await engine.run_blocking(
+                _run_user, user, date_fedi, args, posts_path
+            )
+
+    return engine.run(
+        [run(user, date_fedi) for user, date_fedi in users]
+    )
+
+
 def main():
     exit_code = 0
     # Convert legacy flag to proper flag format
@@ -509,7 +1073,6 @@ def main():
         if random_user_order:
             shuffle(user_dict)
 
-        users_path = os.path.join(base_path, "users")
         for user_item in user_dict[:]:
             user_item["skip_pin"] = False
             if args.noProfile:  # pragma: todo
@@ -531,199 +1094,45 @@ def main():
                 user_item["skip_pin"] = True
                 user_item["archive"] = args.archive
 
-        for user_item in user_dict:
-            try:
-                first_time = False
-                logger.info("======================================")
-                logger.info(
-                    _(
-                        "Processing user:\t{}"
-                    ).format(user_item["pleroma_username"])
-                )
-                t_users = user_item["twitter_username"]
-                t_user_list = isinstance(t_users, list)
-                t_users = t_users if t_user_list else [t_users]
-                for t_user in t_users:
-                    user_path = os.path.join(users_path, t_user)
-
-                    if not os.path.exists(user_path):
-                        first_time_msg = _(
-                            "It seems like pleroma-bot is running for the "
-                            "first time for this Twitter user: {}"
-                        ).format(t_user)
-                        logger.info(first_time_msg)
-                        first_time = True
-                user = User(user_item, config, base_path, posts_ids)
-                if args.threads:  # pragma: todo
-                    threads = int(args.threads)
-                else:
-                    cores = mp.cpu_count()
-                    threads = round(cores / 2 if cores > 4 else 4)
-                user.threads = threads
-                if first_time and not args.skipChecks and not args.forceDate:
-                    user.first_time = True
-                if (
-                        (args.forceDate
-                         and args.forceDate in user.twitter_username)
-                        or args.forceDate == "all"
-                        or user.first_time
-                ) and not args.skipChecks:
-                    date_fedi = user.force_date()
-                elif args.forceDate and user.check_date_format(args.forceDate):
-                    date_fedi = user.transform_date(args.forceDate)
-                else:
-                    if args.forceDate:
-                        if not user.check_date_format(args.forceDate):
-                            raise Exception(
-                                _('Invalid forceDate format, use "YYYY-mm-dd"')
-                            )
-                    date_fedi = user.get_date_last_post()
-
-                if user.tweet_ids:
-                    tweets = {
-                        "data": [],
-                        "includes": {},
-                        "meta": {"result_count": len(user.tweet_ids)},
-                    }
-                    user.result_count = len(user.tweet_ids)
-                    includes = ["users", "tweets", "media", "polls"]
-                    for include in includes:
-                        try:
-                            _include = tweets["includes"][include]
-                        except KeyError:
-                            tweets["includes"].update({include: []})
-                    for tweet_id in user.tweet_ids:
-                        next_tweet = user._get_tweets("v2", tweet_id=tweet_id)
-                        if not next_tweet:  # pragma: todo
-                            continue
-                        includes = ["users", "tweets", "media", "polls"]
-                        for include in includes:
-                            try:
-                                _include = next_tweet["includes"][include]
-                                _include = _include
-                            except KeyError:
-                                next_tweet["includes"].update({include: []})
-                        tweets["data"].append(next_tweet["data"])
-                        for user_tweet in next_tweet["includes"]["users"]:
-                            tweets["includes"]["users"].append(user_tweet)
-                        for tweet_include in next_tweet["includes"]["tweets"]:
-                            tweets["includes"]["tweets"].append(tweet_include)
-                        for media in next_tweet["includes"]["media"]:
-                            tweets["includes"]["media"].append(media)
-                        for poll in next_tweet["includes"]["polls"]:
-                            tweets["includes"]["polls"].append(poll)
-                elif user.archive:
-                    tweets = user.process_archive(
-                        user.archive, start_time=date_fedi
-                    )
-                    user.result_count = len(tweets["data"])
-                elif user.rss:  # pragma: todo
-                    rss_msg = _("\nUsing RSS feed. The following features "
-                                "will not be available: \n- Profile "
-                                "update\n- Pinned tweets\n- Polls")
-                    logger.debug(rss_msg)
-                    tweets_rss = user.parse_rss_feed(
-                        user.rss, start_time=date_fedi, threads=user.threads
-                    )
-                    tweets = tweets_rss
-                    user.result_count = len(tweets_rss["data"])
-                else:
-                    tweets = user.get_tweets(start_time=date_fedi)
-                logger.debug(f"tweets: \t {tweets}")
-
-                if "meta" not in tweets:
-                    error_msg = _(
-                        "Unable to retrieve tweets. Is the account protected?"
-                        " If so, you need to provide the following OAuth 1.0a"
-                        " fields in the user config:\n - consumer_key \n "
-                        "- consumer_secret \n - access_token_key \n "
-                        "- access_token_secret"
-                    )
-                    logger.error(error_msg)
-                posted = None
-                if user.result_count > 0:
-                    logger.info(
-                        _("tweets gathered: \t {}").format(len(tweets["data"]))
-                    )
-                    # Put oldest first to iterate them and post them in order
-                    tweets["data"].reverse()
-                    if user.rss:  # pragma: todo
-                        tweets_to_post = tweets_rss
-                    else:
-                        if threads > 1:
-                            tweets_to_post = process_parallel(
-                                tweets, user, threads
-                            )
-                        else:  # pragma: todo
-                            tweets_to_post = user.process_tweets(tweets)
-                    logger.info(
-                        _("tweets to post: \t {}").format(
-                            len(tweets_to_post['data'])
-                        )
+        # How many users can be running at the same time, in total and per
+        # Fediverse instance
+        user_workers = config.get("user_workers")
+        if user_workers is None and args.engine != "asyncio":
+            user_workers = 1
+        instance_limit = config.get("instance_concurrency", 2)
+
+        if args.engine == "asyncio" or user_workers > 1:
+            users, exit_code = _setup_users(
+                user_dict, config, args, base_path, posts_ids
+            )
+            if args.engine == "asyncio":
+                run_users = _run_asyncio
+            else:
+                run_users = _run_threaded
+            results = run_users(
+                users, args, posts_path, user_workers, instance_limit
+            )
+            exit_code = _log_results(users, results) or exit_code
+        else:
+            for user_item in user_dict:
+                try:
+                    user, date_fedi = _setup_user(
+                        user_item, config, args, base_path, posts_ids
                     )
-                    logger.debug(
-                        f"tweets_processed: \t {tweets_to_post['data']}"
+                    _run_user(user, date_fedi, args, posts_path)
+                except Exception:
+                    logger.error(
+                        _(
+                            "Exception occurred for user, skipping..."
+                        ), exc_info=True
                     )
-                    tweet_counter = 0
-                    posted = {}
-                    desc = _("Posting tweets... ")
-                    pbar = tqdm(total=len(tweets_to_post["data"]), desc=desc)
-                    for tweet in tweets_to_post["data"]:
-                        tweet_counter += 1
-                        logger.debug(
-                            f"({tweet_counter}/{len(tweets_to_post['data'])})"
-                        )
-                        try:
-                            reply_id = tweet["reply_id"]
-                        except KeyError:  # pragma: todo
-                            reply_id = None
-                        try:
-                            retweet_id = tweet["retweet_id"]
-                        except KeyError:  # pragma: todo
-                            retweet_id = None
-                        post_id = user.post(
-                            (
-                                tweet["id"],
-                                tweet["text"],
-                                tweet["created_at"],
-                                reply_id,
-                                retweet_id
-                            ),
-                            tweet["polls"],
-                            tweet["possibly_sensitive"],
-                            tweets_to_post["media_processed"],
-                            cw=tweet["cw"]
-                        )
-                        posted[tweet["id"]] = post_id
-                        posts_ids = user.posts_ids
-                        with open(posts_path, "r+") as f:
-                            f.write(json.dumps(posts_ids, indent=4))
-                        pbar.update(1)
-                        time.sleep(user.delay_post)
-                    pbar.close()
-                if not user.skip_pin:
-                    user.check_pinned(posted)
-
-                if not (user.no_profile or args.noProfile):
-                    if user.skip_profile:
-                        logger.warning(
-                            _("Multiple twitter users, not updating profile")
-                        )
-                    else:
-                        user.update_profile()
-                # Clean-up
-                shutil.rmtree(user.tweets_temp_path)
-            except Exception:
-                logger.error(
-                    _(
-                        "Exception occurred for user, skipping..."
-                    ), exc_info=True
-                )
-                exit_code = 1
-                continue
+                    exit_code = 1
+                    continue
     except Exception:
         logger.error(_("Exception occurred"), exc_info=True)
         return 1
+    finally:
+        close_registries()
 
     return exit_code
 
@@ -8,6 +8,7 @@ import requests
 import requests_mock
 
 from test_user import UserTemplate
+from pleroma_bot import cli, _cache, _media, _session
 from pleroma_bot.cli import User
 
 
@@ -16,6 +17,30 @@ def rootdir():
     return os.path.dirname(os.path.abspath(__file__))
 
 
+@pytest.fixture(autouse=True)
+def caches(tmp_path, monkeypatch):
+    """
+    Keeps the caches of the users created by a test in its temp dir and
+    starts every test without the caches and sessions of the previous ones
+    """
+    monkeypatch.setattr(_cache, '_caches', {})
+    monkeypatch.setattr(_media, '_media_caches', {})
+    monkeypatch.setattr(_session, '_registries', {})
+
+    def in_tmp_path(get_cache):
+        def wrapper(path, *args, **kwargs):
+            path = os.path.join(tmp_path, os.path.basename(path))
+            return get_cache(path, *args, **kwargs)
+        return wrapper
+
+    monkeypatch.setattr(cli, 'get_cache', in_tmp_path(cli.get_cache))
+    monkeypatch.setattr(
+        cli, 'get_media_cache', in_tmp_path(cli.get_media_cache)
+    )
+    yield tmp_path
+    _session.close_registries()
+
+
 @pytest.fixture
 def mock_request(rootdir):
     test_user = UserTemplate()
@@ -225,8 +250,8 @@ def _sample_users(mock_request, rootdir):
                      json=mock_request['sample_data']['twitter_info'],
                      status_code=200)
 
-            mock.get(f"{test_user.twitter_base_url_v2}/users/2244994945"
-                     f"/tweets",
+            mock.get(f"{test_user.twitter_base_url_v2}/users/"
+                     f"1320506197913542656/tweets",
                      json=mock_request['sample_data']['tweets_v2'],
                      status_code=200)
 
@@ -252,6 +277,14 @@ def _sample_users(mock_request, rootdir):
                      f"&poll.fields=duration_minutes%2Coptions",
                      json=mock_request['sample_data']['poll'],
                      status_code=200)
+            mock.get(f"{test_user.twitter_base_url}/statuses/lookup.json?"
+                     f"id=1323048312161947650%2C1323049214134407171",
+                     json=mock_request['sample_data']['tweets_v1_lookup'],
+                     status_code=200)
+            mock.get(f"{test_user.twitter_base_url_v2}/tweets?ids="
+                     f"1339829031147954177",
+                     json=mock_request['sample_data']['tweets_lookup'],
+                     status_code=200)
             mock.get(f"{config_users['config']['pleroma_base_url']}"
                      f"/api/v1/accounts/"
                      f"{user_item['pleroma_username']}/statuses",
@@ -285,6 +318,12 @@ def _sample_users(mock_request, rootdir):
                       f"/api/v1/media",
                       json=mock_request['sample_data']['pleroma_post_media'],
                       status_code=200)
+            mock.get(re.compile(
+                     re.escape(config_users['config']['pleroma_base_url'])
+                     + "/api/v1/media/"
+                     ),
+                     json=mock_request['sample_data']['pleroma_post_media'],
+                     status_code=200)
             mock.post(f"{config_users['config']['pleroma_base_url']}"
                       f"/api/v1/statuses/{test_user.pleroma_pinned_new}/pin",
                       json=mock_request['sample_data']['pleroma_pin'],
@@ -313,6 +352,10 @@ def _sample_users(mock_request, rootdir):
                       f"/api/drive/files/create",
                       json={"id": 12345},
                       status_code=200)
+            mock.post(f"{config_users['config']['pleroma_base_url']}"
+                      f"/api/drive/files/find-by-hash",
+                      json=[],
+                      status_code=200)
             mock.post(f"{config_users['config']['pleroma_base_url']}"
                       f"/api/drive/files/update",
                       json={"id": 12345},
@@ -1,5 +1,6 @@
 import datetime
 import os
+import copy
 import re
 import sys
 import time
@@ -230,10 +231,21 @@ def test_check_pinned_exception_tweet(sample_users, mock_request):
             f"&expansions=attachments.poll_ids"
             f"&poll.fields=duration_minutes%2Coptions"
         )
+        # Polls are requested only when missing from the includes
+        pinned_tweet = copy.deepcopy(
+            mock_request['sample_data']['pinned_tweet']
+        )
+        del pinned_tweet['includes']['polls']
         # Test exception
         for sample_user in sample_users:
             with sample_user['mock'] as mock:
                 sample_user_obj = sample_user['user_obj']
+                mock.get(
+                    f"{test_user.twitter_base_url_v2}/tweets/"
+                    f"{test_user.pinned}",
+                    json=pinned_tweet,
+                    status_code=200
+                )
                 mock.get(url_tweet,
                          json=mock_request['sample_data']['poll'],
                          status_code=500)
@@ -771,7 +783,8 @@ def test__get_tweets_v2_exception(sample_users):
                 date = sample_user_obj.get_date_last_pleroma_post()
                 date_encoded = urllib.parse.quote(date)
                 tweets_url = (
-                    f"{test_user.twitter_base_url_v2}/users/2244994945/tweets"
+                    f"{test_user.twitter_base_url_v2}/users/"
+                    f"1320506197913542656/tweets"
                     f"?max_results={sample_user_obj.max_tweets}&start_time"
                     f"={date_encoded}&poll."
                     f"fields=duration_minutes%2Cend_datetime%2Cid"
@@ -811,6 +824,11 @@ def test__get_tweets_v2_exception(sample_users):
                     f"usernames={sample_user_obj.twitter_username[idx]}"
                 )
                 mock.get(tweets_url, status_code=500)
+                # The ID is cached by now, remove it to force the lookup
+                id_cache = os.path.join(
+                    sample_user_obj.user_path[t_user], "twitter_id.json"
+                )
+                os.remove(id_cache)
                 start_time = sample_user_obj.get_date_last_pleroma_post()
                 err_ex = requests.exceptions.HTTPError
                 with pytest.raises(err_ex) as error_info:
@@ -907,7 +925,7 @@ def test_main_oauth_exception(
         users_path = os.path.join(os.getcwd(), 'users')
         shutil.rmtree(users_path)
 
-        g_mock.get(f"{test_user.twitter_base_url_v2}/users/2244994945"
+        g_mock.get(f"{test_user.twitter_base_url_v2}/users/1320506197913542656"
                    f"/tweets",
                    json={},
                    status_code=200)
@@ -924,7 +942,7 @@ def test_main_oauth_exception(
                 assert err_msg in caplog.text
 
         # Clean-up
-        g_mock.get(f"{test_user.twitter_base_url_v2}/users/2244994945"
+        g_mock.get(f"{test_user.twitter_base_url_v2}/users/1320506197913542656"
                    f"/tweets",
                    json=mock_request['sample_data']['tweets_v2'],
                    status_code=200)
@@ -999,13 +1017,21 @@ def test__download_media_exception(sample_users, caplog):
             media_url = "https://mymock.media/img.jpg"
             mock.get(media_url, status_code=500)
             media = [{'url': media_url, 'type': 'image', 'media_key': '3_123'}]
-            tweet = None
+            tweet = {"id": "12345"}
+            downloader = sample_user_obj.media_downloader
+            downloader.backoff = 0
+            history_start = len(mock.request_history)
             with pytest.raises(requests.exceptions.HTTPError) as error_info:
                 sample_user_obj._download_media(media, tweet)
             exception_value = f"500 Server Error: None for url: {media_url}"
             assert str(error_info.value) == exception_value
+            # Server errors are retried
+            media_reqs = [
+                req for req in mock.request_history[history_start:]
+                if req.url == media_url
+            ]
+            assert len(media_reqs) == downloader.retries + 1
             mock.get(media_url, status_code=404)
-            tweet = {"id": "12345"}
             with caplog.at_level(logging.WARNING):
                 sample_user_obj._download_media(media, tweet)
             warn_msg1 = "Media not found (404)"
@@ -123,6 +123,8 @@ def test_post_pleroma_media_logger(rootdir, sample_users, caplog):
                 media_url = (
                     f"{test_user.pleroma_base_url}/api/v1/media"
                 )
+                # Make sure the files are uploaded and not reused
+                sample_user_obj.media_id_cache.clear()
                 mock.post(media_url, status_code=413)
                 with caplog.at_level(logging.ERROR):
                     sample_user_obj.post_pleroma(
@@ -1,9 +1,17 @@
+import io
 import os
+import copy
+import time
+import types
 import re
 import sys
+import yaml
 import shutil
+import pickle
 import hashlib
 import logging
+import threading
+import requests
 import urllib.parse
 import multiprocessing as mp
 from unittest.mock import patch
@@ -17,7 +25,18 @@ from conftest import get_config_users
 
 from pleroma_bot import cli, User
 from pleroma_bot._utils import random_string, previous_and_next, guess_type
-from pleroma_bot._utils import process_parallel
+from pleroma_bot._utils import process_parallel, index_media
+from pleroma_bot._utils import ordered_map, chunkify, _since_id_file
+from pleroma_bot._ratelimit import RateLimitTracker, endpoint_family
+from pleroma_bot._cache import JsonCache
+from pleroma_bot._media import MediaCache, MediaDownloader
+from pleroma_bot._processing import _expand_url, _expand_urls
+from pleroma_bot._processing import _prefetch_urls
+from pleroma_bot._processing import _prefetch_referenced_tweets
+from pleroma_bot._rewrite import TextRewriter
+from pleroma_bot._keywords import ContentWarnings, KeywordMatcher
+from pleroma_bot._filters import TweetFilter, archive_filter_fields
+from pleroma_bot._filters import rss_filter_fields
 
 
 def test_random_string():
@@ -896,8 +915,8 @@ def test_get_tweets_next_token(sample_users, mock_request):
     test_user = UserTemplate()
     for sample_user in sample_users:
         with sample_user['mock'] as mock:
-            mock.get(f"{test_user.twitter_base_url_v2}/users/2244994945"
-                     f"/tweets",
+            mock.get(f"{test_user.twitter_base_url_v2}/users/"
+                     f"1320506197913542656/tweets",
                      json=mock_request['sample_data']['tweets_v2_next_token'],
                      status_code=200)
             sample_user_obj = sample_user['user_obj']
@@ -907,7 +926,7 @@ def test_get_tweets_next_token(sample_users, mock_request):
 
                 mock.get(
                     f"{test_user.twitter_base_url_v2}"
-                    f"/users/2244994945"
+                    f"/users/1320506197913542656"
                     f"/tweets",
                     json=mock_request['sample_data']['tweets_v2_next_token2'],
                     status_code=200)
@@ -918,6 +937,1094 @@ def test_get_tweets_next_token(sample_users, mock_request):
     return mock
 
 
+def test_iter_tweets_v2(sample_users, mock_request):
+    """
+    Check that the timeline is yielded page by page and that the pages add up
+    to the tweets returned by _get_tweets_v2
+    """
+    test_user = UserTemplate()
+    for sample_user in sample_users:
+        with sample_user['mock'] as mock:
+            mock.get(f"{test_user.twitter_base_url_v2}/users/"
+                     f"1320506197913542656/tweets",
+                     json=mock_request['sample_data']['tweets_v2_next_token'],
+                     status_code=200)
+            sample_user_obj = sample_user['user_obj']
+            for t_user in sample_user_obj.twitter_username:
+                start_time = sample_user_obj.get_date_last_pleroma_post()
+                pages = sample_user_obj._iter_tweets_v2(start_time, t_user)
+                first_page = next(pages)
+                assert "data" in first_page
+                pages = [first_page] + list(pages)
+                assert len(pages) == 2
+                tweets_v2 = sample_user_obj._get_tweets_v2(
+                    start_time=start_time, t_user=t_user
+                )
+                total = sum(len(page["data"]) for page in pages)
+                assert len(tweets_v2["data"]) == total
+                pages = sample_user_obj._iter_tweets_v2(
+                    start_time, t_user, count=sample_user_obj.max_tweets
+                )
+                assert list(pages) == []
+    return mock
+
+
+def test_twitter_user_id_cache(sample_users):
+    """
+    Check that the Twitter user ID is only looked up again once the cached
+    one expires
+    """
+    test_user = UserTemplate()
+    for sample_user in sample_users:
+        with sample_user['mock'] as mock:
+            sample_user_obj = sample_user['user_obj']
+            for t_user in sample_user_obj.twitter_username:
+                lookup_url = (
+                    f"{test_user.twitter_base_url_v2}/users/by?"
+                    f"usernames={t_user}"
+                )
+                id_cache = os.path.join(
+                    sample_user_obj.user_path[t_user], "twitter_id.json"
+                )
+                if os.path.isfile(id_cache):
+                    os.remove(id_cache)
+
+                def lookups():
+                    return len([
+                        req for req in mock.request_history
+                        if req.url == lookup_url
+                    ])
+
+                lookups_before = lookups()
+                twitter_id = sample_user_obj._get_twitter_user_id(t_user)
+                assert twitter_id == "1320506197913542656"
+                assert os.path.isfile(id_cache)
+                assert sample_user_obj._get_twitter_user_id(t_user) == (
+                    twitter_id
+                )
+                assert lookups() == lookups_before + 1
+
+                sample_user_obj.twitter_id_ttl = 0
+                os.remove(id_cache)
+                sample_user_obj._get_twitter_user_id(t_user)
+                sample_user_obj._get_twitter_user_id(t_user)
+                assert lookups() == lookups_before + 3
+                sample_user_obj.twitter_id_ttl = 86400
+
+                # The profile info comes with the ID, no lookup needed
+                os.remove(id_cache)
+                sample_user_obj._get_twitter_info()
+                assert os.path.isfile(id_cache)
+                lookups_before = lookups()
+                assert sample_user_obj._get_twitter_user_id(t_user)
+                assert lookups() == lookups_before
+    return mock
+
+
+def test_prefetch_referenced_tweets(sample_users, mock_request):
+    """
+    Check that retweeted and quoted tweets are requested in a single batch
+    and served from the index when processing
+    """
+    test_user = UserTemplate()
+    single_url = f"{test_user.twitter_base_url_v2}/tweets/1339829031147954177"
+    for sample_user in sample_users:
+        with sample_user['mock'] as mock:
+            sample_user_obj = sample_user['user_obj']
+            tweets_v2 = mock_request['sample_data']['tweets_v2']
+            tweet_index = sample_user_obj._get_tweets_by_ids(
+                ["1339829031147954177"]
+            )
+            assert tweet_index["1339829031147954178"] is None
+            tweet = tweet_index["1339829031147954177"]
+            assert tweet["includes"]["users"][0]["username"] == "BotPleroma"
+
+            history_len = len(mock.request_history)
+            sample_user_obj.process_tweets(tweets_v2)
+            requests_made = mock.request_history[history_len:]
+            lookups = [
+                req for req in requests_made
+                if req.path == "/2/tweets" and "ids" in req.qs
+                and "1339829031147954177" in req.qs["ids"][0]
+            ]
+            assert len(lookups) == 1
+            singles = [
+                req for req in requests_made
+                if req.url.split("?")[0] == single_url
+            ]
+            assert len(singles) == 0
+
+            # Tweets sharing the includes of a batch share its media index
+            tweet_index = _prefetch_referenced_tweets(
+                sample_user_obj, copy.deepcopy(tweets_v2)
+            )
+            entries = [entry for entry in tweet_index.values() if entry]
+            assert entries
+            for entry in entries:
+                media_keys = [
+                    m["media_key"] for m in entry["includes"]["media"]
+                ]
+                assert sorted(entry["media_index"]) == sorted(media_keys)
+                for other in entries:
+                    if other["includes"] is entry["includes"]:
+                        assert other["media_index"] is entry["media_index"]
+
+            # A retweet of a quote, the retweeted tweet comes with the
+            # includes but the quoted one has to be requested
+            author = {"id": "1", "username": "QuoteAuthor"}
+            quoted = {"id": "902", "text": "quoted", "author_id": "1"}
+            mock.get(
+                f"{test_user.twitter_base_url_v2}/tweets?ids=902",
+                json={"data": [quoted], "includes": {"users": [author]}}
+            )
+            rt_chain = {
+                "data": [{
+                    "id": "900",
+                    "text": "RT",
+                    "author_id": "1",
+                    "referenced_tweets": [{"type": "retweeted", "id": "901"}]
+                }],
+                "includes": {
+                    "users": [author],
+                    "tweets": [{
+                        "id": "901",
+                        "text": "quote",
+                        "author_id": "1",
+                        "referenced_tweets": [{"type": "quoted", "id": "902"}]
+                    }],
+                },
+            }
+            tweet_index = _prefetch_referenced_tweets(
+                sample_user_obj, rt_chain
+            )
+            assert tweet_index["901"]["data"]["text"] == "quote"
+            assert tweet_index["902"]["data"] == quoted
+    return mock
+
+
+def test_prefetch_extended_media(sample_users, mock_request):
+    """
+    Check that the video variants are requested in a single batch and cached
+    for the rest of the run
+    """
+    test_user = UserTemplate()
+    lookup_url = f"{test_user.twitter_base_url}/statuses/lookup.json"
+    show_url = f"{test_user.twitter_base_url}/statuses/show.json"
+    for sample_user in sample_users:
+        with sample_user['mock'] as mock:
+            sample_user_obj = sample_user['user_obj']
+            sample_user_obj.extended_media = {}
+            for _run in range(2):
+                tweets_v2 = copy.deepcopy(
+                    mock_request['sample_data']['tweets_v2']
+                )
+                history_len = len(mock.request_history)
+                tweets = sample_user_obj.process_tweets(tweets_v2)
+                requests_made = [
+                    req.url.split("?")[0]
+                    for req in mock.request_history[history_len:]
+                ]
+                assert requests_made.count(show_url) == 0
+                if not sample_user_obj.media_upload:
+                    assert requests_made.count(lookup_url) == 0
+                    continue
+                expected_lookups = 1 if _run == 0 else 0
+                assert requests_made.count(lookup_url) == expected_lookups
+                media_types = [
+                    media["type"]
+                    for items in tweets["media_processed"].values()
+                    for media in items
+                ]
+                assert "video" in media_types
+                assert "animated_gif" in media_types
+    return mock
+
+
+def test_prefetch_polls(sample_users, mock_request):
+    """
+    Check that polls are taken from the includes and only requested when
+    missing from them
+    """
+    test_user = UserTemplate()
+    for sample_user in sample_users:
+        with sample_user['mock'] as mock:
+            sample_user_obj = sample_user['user_obj']
+
+            def poll_requests(history_len):
+                return [
+                    req for req in mock.request_history[history_len:]
+                    if req.path == "/2/tweets"
+                    and req.qs.get("ids") == [test_user.pinned]
+                ]
+
+            for includes_polls in (True, False):
+                tweets_v2 = copy.deepcopy(
+                    mock_request['sample_data']['tweets_v2']
+                )
+                if not includes_polls:
+                    del tweets_v2["includes"]["polls"]
+                history_len = len(mock.request_history)
+                poll_index = sample_user_obj._prefetch_polls(tweets_v2)
+                assert "1323049466027479040" in poll_index
+                expected_requests = 0 if includes_polls else 1
+                assert len(poll_requests(history_len)) == expected_requests
+
+                history_len = len(mock.request_history)
+                tweets = sample_user_obj.process_tweets(tweets_v2)
+                assert len(poll_requests(history_len)) == expected_requests
+                polls = [
+                    tweet["polls"] for tweet in tweets["data"]
+                    if tweet["id"] == test_user.pinned
+                ]
+                assert polls[0]["expires_in"] == 10080 * 60
+    return mock
+
+
+def test_rate_limit_tracker(sample_users):
+    """
+    Check that the rate limit budget is tracked per endpoint family and that
+    requests are paced when it runs low
+    """
+    assert endpoint_family(
+        "https://api.twitter.com/2/users/2244994945/tweets?max_results=100"
+    ) == endpoint_family("https://api.twitter.com/2/users/1234/tweets")
+    assert endpoint_family(
+        "https://api.twitter.com/2/users/by/username/TwitterDev"
+    ) == "api.twitter.com/2/users/by/username/:id"
+    assert endpoint_family(
+        "https://api.twitter.com/1.1/statuses/show/1234.json"
+    ) == "api.twitter.com/1.1/statuses/show/:id"
+
+    tracker = RateLimitTracker(reserve=0.5, margin=0)
+    key = tracker.key("https://api.twitter.com/2/tweets/1", "token")
+    other_key = tracker.key("https://api.twitter.com/2/tweets/1", "other")
+    assert tracker.reserve_slot(key) == 0
+    reset = int(datetime.now().timestamp()) + 60
+    assert not tracker.update(key, {})
+    assert tracker.update(key, {
+        'x-rate-limit-limit': '10',
+        'x-rate-limit-remaining': '9',
+        'x-rate-limit-reset': str(reset),
+    })
+    # Plenty of budget left
+    assert tracker.reserve_slot(key) == 0
+    assert tracker.status(key) == (8, 10, reset)
+    # Below the reserve requests are spread over the rest of the window
+    tracker.update(key, {
+        'x-rate-limit-limit': '10',
+        'x-rate-limit-remaining': '2',
+        'x-rate-limit-reset': str(reset),
+    })
+    assert tracker.reserve_slot(key) == 0
+    assert 0 < tracker.reserve_slot(key) <= 60
+    # Exhausted, wait until the reset
+    assert tracker.reserve_slot(key) > 50
+    assert tracker.reserve_slot(other_key) == 0
+    # Out of order responses don't give back budget
+    tracker.update(key, {
+        'x-rate-limit-limit': '10',
+        'x-rate-limit-remaining': '5',
+        'x-rate-limit-reset': str(reset),
+    })
+    assert tracker.status(key)[0] == 0
+    # A new window starts from scratch
+    tracker.update(key, {
+        'x-rate-limit-limit': '10',
+        'x-rate-limit-remaining': '10',
+        'x-rate-limit-reset': str(reset + 900),
+    })
+    assert tracker.reserve_slot(key) == 0
+    assert pickle.loads(pickle.dumps(tracker)).status(key) is None
+
+    for sample_user in sample_users:
+        with sample_user['mock'] as mock:
+            sample_user_obj = sample_user['user_obj']
+            url = f"{sample_user_obj.twitter_base_url_v2}/tweets/rate_limit"
+            mock.get(url, json={}, headers={
+                'x-rate-limit-limit': '900',
+                'x-rate-limit-remaining': '899',
+                'x-rate-limit-reset': str(reset),
+            })
+            sample_user_obj.twitter_api_request("GET", url)
+            limits_key = sample_user_obj.rate_limits.key(
+                url, sample_user_obj.twitter_token
+            )
+            assert sample_user_obj.rate_limits.status(limits_key)[1] == 900
+    return mock
+
+
+def test_url_cache(sample_users, tmp_path):
+    """
+    Check that expanded URLs (and failures) are cached and that the cache
+    doesn't grow past its size
+    """
+    cache_path = os.path.join(tmp_path, "cache.json")
+    cache = JsonCache(cache_path, max_entries=2)
+    cache.set("a", 1)
+    cache.set("b", None)
+    assert "b" in cache
+    assert cache.get("a") == 1
+    cache.set("c", 3)
+    # "b" was the least recently used
+    assert "b" not in cache
+    assert len(cache) == 2
+    cache.set("d", 4, ttl=-1)
+    assert "d" not in cache
+    cache.save()
+    assert JsonCache(cache_path).get("c") == 3
+
+    for sample_user in sample_users:
+        with sample_user['mock'] as mock:
+            sample_user_obj = sample_user['user_obj']
+            sample_user_obj.url_cache.clear()
+            short_url = "https://short.test/abc"
+            dead_url = "https://short.test/dead"
+            expanded = "https://example.test/long/url"
+            mock.head(
+                short_url,
+                status_code=301,
+                headers={"Location": expanded}
+            )
+            mock.head(expanded, status_code=200)
+            mock.head(dead_url, status_code=404)
+            history_start = len(mock.request_history)
+            for _attempt in range(2):
+                assert _expand_url(sample_user_obj, short_url) == expanded
+                assert _expand_url(sample_user_obj, dead_url) is None
+            head_reqs = [
+                req.url for req in mock.request_history[history_start:]
+                if req.method == "HEAD"
+            ]
+            assert head_reqs.count(short_url) == 1
+            assert head_reqs.count(dead_url) == 1
+            sample_user_obj.url_cache.clear()
+    return mock
+
+
+def test_finish_user_caches(sample_users, monkeypatch):
+    """
+    Check that the URLs expanded while updating the profile and the media
+    uploaded when posting the pinned tweet are saved, even if updating the
+    profile fails
+    """
+    args = cli.get_args(sysargs=[])
+    bio_url = "https://short.test/bio"
+    expanded = "https://example.test/bio"
+    media_key = "pinned_media_key"
+    for sample_user in sample_users:
+        with sample_user['mock']:
+            user = sample_user['user_obj']
+            os.makedirs(user.tweets_temp_path, exist_ok=True)
+
+            def check_pinned(posted):
+                user.media_id_cache.set(media_key, "pinned_media")
+
+            def update_profile():
+                user.url_cache.set(bio_url, expanded)
+                raise ValueError("Profile update failed")
+
+            monkeypatch.setattr(user, "tweet_sources", {})
+            monkeypatch.setattr(user, "skip_pin", False, raising=False)
+            monkeypatch.setattr(user, "check_pinned", check_pinned)
+            monkeypatch.setattr(user, "skip_profile", False, raising=False)
+            monkeypatch.setattr(user, "no_profile", False)
+            monkeypatch.setattr(user, "update_profile", update_profile)
+            with pytest.raises(ValueError):
+                cli._finish_user(user, [], args)
+            assert JsonCache(user.url_cache.path).get(bio_url) == expanded
+            saved = JsonCache(user.media_id_cache.path)
+            assert saved.get(media_key) == "pinned_media"
+            user.url_cache.delete(bio_url)
+            user.url_cache.save()
+            user.media_id_cache.delete(media_key)
+            user.media_id_cache.save()
+            monkeypatch.undo()
+
+
+def test_prefetch_urls(sample_users):
+    """
+    Check that the shortened URLs of a batch are expanded concurrently before
+    processing the tweets
+    """
+    short_urls = [f"https://short.test/{idx}" for idx in range(3)]
+    # Every expansion waits for the rest, so this only passes if all of
+    # them are in flight at the same time
+    barrier = threading.Barrier(len(short_urls), timeout=10)
+
+    def expand_together(user, url):
+        barrier.wait()
+        user.url_cache.set(url, url)
+        return url
+
+    for sample_user in sample_users:
+        with sample_user['mock'] as mock:
+            sample_user_obj = sample_user['user_obj']
+            sample_user_obj.url_cache.clear()
+            barrier.reset()
+            tweets = {
+                "data": [
+                    {
+                        "id": "1",
+                        # Links without a scheme are never expanded
+                        "text": f"{short_urls[0]} {short_urls[1]} "
+                                f"example.com/page",
+                        "entities": {"urls": []},
+                    },
+                    {
+                        "id": "2",
+                        "text": f"{short_urls[2]} https://t.co/known",
+                        "entities": {
+                            "urls": [
+                                {
+                                    "url": "https://t.co/known",
+                                    "expanded_url": "https://known.test",
+                                }
+                            ]
+                        },
+                    },
+                ]
+            }
+            with patch(
+                    "pleroma_bot._processing._expand_url",
+                    side_effect=expand_together
+            ) as mock_expand:
+                _prefetch_urls(sample_user_obj, tweets)
+            assert mock_expand.call_count == len(short_urls)
+            for url in short_urls:
+                assert sample_user_obj.url_cache.get(url) == url
+            assert "https://t.co/known" not in sample_user_obj.url_cache
+            assert "http://example.com/page" not in sample_user_obj.url_cache
+
+            # _expand_urls (unlike the text rewriter) expands those too
+            tweets["data"][0]["text"] = f"{short_urls[0]} {short_urls[1]}"
+            history_start = len(mock.request_history)
+            for tweet in tweets["data"]:
+                _expand_urls(sample_user_obj, tweet)
+            assert len(mock.request_history) == history_start
+            assert tweets["data"][1]["text"].endswith("https://known.test")
+            sample_user_obj.url_cache.clear()
+    return mock
+
+
+def test_text_rewriter(sample_users):
+    """
+    Check that the rewriter gives the same text the separate passes gave
+    """
+    for sample_user in sample_users:
+        with sample_user['mock'] as mock:
+            sample_user_obj = copy.copy(sample_user['user_obj'])
+            sample_user_obj.keep_media_links = False
+            sample_user_obj.rich_text = True
+            sample_user_obj.nitter = True
+            sample_user_obj.invidious = True
+            sample_user_obj.custom_replacements = {
+                "C++": "Rust", "@imdevKc": "@fedihandle"
+            }
+            rewriter = TextRewriter(sample_user_obj)
+            expansions = {"https://t.co/yt": "https://youtube.com/watch?v=1"}
+            # Mentions sharing a prefix get their own link, the status link
+            # is removed and special characters in keys are taken literally
+            text = (
+                "@imdevKc @imdevKcFan c++ &amp; "
+                "https://twitter.com/a/status/1 https://t.co/yt"
+            )
+            nitter = sample_user_obj.nitter_base_url
+            invidious = sample_user_obj.invidious_base_url
+            expected = (
+                f"[@fedihandle]({nitter}/imdevKc) "
+                f"[@fedihandleFan]({nitter}/imdevKcFan) Rust & "
+                f" {invidious}/watch?v=1"
+            )
+            assert rewriter.rewrite(text, expansions.get) == expected
+            # URLs are expanded before unescaping the text and custom
+            # replacements apply to the whole result, across tokens
+            sample_user_obj.custom_replacements = {"& https": "and https"}
+            rewriter = TextRewriter(sample_user_obj)
+            expansions = {"https://t.co/q?a=1&amp;b=2": "https://q.test/?b"}
+            assert rewriter.rewrite(
+                "x &amp; https://t.co/q?a=1&amp;b=2", expansions.get
+            ) == "x and https://q.test/?b"
+            sample_user_obj.rich_text = False
+            sample_user_obj.keep_media_links = True
+            sample_user_obj.custom_replacements = {}
+            rewriter = TextRewriter(sample_user_obj)
+            assert rewriter.rewrite("@imdevKc https://twitter.com/a") == (
+                f"@imdevKc {nitter}/a"
+            )
+    return mock
+
+
+def test_spool_tweets(sample_users, mock_request):
+    """
+    Check that the pages of the timeline are written to disk when streaming
+    and loaded back one at a time
+    """
+    for sample_user in sample_users:
+        with sample_user['mock'] as mock:
+            sample_user_obj = sample_user['user_obj']
+            start_time = sample_user_obj.get_date_last_pleroma_post()
+            tweets = sample_user_obj.get_tweets(start_time=start_time)
+            result_count = sample_user_obj.result_count
+            page_paths = sample_user_obj.spool_tweets(start_time=start_time)
+            assert sample_user_obj.result_count == result_count
+            assert len(page_paths) == len(
+                sample_user_obj.twitter_username
+            )
+            spooled = []
+            for page_path in page_paths:
+                page = cli._load_page(page_path)
+                assert not os.path.exists(page_path)
+                for include in ("users", "tweets", "media", "polls"):
+                    assert include in page["includes"]
+                spooled.extend(page["data"])
+            assert spooled == tweets["data"]
+            for tweet in spooled:
+                assert tweet["id"] in sample_user_obj.tweet_sources
+    return mock
+
+
+def test_media_downloader(sample_users):
+    """
+    Check that the attachments of a tweet are downloaded at the same time,
+    transient errors are retried and the downloaded bytes are counted
+    """
+    media_urls = [f"https://mymock.media/{idx}.png" for idx in range(3)]
+    media = [
+        {"url": url, "type": "photo", "media_key": f"3_{idx}"}
+        for idx, url in enumerate(media_urls)
+    ]
+    tweet = {"id": "1234567890"}
+    barrier = threading.Barrier(len(media_urls), timeout=10)
+
+    for sample_user in sample_users:
+        with sample_user['mock'] as mock:
+            sample_user_obj = sample_user['user_obj']
+            downloader = sample_user_obj.media_downloader
+            downloader.backoff = 0
+            # Every attachment has to be downloaded here
+            downloader.cache = None
+            tweet_path = os.path.join(
+                sample_user_obj.tweets_temp_path, tweet["id"]
+            )
+            os.makedirs(tweet_path, exist_ok=True)
+            for url in media_urls:
+                mock.get(
+                    url,
+                    [
+                        {"exc": requests.exceptions.ConnectionError},
+                        {"status_code": 503},
+                        {
+                            "content": b"png" * 10,
+                            "headers": {"Content-Type": "image/png"},
+                        },
+                    ]
+                )
+            files, size = downloader.summary()
+            download = downloader.download
+
+            def download_together(url, directory, name, **kwargs):
+                # Only passes if every attachment is in flight at once
+                barrier.wait()
+                return download(url, directory, name, **kwargs)
+
+            barrier.reset()
+            with patch.object(
+                    downloader, "download", side_effect=download_together
+            ):
+                sample_user_obj._download_media(media, tweet)
+            assert sorted(os.listdir(tweet_path)) == [
+                f"{idx}-3_{idx}.png" for idx in range(3)
+            ]
+            assert downloader.summary() == (
+                files + len(media_urls), size + 30 * len(media_urls)
+            )
+            shutil.rmtree(tweet_path)
+    return mock
+
+
+def test_media_cache(sample_users, tmp_path):
+    """
+    Check that downloaded media is stored once by content and linked into
+    the tweet folders, and that the least recently used files are evicted
+    """
+    media_urls = [f"https://mymock.media/cached/{idx}.png" for idx in range(4)]
+    contents = [b"a" * 30, b"b" * 30, b"a" * 30, b"c" * 30]
+    for sample_user in sample_users:
+        with sample_user['mock'] as mock:
+            sample_user_obj = sample_user['user_obj']
+            # Opt-in, nothing is cached unless 'media_cache_size' is set
+            assert sample_user_obj.media_cache is None
+            cache_path = str(tmp_path / sample_user_obj.twitter_username[0])
+            cache = MediaCache(cache_path, max_size=70)
+            downloader = MediaDownloader(
+                sample_user_obj.http, workers=1, retries=0, cache=cache
+            )
+            for url, content in zip(media_urls, contents):
+                mock.get(
+                    url,
+                    content=content,
+                    headers={"Content-Type": "image/png"}
+                )
+            tweet_paths = [str(tmp_path / "t1"), str(tmp_path / "t2")]
+            for tweet_path in tweet_paths:
+                os.makedirs(tweet_path, exist_ok=True)
+
+            first = downloader.download(media_urls[0], tweet_paths[0], "0-a")
+            assert first.endswith(".png")
+            # Cached now, the URL isn't requested again
+            mock.get(media_urls[0], status_code=500)
+            second = downloader.download(media_urls[0], tweet_paths[1], "0-a")
+            assert downloader.summary() == (1, 30)
+            assert os.path.samefile(first, second)
+            # Removing the tweet folder keeps the cached file
+            os.remove(first)
+            with open(second, "rb") as f:
+                assert f.read() == contents[0]
+
+            # Same content from another URL is stored once
+            downloader.download(media_urls[2], tweet_paths[0], "2-a")
+            assert cache.size() == 30
+            downloader.download(media_urls[1], tweet_paths[0], "1-b")
+            assert cache.size() == 60
+            # Use 'a' again, so 'b' is the least recently used
+            cache.fetch(media_urls[0], tweet_paths[0], "0-a")
+            downloader.download(media_urls[3], tweet_paths[0], "3-c")
+            assert cache.size() == 60
+            assert cache.fetch(media_urls[1], tweet_paths[0], "x") is None
+            assert cache.fetch(media_urls[2], tweet_paths[0], "x") is not None
+
+            # The index is kept between runs
+            cache.save()
+            cache = MediaCache(cache_path, max_size=70)
+            assert cache.fetch(media_urls[3], tweet_paths[1], "3-c")
+
+            # Worker processes download without it, their copy of the
+            # index would never be saved
+            restored = pickle.loads(pickle.dumps(downloader))
+            assert restored.cache is None
+            assert downloader.cache is not None
+            for tweet_path in tweet_paths:
+                shutil.rmtree(tweet_path)
+
+            config = dict(sample_user['config'], media_cache_size="1MB")
+            user_obj = User(config['users'][0], config, str(tmp_path), {})
+            assert user_obj.media_cache.max_size == 2 ** 20
+            assert user_obj.media_downloader.cache is user_obj.media_cache
+    return mock
+
+
+def test_media_id_cache(rootdir, sample_users, mock_request):
+    """
+    Check that files already uploaded to the instance are attached by ID
+    instead of being uploaded again
+    """
+    test_user = UserTemplate()
+    png = os.path.join(
+        rootdir, 'test_files', 'sample_data', 'media', 'image.png'
+    )
+    media_id = mock_request['sample_data']['pleroma_post_media']['id']
+    for sample_user in sample_users:
+        with sample_user['mock'] as mock:
+            sample_user_obj = sample_user['user_obj']
+            if not sample_user_obj.media_upload:
+                continue
+            base_url = test_user.pleroma_base_url
+            tweet_folder = os.path.join(
+                sample_user_obj.tweets_temp_path, test_user.pinned
+            )
+            os.makedirs(tweet_folder, exist_ok=True)
+            shutil.copy(png, tweet_folder)
+            tweet = (test_user.pinned, "", "", None, None)
+            sample_user_obj.media_id_cache.clear()
+
+            def requests_to(method, path):
+                return [
+                    req for req in mock.request_history[history_start:]
+                    if req.method == method and req.path == path
+                ]
+
+            for uploads in (1, 0):
+                history_start = len(mock.request_history)
+                sample_user_obj.post_pleroma(tweet, None, False)
+                assert len(requests_to("POST", "/api/v1/media")) == uploads
+                status = requests_to("POST", "/api/v1/statuses")[-1]
+                assert urllib.parse.parse_qs(status.text)["media_ids[]"] == [
+                    str(media_id)
+                ]
+            assert len(requests_to("GET", f"/api/v1/media/{media_id}")) == 1
+
+            # Not valid anymore (e.g. already attached), upload it again
+            mock.get(f"{base_url}/api/v1/media/{media_id}", status_code=404)
+            history_start = len(mock.request_history)
+            sample_user_obj.post_pleroma(tweet, None, False)
+            assert len(requests_to("POST", "/api/v1/media")) == 1
+
+            # Misskey looks for the same file in the drive
+            instance = sample_user_obj.instance
+            sample_user_obj.instance = "misskey"
+            find_url = f"{base_url}/api/drive/files/find-by-hash"
+            mock.post(find_url, json=[{"id": "drive_file"}])
+            history_start = len(mock.request_history)
+            sample_user_obj.post_misskey(tweet, None, False)
+            find = requests_to("POST", "/api/drive/files/find-by-hash")
+            with open(png, "rb") as f:
+                md5 = hashlib.md5(f.read()).hexdigest()
+            assert find[0].json()["md5"] == md5
+            assert not requests_to("POST", "/api/drive/files/create")
+            note = requests_to("POST", "/api/notes/create")[-1]
+            assert note.json()["fileIds"] == ["drive_file"]
+            mock.post(find_url, json=[])
+            sample_user_obj.instance = instance
+            shutil.rmtree(tweet_folder)
+    return mock
+
+
+def test_media_preflight(sample_users, caplog):
+    """
+    Check that attachments too large or of a type the instance doesn't
+    accept are skipped before downloading them
+    """
+    tweet = {"id": "1234567891"}
+    base_url = "https://mymock.media/preflight"
+    for sample_user in sample_users:
+        with sample_user['mock'] as mock:
+            sample_user_obj = sample_user['user_obj']
+            downloader = sample_user_obj.media_downloader
+            cache = downloader.cache
+            downloader.cache = None
+            upload_limits = sample_user_obj.upload_limits
+            mime_types = sample_user_obj.supported_mime_types
+            tweet_path = os.path.join(
+                sample_user_obj.tweets_temp_path, tweet["id"]
+            )
+            os.makedirs(tweet_path, exist_ok=True)
+            bodies = {}
+
+            class Body(io.BytesIO):
+                was_read = False
+
+                def read(self, *args):
+                    self.was_read = True
+                    return super().read(*args)
+
+            def add_media(name, content_type, size, length=True):
+                bodies[name] = Body(b"x" * size)
+                headers = {"Content-Type": content_type}
+                if length:
+                    headers["Content-Length"] = str(size)
+                mock.get(
+                    f"{base_url}/{name}", body=bodies[name], headers=headers
+                )
+                return {
+                    "url": f"{base_url}/{name}",
+                    "type": "photo",
+                    "media_key": name,
+                }
+
+            sample_user_obj.file_max_size = "1KB"
+            sample_user_obj.upload_limits = {"video": 2048}
+            sample_user_obj.supported_mime_types = frozenset(
+                ("image/png", "video/mp4")
+            )
+            media = [
+                add_media("big", "image/png", 4096),
+                add_media("video", "video/mp4", 3072),
+                add_media("webp", "image/webp", 10),
+                add_media("small", "image/png", 512),
+                add_media("unknown", "image/png", 4096, length=False),
+            ]
+            # The video is within file_max_size, only the instance limit
+            sample_user_obj.file_max_size = "3.5KB"
+            with caplog.at_level(logging.ERROR):
+                sample_user_obj._download_media(media, tweet)
+            assert "config file size limit (3.5KB)" in caplog.text
+            assert "size limit of the instance" in caplog.text
+            assert "not supported by the instance (image/webp)" in caplog.text
+            # Nothing was read from the rejected ones
+            for name in ("big", "video", "webp"):
+                assert not bodies[name].was_read
+            # Without Content-Length it's checked once downloaded
+            assert bodies["unknown"].was_read
+            assert os.listdir(tweet_path) == ["3-small.png"]
+
+            shutil.rmtree(tweet_path)
+            del sample_user_obj.file_max_size
+            sample_user_obj.upload_limits = upload_limits
+            sample_user_obj.supported_mime_types = mime_types
+            downloader.cache = cache
+    return mock
+
+
+def test_media_relay(rootdir, sample_users, mock_request, caplog):
+    """
+    Check that relayed media is streamed from its URL to the instance
+    without writing it to disk, unless the upload has to be retried
+    """
+    test_user = UserTemplate()
+    png = os.path.join(
+        rootdir, 'test_files', 'sample_data', 'media', 'image.png'
+    )
+    with open(png, "rb") as f:
+        content = f.read()
+    media_url = "https://mymock.media/relay/image"
+    media_json = mock_request['sample_data']['pleroma_post_media']
+    tweet_id = test_user.pinned
+    tweet = (tweet_id, "", "", None, None)
+    for sample_user in sample_users:
+        with sample_user['mock'] as mock:
+            sample_user_obj = sample_user['user_obj']
+            if not sample_user_obj.media_upload:
+                continue
+            upload_url = f"{test_user.pleroma_base_url}/api/v1/media"
+            downloader = sample_user_obj.media_downloader
+            cache = downloader.cache
+            downloader.cache = None
+            downloader.backoff = 0
+            instance = sample_user_obj.instance
+            sample_user_obj.instance = "pleroma"
+            sample_user_obj.media_relay = True
+            sample_user_obj.media_id_cache.clear()
+            tweet_folder = os.path.join(
+                sample_user_obj.tweets_temp_path, tweet_id
+            )
+            os.makedirs(tweet_folder, exist_ok=True)
+            mock.get(
+                media_url,
+                content=content,
+                headers={"Content-Type": "image/png"},
+            )
+            uploads = []
+
+            def upload(request, context):
+                # The body is sent as it's read from the media response
+                assert not isinstance(request.body, bytes)
+                uploads.append(b"".join(request.body))
+                return media_json
+
+            mock.post(upload_url, json=upload)
+            item = {"url": media_url, "type": "photo", "media_key": "relay"}
+            sample_user_obj._download_media([item], {"id": tweet_id})
+            assert os.listdir(tweet_folder) == []
+            assert sample_user_obj.relayed_media[tweet_id] == {
+                "0-relay": media_url
+            }
+            history_start = len(mock.request_history)
+            sample_user_obj.post_pleroma(tweet, None, False)
+            assert tweet_id not in sample_user_obj.relayed_media
+            assert len(uploads) == 1
+            assert content in uploads[0]
+            assert b'Content-Type: image/png' in uploads[0]
+            assert os.listdir(tweet_folder) == []
+            status = [
+                req for req in mock.request_history[history_start:]
+                if req.path == "/api/v1/statuses"
+            ][-1]
+            assert urllib.parse.parse_qs(status.text)["media_ids[]"] == [
+                str(media_json["id"])
+            ]
+
+            # A failed upload is retried from a temp file
+            sample_user_obj.media_id_cache.clear()
+            mock.post(upload_url, [
+                {"status_code": 503},
+                {"json": media_json, "status_code": 200},
+            ])
+            sample_user_obj._download_media([item], {"id": tweet_id})
+            history_start = len(mock.request_history)
+            with caplog.at_level(logging.WARNING):
+                sample_user_obj.post_pleroma(tweet, None, False)
+            assert "Relaying media failed (HTTP 503)" in caplog.text
+            assert os.listdir(tweet_folder) == ["0-relay.png"]
+            media_posts = [
+                req for req in mock.request_history[history_start:]
+                if req.path == "/api/v1/media"
+            ]
+            assert len(media_posts) == 2
+            assert content in media_posts[1].body
+
+            # Dropped even when the tweet isn't posted again
+            base_url = sample_user_obj.pleroma_base_url
+            posts = sample_user_obj.posts_ids[base_url]
+            avoid_duplicates = sample_user_obj.avoid_duplicates
+            sample_user_obj.avoid_duplicates = True
+            posted = posts.get(tweet_id)
+            posts[tweet_id] = "posted_before"
+            mock.get(f"{base_url}/api/v1/statuses/posted_before", json={})
+            sample_user_obj._download_media([item], {"id": tweet_id})
+            assert tweet_id in sample_user_obj.relayed_media
+            assert sample_user_obj.post_pleroma(tweet, None, False) == (
+                "posted_before"
+            )
+            assert tweet_id not in sample_user_obj.relayed_media
+            if posted is None:
+                del posts[tweet_id]
+            else:
+                posts[tweet_id] = posted
+            sample_user_obj.avoid_duplicates = avoid_duplicates
+
+            mock.post(upload_url, json=media_json, status_code=200)
+            sample_user_obj.media_relay = False
+            sample_user_obj.instance = instance
+            downloader.cache = cache
+            shutil.rmtree(tweet_folder)
+    return mock
+
+
+def test_since_id_cursor(sample_users):
+    """
+    Check that the last mirrored tweet is persisted per Twitter user and used
+    as since_id when no start date is given
+    """
+    test_user = UserTemplate()
+    timeline_path = "/2/users/1320506197913542656/tweets"
+    for sample_user in sample_users:
+        with sample_user['mock'] as mock:
+            sample_user_obj = sample_user['user_obj']
+            for t_user in sample_user_obj.twitter_username:
+                since_id_file = _since_id_file(sample_user_obj, t_user)
+                if os.path.isfile(since_id_file):
+                    os.remove(since_id_file)
+                assert sample_user_obj.get_since_id(t_user) is None
+
+                sample_user_obj.update_since_id(test_user.pinned, t_user)
+                sample_user_obj.update_since_id("1323048139251658753", t_user)
+                assert sample_user_obj.get_since_id(t_user) == test_user.pinned
+
+            sample_user_obj.get_tweets()
+            timeline_reqs = [
+                req for req in mock.request_history
+                if req.path == timeline_path
+            ]
+            assert timeline_reqs[-1].qs["since_id"] == [test_user.pinned]
+            assert "start_time" not in timeline_reqs[-1].qs
+            for tweet_id, t_user in sample_user_obj.tweet_sources.items():
+                assert t_user in sample_user_obj.twitter_username
+
+            start_time = sample_user_obj.get_date_last_pleroma_post()
+            sample_user_obj.get_tweets(start_time=start_time)
+            timeline_reqs = [
+                req for req in mock.request_history
+                if req.path == timeline_path
+            ]
+            assert "since_id" not in timeline_reqs[-1].qs
+            assert "start_time" in timeline_reqs[-1].qs
+
+            for t_user in sample_user_obj.twitter_username:
+                os.remove(_since_id_file(sample_user_obj, t_user))
+    return mock
+
+
+def test_since_id_accounts(sample_users, mock_request, tmp_path):
+    """
+    Check that Fediverse accounts mirroring the same Twitter user keep their
+    own since_id cursor
+    """
+    for sample_user in sample_users:
+        with sample_user['mock'] as mock:
+            mock.get(
+                "https://other.test/.well-known/nodeinfo",
+                json=mock_request['sample_data']['nodeinfo']
+            )
+            config = sample_user['config']
+            user_cfg = config['users'][0]
+            accounts = [
+                User(user_cfg, config, str(tmp_path), {}),
+                User(
+                    dict(user_cfg, pleroma_username="other"),
+                    config, str(tmp_path), {}
+                ),
+                User(
+                    dict(user_cfg, pleroma_base_url="https://other.test"),
+                    config, str(tmp_path), {}
+                ),
+            ]
+            t_user = accounts[0].twitter_username[0]
+            accounts[0].update_since_id("200", t_user)
+            assert accounts[0].get_since_id(t_user) == "200"
+            for account in accounts[1:]:
+                assert account.get_since_id(t_user) is None
+            accounts[1].update_since_id("100", t_user)
+            assert accounts[0].get_since_id(t_user) == "200"
+            assert accounts[1].get_since_id(t_user) == "100"
+            since_id_files = {
+                _since_id_file(account, t_user) for account in accounts
+            }
+            assert len(since_id_files) == len(accounts)
+            for since_id_file in since_id_files:
+                assert since_id_file.startswith(
+                    accounts[0].user_path[t_user]
+                )
+            shutil.rmtree(accounts[0].users_path)
+
+
+def test_since_id_hold(sample_users):
+    """
+    Check that the since_id cursor doesn't move past a tweet that couldn't
+    be posted, so it's gathered again on the next run
+    """
+    for sample_user in sample_users:
+        with sample_user['mock']:
+            sample_user_obj = sample_user['user_obj']
+            t_user = sample_user_obj.twitter_username[0]
+            since_id_file = _since_id_file(sample_user_obj, t_user)
+            tweet_sources = sample_user_obj.tweet_sources
+            delay_post = sample_user_obj.delay_post
+            sample_user_obj.delay_post = 0
+            sample_user_obj.tweet_sources = {
+                tweet_id: t_user for tweet_id in ("100", "200", "300", "400")
+            }
+            posts_path = os.path.join(
+                sample_user_obj.base_path, "posts_hold.json"
+            )
+            with open(posts_path, "w"):
+                pass
+            tweets = {
+                "data": [
+                    {
+                        "id": tweet_id,
+                        "text": "text",
+                        "created_at": None,
+                        "polls": None,
+                        "possibly_sensitive": False,
+                        "cw": None,
+                    }
+                    for tweet_id in ("100", "200", "300")
+                ],
+                "media_processed": {},
+            }
+            if os.path.isfile(since_id_file):
+                os.remove(since_id_file)
+            # "200" fails, "300" is posted after it and "400" is filtered out
+            with patch.object(
+                    sample_user_obj, "post", side_effect=["1", None, "3"]
+            ):
+                cli._post_tweets(
+                    sample_user_obj, tweets, iter(tweets["data"]),
+                    posts_path, {}
+                )
+            assert sample_user_obj.get_since_id(t_user) == "100"
+            sample_user_obj.update_since_ids()
+            assert sample_user_obj.get_since_id(t_user) == "100"
+
+            # Nothing to post isn't a failure
+            sample_user_obj.since_id_holds.clear()
+            tweets["data"][1]["text"] = ""
+            with patch.object(
+                    sample_user_obj, "post", side_effect=["1", None, "3"]
+            ):
+                cli._post_tweets(
+                    sample_user_obj, tweets, iter(tweets["data"]),
+                    posts_path, {}
+                )
+            sample_user_obj.update_since_ids()
+            assert sample_user_obj.get_since_id(t_user) == "400"
+
+            os.remove(since_id_file)
+            os.remove(posts_path)
+            sample_user_obj.tweet_sources = tweet_sources
+            sample_user_obj.delay_post = delay_post
+
+
 def test_process_tweets(rootdir, sample_users, mock_request):
     test_user = UserTemplate()
     for sample_user in sample_users:
@@ -1280,6 +2387,76 @@ def test_content_warnings(sample_users, mock_request, global_mock):
                                 assert enc_cw in history[-1].text
 
 
+def test_tweet_filter(sample_users, mock_request):
+    tweets = mock_request['sample_data']['tweets_v2']["data"]
+    ref_types = [
+        {ref["type"] for ref in tweet.get("referenced_tweets", [])}
+        for tweet in tweets
+    ]
+    assert TweetFilter().apply(tweets) == tweets
+
+    no_rts = TweetFilter(include_rts=False).apply(tweets)
+    assert no_rts == [
+        tweet for tweet, refs in zip(tweets, ref_types)
+        if "retweeted" not in refs
+    ]
+    no_refs = TweetFilter(
+        include_rts=False, include_quotes=False, include_replies=False
+    ).apply(tweets)
+    assert no_refs == [
+        tweet for tweet, refs in zip(tweets, ref_types) if not refs
+    ]
+    sponsored = TweetFilter(hashtags=["sponsored"]).apply(tweets)
+    assert sponsored
+    for tweet in sponsored:
+        assert "#sponsored" in tweet["text"]
+    assert TweetFilter(hashtags=["missing"]).apply(tweets) == []
+
+    archive_tweet = {
+        "full_text": "RT @imdevKc: #Sponsored",
+        "entities": {"hashtags": [{"text": "Sponsored"}]},
+    }
+    fields = archive_filter_fields(archive_tweet)
+    assert TweetFilter(hashtags=["Sponsored"]).accepts(fields)
+    assert not TweetFilter(include_rts=False).accepts(fields)
+
+    fields = rss_filter_fields("R to @imdevKc: it&#39;s #data", "")
+    assert TweetFilter(include_rts=False, hashtags=["data"]).accepts(fields)
+    assert not TweetFilter(hashtags=["39"]).accepts(fields)
+    assert not TweetFilter(include_replies=False).accepts(fields)
+
+
+def test_index_media():
+    media = [
+        {"media_key": "3_1", "url": "a"},
+        {"media_key": "7_2", "url": "b"},
+        {"media_key": "3_1", "url": "c"},
+    ]
+    index = index_media(media)
+    assert index == {"3_1": [media[0], media[2]], "7_2": [media[1]]}
+    index_media([{"id": "rss", "url": "d"}], "id", index)
+    assert index["rss"] == [{"id": "rss", "url": "d"}]
+
+
+def test_keyword_matcher():
+    matcher = KeywordMatcher(["he", "she", "hers", "his"])
+    matches = list(matcher.finditer("uSHErs"))
+    assert matches == [(1, 4, "she"), (2, 4, "he"), (2, 6, "hers")]
+    # Leftmost-longest, non-overlapping
+    assert matcher.sub(str.upper, "ushers his") == "uSHErs HIS"
+    assert not KeywordMatcher([])
+
+    cw = ContentWarnings({
+        "Tetris spoilers": ["tspin", "line clear"],
+        "nippon cartoons": ["manga", "anime"],
+        "spoilers": ["#spoilers"],
+    })
+    text = "The TSpin was better in the mangas\n#tetris #Spoilers line clear"
+    assert cw.check(text) == "Tetris spoilers, spoilers"
+    assert cw.check("manga.") == ""
+    assert cw.check("anime") == "Nippon cartoons"
+
+
 def test_custom_replacements(sample_users, mock_request, global_mock):
     test_user = UserTemplate()
     for sample_user in sample_users:
@@ -1394,12 +2571,6 @@ def test_nitter_instances(sample_users, mock_request, global_mock):
 
                     tweets_to_post = sample_user_obj.process_tweets(tweets_v2)
                     media = tweets_to_post["media_processed"]
-                    media = {
-                        key: [
-                            l_item for l_item in media if
-                            l_item['media_key'] == key
-                        ] for key in set([i['media_key'] for i in media])
-                    }
                     for tweet in tweets_to_post['data']:
                         if sample_user_obj.signature:
                             sample_user_obj.post_pleroma(
@@ -1671,6 +2842,190 @@ def test_tweet_order(sample_users, mock_request, global_mock):
     return test_user, sample_user, mock
 
 
+def test_process_modes(sample_users, mock_request, global_mock):
+    """
+    Check that processing tweets with threads gives the same result as with
+    processes, and that the processed IDs are kept in the user
+    """
+    for sample_user in sample_users:
+        with global_mock as mock:
+            users = get_config_users('config.yml')
+            for user_item in users['user_dict']:
+                sample_user_obj = User(
+                    user_item, users['config'], os.getcwd(), {}
+                )
+                t_user = sample_user_obj.twitter_username[0]
+                results = {}
+                # Processes reuse the media looked up by the threads
+                for mode in ("thread", "process"):
+                    sample_user_obj.process_mode = mode
+                    posts = sample_user_obj.posts_ids[
+                        sample_user_obj.pleroma_base_url
+                    ]
+                    posts.clear()
+                    tweets = sample_user_obj._get_tweets(
+                        "v2", t_user=t_user
+                    )
+                    tweets["data"].reverse()
+                    results[mode] = process_parallel(
+                        copy.deepcopy(tweets), sample_user_obj, 4
+                    )
+                    ids = [tweet["id"] for tweet in tweets["data"]]
+                    processed = [
+                        tweet["id"] for tweet in results[mode]["data"]
+                    ]
+                    assert processed == ids
+                    if mode == "thread":
+                        assert set(posts) == set(ids)
+                    else:
+                        # Lost in the worker processes
+                        assert not posts
+                assert results["thread"] == results["process"]
+    return mock
+
+
+def test_ordered_map():
+    """
+    Check that results are yielded in the order of the items, as soon as
+    the ones before them are ready, with a bounded number of items in flight
+    """
+    # Later items finish first
+    release = {idx: threading.Event() for idx in range(6)}
+    submitted = []
+
+    def items():
+        for idx in range(6):
+            submitted.append(idx)
+            yield idx
+
+    def work(idx):
+        release[idx].wait(10)
+        return idx * 10
+
+    results = ordered_map(work, items(), workers=3, window=3)
+    for idx in (2, 1):
+        release[idx].set()
+    release[0].set()
+    assert next(results) == 0
+    assert next(results) == 10
+    # No more than 'window' items ahead of the last one yielded
+    assert submitted == [0, 1, 2, 3]
+    for event in release.values():
+        event.set()
+    assert list(results) == [20, 30, 40, 50]
+
+    # Items aren't reordered by their value
+    items = ["9", "10", "100", "11"]
+    assert list(ordered_map(str.upper, items, workers=2)) == items
+
+    # Errors reach the consumer
+    with pytest.raises(ZeroDivisionError):
+        list(ordered_map(lambda x: 1 / x, [1, 0, 2], workers=2))
+
+    # Consecutive chunks, joined in order give back the list
+    chunks = chunkify(list(range(7)), 3)
+    assert chunks == [[0, 1, 2], [3, 4], [5, 6]]
+    assert chunkify([1], 3) == [[1], [], []]
+
+
+def test_pipeline_fetched(sample_users, mock_request, global_mock):
+    """
+    Check that tweets are handed to the posting loop in order while the
+    following ones are still being processed, no more than pipeline_depth
+    ahead
+    """
+    for sample_user in sample_users:
+        with global_mock as mock:
+            users = get_config_users('config.yml')
+            for user_item in users['user_dict']:
+                sample_user_obj = User(
+                    user_item, users['config'], os.getcwd(), {}
+                )
+                t_user = sample_user_obj.twitter_username[0]
+                processed_ids = []
+
+                def process_tweet(user, tweet, *args):
+                    processed_ids.append(tweet["id"])
+                    return []
+
+                for depth in (2, 0):
+                    sample_user_obj.pipeline_depth = depth
+                    processed_ids.clear()
+                    tweets = sample_user_obj._get_tweets(
+                        "v2", t_user=t_user
+                    )
+                    ids = [tweet["id"] for tweet in tweets["data"]][::-1]
+                    with patch(
+                            "pleroma_bot._processing._process_tweet",
+                            side_effect=process_tweet
+                    ):
+                        tweets_to_post, processed = cli._pipeline_fetched(
+                            sample_user_obj, tweets, 2
+                        )
+                        first = next(processed)
+                        if depth:
+                            assert len(processed_ids) <= depth
+                        else:
+                            assert len(processed_ids) == len(ids)
+                        posted = [first["id"]]
+                        posted.extend(tweet["id"] for tweet in processed)
+                    assert posted == ids
+                    assert sorted(processed_ids) == sorted(ids)
+                    assert [t["id"] for t in tweets_to_post["data"]] == ids
+    return mock
+
+
+def test_fetch_tweets_order(sample_users, mock_request, global_mock):
+    """
+    Check that the tweets of several Twitter users are posted in the order
+    they were tweeted, not one user after the other
+    """
+    with global_mock as mock:
+        users = get_config_users('config.yml')
+        t_users = [
+            user_item['twitter_username']
+            for user_item in users['user_dict'][:2]
+        ]
+        user_item = dict(users['user_dict'][0], twitter_username=t_users)
+        sample_user_obj = User(user_item, users['config'], os.getcwd(), {})
+        sample_user_obj.pipeline_depth = 2
+        tweets_v2 = copy.deepcopy(mock_request['sample_data']['tweets_v2'])
+        newest_first = sorted(
+            tweets_v2["data"], key=lambda i: int(i["id"]), reverse=True
+        )
+        # Every user gets every other tweet, so their tweets interleave
+        timelines = {
+            t_users[0]: newest_first[0::2],
+            t_users[1]: newest_first[1::2],
+        }
+
+        def get_tweets(version, t_user=None, **kwargs):
+            return {
+                "data": timelines[t_user],
+                "includes": copy.deepcopy(tweets_v2["includes"]),
+                "meta": {"result_count": len(timelines[t_user])},
+            }
+
+        def process_tweet(user, tweet, *args):
+            return []
+
+        with patch.object(sample_user_obj, "_get_tweets", get_tweets):
+            tweets = cli._fetch_tweets(
+                sample_user_obj, "2020-01-01T00:00:00Z"
+            )
+        with patch(
+                "pleroma_bot._processing._process_tweet",
+                side_effect=process_tweet
+        ):
+            _tweets_to_post, processed = cli._pipeline_fetched(
+                sample_user_obj, tweets, 2
+            )
+            posted = [tweet["id"] for tweet in processed]
+        assert posted == [tweet["id"] for tweet in reversed(newest_first)]
+        assert len(set(posted)) > 2
+    return mock
+
+
 def test_keep_media_links(sample_users, mock_request, global_mock):
     test_user = UserTemplate()
     for sample_user in sample_users:
@@ -2007,3 +3362,204 @@ def test_main(rootdir, global_mock, sample_users, monkeypatch, mock_request):
                 if os.path.isfile(pinned_pleroma):
                     os.remove(pinned_pleroma)
     return g_mock
+
+
+def test_session_registry(sample_users):
+    """
+    Check that users with the same pool settings share a registry, requests
+    to the same host reuse one session and the default timeout is applied
+    """
+    registry = sample_users[0]['user_obj'].http
+    for sample_user in sample_users:
+        with sample_user['mock'] as mock:
+            sample_user_obj = sample_user['user_obj']
+            assert sample_user_obj.http is registry
+            base_url = sample_user_obj.pleroma_base_url
+            session = registry.session(base_url)
+            assert session is registry.session(f"{base_url}/api/v1/statuses")
+            assert session is not registry.session("https://api.twitter.com")
+            limit = registry.host_limit(base_url)
+            assert limit is registry.host_limit(f"{base_url}/api/v1/statuses")
+            sample_user_obj.get_date_last_pleroma_post()
+            assert mock.last_request.timeout == registry.timeout
+    restored = pickle.loads(pickle.dumps(registry))
+    assert restored.timeout == registry.timeout
+    assert restored.pool_maxsize == registry.pool_maxsize
+
+
+def test_main_asyncio(rootdir, global_mock, sample_users, monkeypatch):
+    """
+    Check that the asyncio engine runs the whole cycle for every user
+    """
+    with global_mock as g_mock:
+        test_files_dir = os.path.join(rootdir, 'test_files')
+        config_test = os.path.join(test_files_dir, 'config_multiple_users.yml')
+        prev_config = os.path.join(os.getcwd(), 'config.yml')
+        backup_config = os.path.join(os.getcwd(), 'config.yml.bak')
+        if os.path.isfile(prev_config):
+            shutil.copy(prev_config, backup_config)
+        shutil.copy(config_test, prev_config)
+
+        with open(config_test) as f:
+            users = len(yaml.safe_load(f)["users"])
+        engines = []
+
+        class RecordedEngine(cli.AsyncEngine):
+            def __init__(self, *args, **kwargs):
+                super().__init__(*args, **kwargs)
+                engines.append(self)
+
+        monkeypatch.setattr(cli, 'AsyncEngine', RecordedEngine)
+        monkeypatch.setattr('builtins.input', lambda: "2020-12-30")
+        with patch.object(sys, 'argv', ['', '--engine', 'asyncio']):
+            assert cli.main() == 0
+        # A thread for every user, none waits for a free one
+        assert engines[0].max_workers == users
+        with patch.object(
+                sys, 'argv', ['', '--engine', 'asyncio', '--skipChecks']
+        ):
+            assert cli.main() == 0
+        # The pooled sessions are closed once the run is over
+        registry = sample_users[0]['user_obj'].http
+        assert registry._sessions == {}
+        statuses = [
+            req for req in g_mock.request_history
+            if req.method == "POST" and req.path.endswith("/statuses")
+        ]
+        assert len(statuses) > 0
+
+        # Clean-up
+        if os.path.isfile(backup_config):
+            shutil.copy(backup_config, prev_config)
+    return g_mock
+
+
+def test_main_streaming(rootdir, global_mock, sample_users, monkeypatch):
+    """
+    Check that users with 'streaming' enabled are run page by page
+    """
+    with global_mock as g_mock:
+        test_files_dir = os.path.join(rootdir, 'test_files')
+        config_test = os.path.join(test_files_dir, 'config_multiple_users.yml')
+        prev_config = os.path.join(os.getcwd(), 'config.yml')
+        backup_config = os.path.join(os.getcwd(), 'config.yml.bak')
+        if os.path.isfile(prev_config):
+            shutil.copy(prev_config, backup_config)
+        with open(config_test) as f:
+            config = yaml.safe_load(f)
+        config["streaming"] = True
+        with open(prev_config, "w") as f:
+            yaml.safe_dump(config, f)
+
+        loaded = []
+        streamed = []
+        load_page = cli._load_page
+        run_user_streaming = cli._run_user_streaming
+
+        def counting_load_page(page_path):
+            loaded.append(page_path)
+            return load_page(page_path)
+
+        def counting_run_user_streaming(user, *args):
+            streamed.append(user.twitter_username)
+            return run_user_streaming(user, *args)
+
+        monkeypatch.setattr('builtins.input', lambda: "2020-12-30")
+        monkeypatch.setattr(cli, '_load_page', counting_load_page)
+        monkeypatch.setattr(
+            cli, '_run_user_streaming', counting_run_user_streaming
+        )
+        for engine in ("sync", "asyncio"):
+            loaded.clear()
+            streamed.clear()
+            argv = ['', '--skipChecks', '--engine', engine]
+            with patch.object(sys, 'argv', argv):
+                assert cli.main() == 0
+            assert len(loaded) > 0
+            for page_path in loaded:
+                assert not os.path.exists(page_path)
+            # Users with several Twitter users gather every tweet at once,
+            # to post them in order
+            assert len(streamed) < len(config["users"])
+            for t_users in streamed:
+                assert len(t_users) == 1
+
+        # Clean-up
+        if os.path.isfile(backup_config):
+            shutil.copy(backup_config, prev_config)
+    return g_mock
+
+
+def test_main_user_workers(rootdir, global_mock, sample_users, monkeypatch):
+    """
+    Check that users can be run at the same time in a thread pool with
+    a limit of users per Fediverse instance
+    """
+    with global_mock as g_mock:
+        test_files_dir = os.path.join(rootdir, 'test_files')
+        config_test = os.path.join(test_files_dir, 'config_multiple_users.yml')
+        prev_config = os.path.join(os.getcwd(), 'config.yml')
+        backup_config = os.path.join(os.getcwd(), 'config.yml.bak')
+        if os.path.isfile(prev_config):
+            shutil.copy(prev_config, backup_config)
+        with open(config_test) as f:
+            config = yaml.safe_load(f)
+        config["user_workers"] = 3
+        config["instance_concurrency"] = 1
+        with open(prev_config, "w") as f:
+            yaml.safe_dump(config, f)
+
+        monkeypatch.setattr('builtins.input', lambda: "2020-12-30")
+        with patch.object(sys, 'argv', ['', '--skipChecks']):
+            assert cli.main() == 0
+
+        # Several users on two instances, interleaved
+        instances = ("https://one.instance", "https://other.instance")
+        users = [
+            (
+                types.SimpleNamespace(pleroma_base_url=instances[idx % 2]),
+                None,
+            )
+            for idx in range(6)
+        ]
+        running = {}
+        max_running = {}
+        overlaps = []
+        lock = threading.Lock()
+
+        def started(user):
+            base_url = user.pleroma_base_url
+            with lock:
+                running[base_url] = running.get(base_url, 0) + 1
+                max_running[base_url] = max(
+                    max_running.get(base_url, 0), running[base_url]
+                )
+                overlaps.append(
+                    sum(1 for count in running.values() if count) > 1
+                )
+
+        def finished(user):
+            with lock:
+                running[user.pleroma_base_url] -= 1
+
+        def fake_run_user(user, *args):
+            started(user)
+            time.sleep(0.2)
+            finished(user)
+
+        monkeypatch.setattr(cli, '_run_user', fake_run_user)
+        for run_users in (cli._run_threaded, cli._run_asyncio):
+            running.clear()
+            max_running.clear()
+            overlaps.clear()
+            results = run_users(users, None, None, 4, 2)
+            assert results == [None] * len(users)
+            # Users of different instances ran at the same time...
+            assert any(overlaps)
+            # ...but never more than 2 of the same one
+            assert max_running == {instance: 2 for instance in instances}
+
+        # Clean-up
+        if os.path.isfile(backup_config):
+            shutil.copy(backup_config, prev_config)
+    return g_mock